@@ -1,30 +1,91 @@
 import functools
 import logging
+import random
 
-def auto_retry(total_tries=1, pause_between_tries=10.0, logging_name=None):
+def auto_retry(total_tries=1, pause_between_tries=10.0, logging_name=None,
+               backoff_factor=1.0, max_pause=None, jitter=0.0, max_total_pause=None,
+               is_retryable=None, retry_counts=None, call_site=None):
     """
     Returns a decorator.
     If the decorated function fails for any reason,
     pause for a bit and then retry until it has been called total_tries times.
+
+    The defaults reproduce a fixed pause between tries.  The optional arguments
+    turn that into a jittered exponential backoff:
+
+    Args:
+        backoff_factor: Each pause is this many times longer than the previous one.
+        max_pause: Upper limit for a single pause (seconds).
+        jitter: Randomize each pause by up to this fraction (0.5 means +/- 50%),
+                so that tasks which failed together don't all retry together.
+        max_total_pause: Give up (re-raise) rather than pause beyond this total (seconds).
+        is_retryable: Function ex -> bool.  Exceptions it rejects are re-raised immediately.
+                      By default, all exceptions are retried.
+        retry_counts: Optional Spark accumulator created with RetryCountsParam(),
+                      to report retries back to the driver.
+        call_site: Name under which retries are counted (default: the function name).
     """
     assert total_tries >= 1
+    assert 0.0 <= jitter <= 1.0
     def decorator(func):
+        counter_key = call_site or func.func_name
+
+        def count(event):
+            if retry_counts is not None:
+                retry_counts.add( { (counter_key, event): 1 } )
+
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
             remaining_tries = total_tries
+            pause = pause_between_tries
+            total_pause = 0.0
             while True:
                 try:
                     return func(*args, **kwargs)
                 except Exception as ex:
                     remaining_tries -= 1
+                    if is_retryable is not None and not is_retryable(ex):
+                        count('fatal')
+                        raise
                     if remaining_tries == 0:
+                        count('exhausted')
+                        raise
+
+                    this_pause = pause * (1.0 + jitter*random.uniform(-1.0, 1.0))
+                    if max_pause is not None:
+                        this_pause = min(this_pause, max_pause)
+                    if max_total_pause is not None and total_pause + this_pause > max_total_pause:
+                        count('exhausted')
                         raise
+
+                    count('retry')
                     if logging_name:
                         logger = logging.getLogger(logging_name)
                         logger.warn("Call to '{}' failed with error: {}.".format(func.func_name, repr(ex)))
-                        logger.warn("Retrying {} more times".format( remaining_tries ))
+                        logger.warn("Retrying {} more times (after {:.1f} seconds)".format( remaining_tries, this_pause ))
                     import time
-                    time.sleep(pause_between_tries)
+                    time.sleep(this_pause)
+                    total_pause += this_pause
+                    pause *= backoff_factor
         wrapper.__wrapped__ = func # Emulate python 3 behavior of @functools.wraps
         return wrapper
     return decorator
+
+class RetryCountsParam(object):
+    """
+    AccumulatorParam for auto_retry(..., retry_counts=...).
+
+    Accumulates a dict of { (call_site, event): count },
+    where event is one of 'retry', 'fatal', or 'exhausted'.
+
+    Example (on the driver):
+
+        retry_counts = sc.accumulator({}, RetryCountsParam())
+    """
+    def zero(self, value):
+        return {}
+
+    def addInPlace(self, counts1, counts2):
+        for key, count in counts2.items():
+            counts1[key] = counts1.get(key, 0) + count
+        return counts1
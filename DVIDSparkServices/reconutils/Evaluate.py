@@ -12,6 +12,15 @@ import numpy
 from segstats import *
 from morpho import *
 
+def _values_at(volume, coords):
+    """Return the labels at the given (N,3) zyx coordinates.
+
+    The volume can be an ndarray or a CompressedNumpyArray.
+    """
+    if hasattr(volume, 'values_at'):
+        return volume.values_at(coords)
+    return volume[tuple(coords.transpose())]
+
 class Evaluate(object):
     """Class to handle various aspects of segmentation evaluation workflow.
 
@@ -287,13 +296,18 @@ class Evaluate(object):
             index2body_gt = {}
             index2body_seg = {}
 
-            for index, point in subvolume_pts.items():
-                # z,y,x -- c order
-                # get bodies on points
+            # get bodies on all points at once
+            # (compressed volumes only decompress the slices that have points)
+            point_indexes = subvolume_pts.keys()
+            point_coords = numpy.array([subvolume_pts[index][::-1] for index in point_indexes],
+                                       dtype=numpy.int64).reshape(-1, 3) # z,y,x -- c order
+            gtbodies = dict(zip(point_indexes, _values_at(labelgt, point_coords)))
+            segbodies = dict(zip(point_indexes, _values_at(label2, point_coords)))
 
+            for index, point in subvolume_pts.items():
                 # ints are json serializable
-                gtbody = int(labelgt[(point[2], point[1], point[0])])
-                segbody = int(label2[(point[2], point[1], point[0])])
+                gtbody = int(gtbodies[index])
+                segbody = int(segbodies[index])
           
                 # !!ignore all 0 points (assume segbody is not 0 anywhere for now)
                 #if gtbody == 0 or segbody == 0:
@@ -15,10 +15,12 @@ from quilted.h5blockstore import H5BlockStore
 
 import DVIDSparkServices
 from DVIDSparkServices.json_util import validate_and_inject_defaults
-from DVIDSparkServices.auto_retry import auto_retry
-from DVIDSparkServices.sparkdvid.sparkdvid import retrieve_node_service
-from DVIDSparkServices.util import zip_many, select_item, dense_roi_mask_for_subvolume
+from DVIDSparkServices.sparkdvid.sparkdvid import retrieve_node_service, checkout_node_service, dvid_read_retry
+from DVIDSparkServices.sparkdvid.TokenService import dvid_token
+from DVIDSparkServices.util import zip_many, select_item, dense_roi_mask_for_subvolume, mask_roi
+from DVIDSparkServices.reconutils.misc import quantize_predictions, dequantize_predictions
 from DVIDSparkServices.sparkdvid.Subvolume import Subvolume
+from DVIDSparkServices.sparkdvid.CompressedNumpyArray import CompressedNumpyArray
 from DVIDSparkServices.subprocess_decorator import execute_in_subprocess
 
 from logcollector.client_utils import make_log_collecting_decorator
@@ -146,6 +148,12 @@ class Segmentor(object):
               },
               "additionalProperties": true,
               "default": {}
+            },
+            "prediction-dtype": {
+              "description": "How voxel predictions are stored in RDDs and the block cache.  uint8 and uint16 predictions are quantized (1.0 is stored as the dtype's max value), and converted back to float32 before they are passed to the create-supervoxels and agglomerate-supervoxels functions.",
+              "type": "string",
+              "enum": ["float32", "uint8", "uint16"],
+              "default": "float32"
             }
           },
           "additionalProperties": true,
@@ -175,6 +183,8 @@ class Segmentor(object):
             self.pdconf = self.segmentor_config["preserve-bodies"]
             self.preserve_bodies = set(self.pdconf["bodies"])
 
+        self.prediction_dtype = np.dtype(str(self.segmentor_config["prediction-dtype"]))
+
 
     def segment(self, subvols_rdd, gray_blocks,
                 gray_checkpoint_dir, mask_checkpoint_dir, pred_checkpoint_dir, sp_checkpoint_dir, seg_checkpoint_dir,
@@ -353,16 +363,15 @@ class Segmentor(object):
                 assert data_mask.dtype == np.bool, "Mask array should be boolean"
                 assert data_mask.ndim == 3
             
-            # Determine how the ROI intersects this subvolume
-            roi_mask = dense_roi_mask_for_subvolume(subvolume)
-
-            # Combine
-            if data_mask is None:
-                data_mask = roi_mask
-            else:
-                data_mask[:] &= roi_mask
+            # Combine with the ROI
+            # (Interior subvolumes are entirely within the ROI, so they need no ROI mask.)
+            if not subvolume.is_interior:
+                if data_mask is None:
+                    data_mask = dense_roi_mask_for_subvolume(subvolume)
+                else:
+                    mask_roi(data_mask, subvolume)
 
-            if data_mask.all():
+            if data_mask is None or data_mask.all():
                 # By convention, None means "everything"
                 return None
 
@@ -374,9 +383,11 @@ class Segmentor(object):
         """Create a dummy placeholder boundary channel from grayscale.
 
         Takes an RDD of grayscale numpy volumes and produces
-        an RDD of predictions (z,y,x).
+        an RDD of predictions (z,y,x,c), quantized to the
+        configured prediction-dtype (see quantize_predictions).
         """
         prediction_function = self._get_segmentation_function('predict-voxels')
+        prediction_dtype = self.prediction_dtype
 
         @send_log_with_key(lambda (sv, (_g, _mc)): str(sv))
         @Segmentor.use_block_cache(pred_checkpoint_dir, allow_read=allow_pred_rollback)
@@ -390,15 +401,14 @@ class Segmentor(object):
             # Call the (custom) function
             predictions = prediction_function(gray, mask)
             assert predictions.ndim == 4, "Predictions volume should be 4D: z-y-x-c"
-            assert predictions.dtype == np.float32, "Predictions should be float32"
+            assert predictions.dtype in (np.float32, prediction_dtype), \
+                "Predictions should be float32 (or {})".format( prediction_dtype )
             assert predictions.shape[:3] == tuple(np.array(block_bounds_zyx[1]) - block_bounds_zyx[0]), \
                 "predictions have unexpected shape: {}, expected block_bounds: {}"\
                 .format( predictions.shape, block_bounds_zyx )
 
-            #import numpy
-            #predictions = predictions * 100
-            #predictions = predictions.astype(numpy.uint8)
-            return predictions
+            # Quantize before the predictions are cached and persisted
+            return quantize_predictions(predictions, prediction_dtype)
              
         return subvols.zip( gray_blocks.zip(mask_blocks) ).map(_execute_for_chunk, True)
 
@@ -426,6 +436,8 @@ class Segmentor(object):
         preserve_bodies = self.preserve_bodies
         resource_server = self.context.workflow.resource_server
         resource_port = self.context.workflow.resource_port
+        retry_counts = self.context.retry_counts
+        dvid_tokens = self.context.workflow.dvid_tokens
 
         @send_log_with_key(lambda (sv, (_pc, _mc)): str(sv))
         @Segmentor.use_block_cache(sp_checkpoint_dir, allow_read=allow_sp_rollback)
@@ -442,27 +454,21 @@ class Segmentor(object):
             mask_bodies = None
             if pdconf is not None:
                 # extract labels 64
-                border = subvolume.border
                 # get sizes of sv box
-                size_z = subvolume.box.z2 + 2*border - subvolume.box.z1
-                size_y = subvolume.box.y2 + 2*border - subvolume.box.y1
-                size_x = subvolume.box.x2 + 2*border - subvolume.box.x1
+                size_z, size_y, size_x = subvolume.shape_with_border
                  
                 # retrieve data from box start position considering border
-                @auto_retry(3, pause_between_tries=60.0, logging_name=__name__)
+                @dvid_read_retry("Segmentor.create_supervoxels", retry_counts)
                 def get_segmask():
-                    node_service = retrieve_node_service(pdconf["dvid-server"], 
-                            pdconf["uuid"], resource_server, resource_port)
-                    # retrieve data from box start position
-                    # Note: libdvid uses zyx order for python functions
-                    if resource_server != "":  
+                    with checkout_node_service(pdconf["dvid-server"], 
+                            pdconf["uuid"], resource_server, resource_port) as node_service, \
+                            dvid_token(dvid_tokens, 'read', 8*size_z*size_y*size_x):
+                        # retrieve data from box start position
+                        # Note: libdvid uses zyx order for python functions
                         return node_service.get_labels3D(str(pdconf["segmentation-name"]),
                                 (size_z, size_y, size_x),
-                                (subvolume.box.z1-border, subvolume.box.y1-border, subvolume.box.x1-border), throttle=False)
-                    else:   
-                        return node_service.get_labels3D(str(pdconf["segmentation-name"]),
-                                (size_z, size_y, size_x),
-                                (subvolume.box.z1-border, subvolume.box.y1-border, subvolume.box.x1-border))
+                                subvolume.box_with_border[0:3],
+                                throttle=(resource_server == "" and dvid_tokens is None))
                 preserve_seg = get_segmask()
 
                 orig_bodies = set(np.unique(preserve_seg))
@@ -473,11 +479,7 @@ class Segmentor(object):
                     mask[preserve_seg == body] = False
 
             # Call the (custom) function
-            #import numpy
-            #prediction = prediction.astype(numpy.float32)
-            #prediction = prediction / 100
-
-            supervoxels = supervoxel_function(prediction, mask)
+            supervoxels = supervoxel_function(dequantize_predictions(prediction), mask)
             
             # insert bodies back and avoid conflicts with pre-existing bodies
             if mask_bodies is not None:
@@ -526,9 +528,6 @@ class Segmentor(object):
         def _execute_for_chunk(args):
             import DVIDSparkServices
             subvolume, (gray, predictions, supervoxels) = args
-            #import numpy
-            #predictions = predictions.astype(numpy.float32)
-            #predictions = predictions / 100
             box = subvolume.box_with_border
             block_bounds_zyx = ( (box.z1, box.y1, box.x1), (box.z2, box.y2, box.x2) )
             
@@ -547,7 +546,7 @@ class Segmentor(object):
 
 
             # Call the (custom) function
-            agglomerated = agglomeration_function(gray, predictions, supervoxels)
+            agglomerated = agglomeration_function(gray, dequantize_predictions(predictions), supervoxels)
             assert agglomerated.ndim == 3, "Agglomerated supervoxels should be 3D (no channel dimension)"
             assert agglomerated.dtype == np.uint32, "Agglomerated supervoxels for a single chunk should be uint32"
             assert agglomerated.shape == tuple(np.array(block_bounds_zyx[1]) - block_bounds_zyx[0]), \
@@ -574,6 +573,8 @@ class Segmentor(object):
                               ... ]
 
         Note: This function requires that label_chunks is already persist()ed in memory.
+              The seg_vols may be CompressedNumpyArrays, in which case only
+              the boundary slabs are decompressed for stitching.
         """
         assert label_chunks.is_cached, "You must persist() label_chunks before calling this function."
         subvolumes_rdd = select_item(label_chunks, 0)
@@ -619,6 +620,11 @@ class Segmentor(object):
             subvolume, labels = key_labels
 
             boundary_array = []
+
+            # The graph builder needs the whole volume
+            if stitch_constraints and isinstance(labels, CompressedNumpyArray):
+                labels = labels.deserialize()
+                key_labels = (subvolume, labels)
             
             # if optioned: extract graph, apply offset, and add to specific boundary in for loop 
             graph_edges = None
@@ -640,6 +646,7 @@ class Segmentor(object):
                         graph_edges.add((n1,n2)) 
 
             # iterate through all box partners
+            bz, by, bx = subvolume.border_zyx
             for partner in subvolume.local_regions:
                 key1 = subvolume.sv_index
                 key2 = partner[0]
@@ -649,22 +656,22 @@ class Segmentor(object):
                 
                 # crop volume to overlap
                 offx1, offx2, offx1_2, offx2_2 = intersects(
-                                subvolume.box.x1-subvolume.border,
-                                subvolume.box.x2+subvolume.border,
-                                box2.x1-subvolume.border,
-                                box2.x2+subvolume.border
+                                subvolume.box.x1-bx,
+                                subvolume.box.x2+bx,
+                                box2.x1-bx,
+                                box2.x2+bx
                             )
                 offy1, offy2, offy1_2, offy2_2 = intersects(
-                                subvolume.box.y1-subvolume.border,
-                                subvolume.box.y2+subvolume.border,
-                                box2.y1-subvolume.border,
-                                box2.y2+subvolume.border
+                                subvolume.box.y1-by,
+                                subvolume.box.y2+by,
+                                box2.y1-by,
+                                box2.y2+by
                             )
                 offz1, offz2, offz1_2, offz2_2 = intersects(
-                                subvolume.box.z1-subvolume.border,
-                                subvolume.box.z2+subvolume.border,
-                                box2.z1-subvolume.border,
-                                box2.z2+subvolume.border
+                                subvolume.box.z1-bz,
+                                subvolume.box.z2+bz,
+                                box2.z1-bz,
+                                box2.z2+bz
                             )
                             
                 labels_cropped = numpy.copy(labels[offz1:offz2, offy1:offy2, offx1:offx2])
@@ -1298,6 +1305,8 @@ class Segmentor(object):
             import numpy
 
             (subvolume, labels) = key_label_mapping
+            if isinstance(labels, CompressedNumpyArray):
+                labels = labels.deserialize()
 
             # grab broadcast offset
             offset = subvolume_offsets.value[subvolume.sv_index]
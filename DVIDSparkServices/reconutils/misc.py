@@ -272,3 +272,47 @@ def normalize_channels_in_place(predictions):
     # Normalize
     predictions[:] /= channel_totals[...,None]
 
+def quantize_predictions(predictions, dtype):
+    """
+    Convert predictions (in the range 0.0-1.0) to the given dtype,
+    which may be float32, uint8, or uint16.
+
+    Quantized predictions span the full range of the integer dtype,
+    i.e. 0.0 -> 0 and 1.0 -> 255 (uint8) or 65535 (uint16).
+    Values outside 0.0-1.0 are clipped.
+
+    Predictions that already have the given dtype are returned as-is.
+    Quantized predictions of another dtype are converted.
+    """
+    import numpy as np
+    dtype = np.dtype(dtype)
+    assert dtype in (np.float32, np.uint8, np.uint16), \
+        "Unsupported prediction dtype: {}".format(dtype)
+
+    if predictions.dtype == dtype:
+        return predictions
+
+    predictions = dequantize_predictions(predictions)
+    if dtype == np.float32:
+        return predictions.astype(np.float32, copy=False)
+
+    # Scale, clip, and round
+    max_value = np.iinfo(dtype).max
+    scaled = np.multiply(predictions, np.float32(max_value), dtype=np.float32)
+    np.clip(scaled, 0, max_value, out=scaled)
+    scaled += np.float32(0.5)
+    return scaled.astype(dtype)
+
+def dequantize_predictions(predictions):
+    """
+    Convert predictions from quantize_predictions() back to float32 (0.0-1.0).
+    Float predictions are returned as-is.
+    """
+    import numpy as np
+    if predictions.dtype not in (np.uint8, np.uint16):
+        return predictions
+
+    max_value = np.iinfo(predictions.dtype).max
+    dequantized = predictions.astype(np.float32)
+    dequantized /= np.float32(max_value)
+    return dequantized
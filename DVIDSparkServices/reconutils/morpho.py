@@ -356,6 +356,7 @@ def stitch(sc, label_chunks):
         boundary_array = []
 
         # iterate through all ROI partners
+        bz, by, bx = subvolume.border_zyx
         for partner in subvolume.local_regions:
             key1 = subvolume.sv_index
             key2 = partner[0]
@@ -365,22 +366,22 @@ def stitch(sc, label_chunks):
 
             # crop volume to overlap
             offx1, offx2, offx1_2, offx2_2 = intersects(
-                subvolume.box.x1 - subvolume.border,
-                subvolume.box.x2 + subvolume.border,
-                box2.x1 - subvolume.border,
-                box2.x2 + subvolume.border
+                subvolume.box.x1 - bx,
+                subvolume.box.x2 + bx,
+                box2.x1 - bx,
+                box2.x2 + bx
             )
             offy1, offy2, offy1_2, offy2_2 = intersects(
-                subvolume.box.y1 - subvolume.border,
-                subvolume.box.y2 + subvolume.border,
-                box2.y1 - subvolume.border,
-                box2.y2 + subvolume.border
+                subvolume.box.y1 - by,
+                subvolume.box.y2 + by,
+                box2.y1 - by,
+                box2.y2 + by
             )
             offz1, offz2, offz1_2, offz2_2 = intersects(
-                subvolume.box.z1 - subvolume.border,
-                subvolume.box.z2 + subvolume.border,
-                box2.z1 - subvolume.border,
-                box2.z2 + subvolume.border
+                subvolume.box.z1 - bz,
+                subvolume.box.z2 + bz,
+                box2.z1 - bz,
+                box2.z2 + bz
             )
 
             labels_cropped = numpy.copy(labels[offz1:offz2, offy1:offy2, offx1:offx2])
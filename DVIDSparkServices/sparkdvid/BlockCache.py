@@ -0,0 +1,147 @@
+"""Defines an in-process LRU cache of DVID blocks.
+
+Neighboring subvolumes overlap by their borders, so the same voxels
+are fetched from DVID more than once.  When neighboring subvolumes are
+processed by the same executor process, BlockCache lets the second one
+reuse the blocks that the first one already fetched.
+
+Volumes are cached in 32^3 blocks, keyed by (instance key, block coord),
+where the instance key identifies the data source (e.g. server, uuid,
+and instance name).  Fetches are expanded to block boundaries, and only
+the (bounding box of the) blocks that aren't cached yet are requested.
+
+Note: Cached blocks are never invalidated, so only cache data that
+      doesn't change while the workflow runs (e.g. grayscale, or labels
+      that the workflow doesn't write to).
+
+"""
+import threading
+from collections import OrderedDict
+import numpy as np
+
+class BlockCache(object):
+    """ LRU cache of blocks, limited by total size in bytes."""
+
+    def __init__(self, max_bytes, blocksize=32):
+        """Initialize cache.
+
+        Args:
+            max_bytes (int): evict least-recently-used blocks beyond this size
+            blocksize (int): width of the cached blocks
+
+        """
+        self.max_bytes = max_bytes
+        self.blocksize = blocksize
+        self._lock = threading.Lock()
+        self._blocks = OrderedDict()
+        self._nbytes = 0
+        self._counters = { "hits": 0, "misses": 0, "evictions": 0 }
+
+    def get_box(self, fetch_box, instance_key, shape_zyx, offset_zyx, dtype, hit_counter=None, miss_counter=None):
+        """Return the given box, using cached blocks where possible.
+
+        Args:
+            fetch_box (callable): fetch_box(shape_zyx, offset_zyx) -> ndarray,
+                called (at most once) with a block-aligned box
+            instance_key (tuple): identifies the data source
+            shape_zyx, offset_zyx: box to return
+            dtype: dtype of the returned array
+            hit_counter, miss_counter: (Optional) objects with an add(n)
+                method (e.g. Spark accumulators) to count block hits/misses
+
+        Returns:
+            C-contiguous ndarray of shape shape_zyx
+        """
+        bs = self.blocksize
+        start = np.array(offset_zyx)
+        stop = start + shape_zyx
+        block_start = start // bs
+        block_stop = (stop + bs - 1) // bs
+
+        block_coords = [ tuple(block_start + c) for c in np.ndindex(*(block_stop - block_start)) ]
+        blocks = {}
+        with self._lock:
+            for coord in block_coords:
+                block = self._blocks.pop((instance_key, coord), None)
+                if block is not None:
+                    # Re-insert as most-recently-used
+                    self._blocks[(instance_key, coord)] = block
+                    blocks[coord] = block
+            missing = [coord for coord in block_coords if coord not in blocks]
+            self._counters["hits"] += len(blocks)
+            self._counters["misses"] += len(missing)
+
+        if hit_counter is not None:
+            hit_counter.add(len(blocks))
+        if miss_counter is not None:
+            miss_counter.add(len(missing))
+
+        if missing:
+            # Fetch the bounding box of the missing blocks in one request.
+            missing_start = np.min(missing, axis=0)
+            missing_stop = 1 + np.max(missing, axis=0)
+            data = fetch_box( tuple((missing_stop - missing_start) * bs), tuple(missing_start * bs) )
+
+            new_blocks = []
+            for c in np.ndindex(*(missing_stop - missing_start)):
+                block_slicing = tuple( slice(i*bs, (i+1)*bs) for i in c )
+                block = data[block_slicing].copy()
+                coord = tuple(missing_start + c)
+                blocks[coord] = block
+                new_blocks.append( ((instance_key, coord), block) )
+            del data
+            self._insert(new_blocks)
+
+        # Assemble the block-aligned volume, then crop to the requested box.
+        aligned = np.empty( (block_stop - block_start) * bs, dtype=dtype )
+        for coord in block_coords:
+            c = np.array(coord) - block_start
+            aligned[tuple( slice(i*bs, (i+1)*bs) for i in c )] = blocks[coord]
+
+        crop_start = start - block_start*bs
+        crop = tuple( slice(a, b) for (a, b) in zip(crop_start, crop_start + shape_zyx) )
+        return np.ascontiguousarray(aligned[crop])
+
+    def stats(self):
+        """Return a dict of hit/miss/eviction counters (in blocks) and the current size."""
+        with self._lock:
+            stats = dict(self._counters)
+            stats["blocks"] = len(self._blocks)
+            stats["bytes"] = self._nbytes
+            return stats
+
+    def clear(self):
+        """Discard all blocks (counters are kept)."""
+        with self._lock:
+            self._blocks.clear()
+            self._nbytes = 0
+
+    def _insert(self, key_blocks):
+        with self._lock:
+            for key, block in key_blocks:
+                old_block = self._blocks.pop(key, None)
+                if old_block is not None:
+                    self._nbytes -= old_block.nbytes
+                self._blocks[key] = block
+                self._nbytes += block.nbytes
+
+            while self._nbytes > self.max_bytes and self._blocks:
+                _key, block = self._blocks.popitem(last=False)
+                self._nbytes -= block.nbytes
+                self._counters["evictions"] += 1
+
+# Process-wide cache (created on first use; see process_block_cache())
+_process_block_cache = None
+_process_block_cache_lock = threading.Lock()
+
+def process_block_cache(max_bytes):
+    """Return this process's BlockCache, with its size limit set to max_bytes.
+
+    The cache persists across tasks run by the same (reused) python worker.
+    """
+    global _process_block_cache
+    with _process_block_cache_lock:
+        if _process_block_cache is None:
+            _process_block_cache = BlockCache(max_bytes)
+        _process_block_cache.max_bytes = max_bytes
+        return _process_block_cache
@@ -0,0 +1,182 @@
+"""Defines a Spark serializer for shuffles of small, keyed numeric records.
+
+Graph and stitching workflows shuffle millions of small records, like
+((v1, v2), weight) or ((sv_index_1, sv_index_2), (subvol, labels, edges)).
+Pickled one tuple at a time, each number costs several bytes of opcodes
+(plus a full object for numpy scalars), and nothing is compressed.
+
+pyspark hands its serializer a whole batch (a list) of records at a time,
+e.g. one shuffle bucket.  When every record in the batch is a (key, value)
+pair with the same layout, ColumnarSerializerLZ4 stores the batch as
+columns instead:
+
+    key:    an int, or a tuple of ints (all the same length)
+    value:  a number, a tuple of numbers (all the same length),
+            or anything else (all values are then pickled together)
+
+Integer columns are stored as int64 and float columns as float64, and the
+columns are compressed together (byte-shuffled, then lz4).  Any other batch
+is pickled with the wrapped serializer and compressed with lz4, as in
+CompressedSerializerLZ4.
+
+Note: Integers (including numpy integer scalars) are read back as python
+ints, and floats as python floats.
+
+Frame format:
+
+    'P' | lz4(wrapped serializer's frame)
+
+    'C' | header ('<Qbb': num records, key arity, value arity)
+        | column types (one char per column: 'i' or 'f')
+        | compressed columns length (uint64) | compressed columns
+        | lz4(wrapped serializer's frame of the list of values), if pickled
+
+    (arity -1 means a scalar key/value; arity -2 means pickled values)
+
+Workflow: [(key, value), ...] => int64/float64 columns => lz4 => JVM
+
+"""
+import struct
+import numpy as np
+from pyspark.serializers import FramedSerializer, PickleSerializer
+from DVIDSparkServices.sparkdvid.CompressedNumpyArray import get_codec, lz4_compress, lz4_decompress
+
+SCALAR = -1
+PICKLED = -2
+
+_INT_TYPES = frozenset([int, long, np.int8, np.uint8, np.int16, np.uint16,
+                        np.int32, np.uint32, np.int64, np.uint64])
+_FLOAT_TYPES = frozenset([float, np.float64])
+
+class ColumnarSerializerLZ4(FramedSerializer):
+    """ Store batches of keyed numeric records as compressed columns.
+
+        Note: Like CompressedSerializerLZ4, frames can't be larger than 2GB.
+
+    """
+    HEADER_FORMAT = '<Qbb'
+
+    # Smaller batches (e.g. single records, with batchSize=1) are just pickled.
+    MIN_COLUMNAR_RECORDS = 16
+
+    def __init__(self, serializer=PickleSerializer()):
+        FramedSerializer.__init__(self)
+        assert isinstance(serializer, FramedSerializer), "serializer must be a FramedSerializer"
+        self.serializer = serializer
+        self.column_codec = get_codec('lz4:shuffle')
+
+    def dumps(self, obj):
+        frame = self._dump_columns(obj)
+        if frame is None:
+            frame = 'P' + lz4_compress(self.serializer.dumps(obj))
+        return frame
+
+    def loads(self, obj):
+        tag = obj[:1]
+        if tag == 'P':
+            return self.serializer.loads(lz4_decompress(buffer(obj, 1)))
+        assert tag == 'C', "Not a ColumnarSerializerLZ4 frame"
+        return self._load_columns(obj)
+
+    def _dump_columns(self, records):
+        """Return the columnar frame for a list of records, or None if
+        the records don't fit the columnar layout."""
+        if type(records) is not list or len(records) < self.MIN_COLUMNAR_RECORDS:
+            return None
+        if set(map(type, records)) != set([tuple]) or set(map(len, records)) != set([2]):
+            return None
+
+        keys, values = zip(*records)
+        key_arity, key_columns = _to_columns(keys)
+        if key_columns is None or any(c.dtype != np.int64 for c in key_columns):
+            return None
+        value_arity, value_columns = _to_columns(values)
+        if value_columns is None:
+            value_arity, value_columns = PICKLED, []
+
+        columns = key_columns + value_columns
+        block = np.empty((len(columns), len(records)), np.int64)
+        for row, column in zip(block, columns):
+            row.view(column.dtype)[:] = column
+        compressed_columns = self.column_codec.compress(block)
+
+        parts = [ 'C',
+                  struct.pack(self.HEADER_FORMAT, len(records), key_arity, value_arity),
+                  ''.join(c.dtype.kind for c in columns),
+                  struct.pack('<Q', len(compressed_columns)),
+                  compressed_columns ]
+        if value_arity == PICKLED:
+            parts.append( lz4_compress(self.serializer.dumps(list(values))) )
+        return ''.join(parts)
+
+    def _load_columns(self, frame):
+        pos = 1
+        num_records, key_arity, value_arity = struct.unpack_from(self.HEADER_FORMAT, frame, pos)
+        pos += struct.calcsize(self.HEADER_FORMAT)
+
+        num_key_columns = max(key_arity, 1)
+        num_columns = num_key_columns + (0 if value_arity == PICKLED else max(value_arity, 1))
+        kinds = frame[pos:pos+num_columns]
+        pos += num_columns
+
+        compressed_length, = struct.unpack_from('<Q', frame, pos)
+        pos += 8
+        block = np.empty((num_columns, num_records), np.int64)
+        self.column_codec.decompress_into(buffer(frame, pos, compressed_length), block)
+        pos += compressed_length
+
+        columns = [ row.view(np.float64 if kind == 'f' else np.int64).tolist()
+                    for row, kind in zip(block, kinds) ]
+
+        keys = _from_columns(key_arity, columns[:num_key_columns])
+        if value_arity == PICKLED:
+            values = self.serializer.loads(lz4_decompress(buffer(frame, pos)))
+        else:
+            values = _from_columns(value_arity, columns[num_key_columns:])
+        return zip(keys, values)
+
+    def __repr__(self):
+        return "ColumnarSerializerLZ4(%s)" % self.serializer
+
+def _to_columns(items):
+    """Split items (all numbers, or all tuples of numbers of the same length)
+    into int64/float64 columns.
+
+    Returns: (arity, columns), where arity is SCALAR for plain numbers,
+             or (arity, None) if the items don't fit.
+    """
+    if type(items[0]) is tuple:
+        arity = len(items[0])
+        if arity == 0 or set(map(type, items)) != set([tuple]) or set(map(len, items)) != set([arity]):
+            return arity, None
+        columns = map(_to_column, zip(*items))
+    else:
+        arity = SCALAR
+        columns = [_to_column(items)]
+
+    if any(c is None for c in columns):
+        return arity, None
+    return arity, columns
+
+def _to_column(items):
+    """Return items as an int64 or float64 array, or None if that
+    would change any item's value (or type, beyond int/float)."""
+    types = set(map(type, items))
+    if types <= _FLOAT_TYPES:
+        return np.fromiter(items, np.float64, len(items))
+    if not types <= _INT_TYPES:
+        return None
+    try:
+        column = np.fromiter(items, np.int64, len(items))
+    except OverflowError:
+        return None
+    if np.uint64 in types and column.min() < 0:
+        # Either some uint64 values were too large for int64, or there are
+        # negative values of another type.  Either way, can't tell them apart.
+        return None
+    return column
+
+def _from_columns(arity, columns):
+    if arity == SCALAR:
+        return columns[0]
+    return zip(*columns)
@@ -0,0 +1,65 @@
+"""Defines a lazily-decompressed label volume.
+
+DVID can send labelblk volumes lz4-compressed.  When libdvid fetches
+them, it decompresses them into a dense uint64 array, and as soon as
+that array is pickled (for persist() or a shuffle), CompressedNumpyArray
+lz4-compresses it again.  For the common case where a stage only
+passes the labels along before using them, both steps are wasted.
+
+CompressedLabelVolume keeps the lz4 payload received from DVID as-is
+and only decompresses it when deserialize() is called (or when it is
+converted with numpy.asarray()).  It pickles as its compressed payload.
+
+Workflow: DVID (lz4) => CompressedLabelVolume => RDD => deserialize()
+
+"""
+import struct
+import numpy as np
+import lz4
+
+class CompressedLabelVolume(object):
+    """ Holds an lz4-compressed label volume until its voxels are needed.
+
+    Note: Nothing is cached.  Each call to deserialize() decompresses
+          the payload again, so consumers should deserialize once and
+          keep the resulting array while they need it.
+
+    """
+
+    def __init__(self, lz4_payload, shape, dtype=np.uint64):
+        """Wraps a payload in python-lz4 format (with its 4-byte size header)."""
+        self.lz4_payload = lz4_payload
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+
+    @classmethod
+    def from_dvid_lz4(cls, raw_lz4, shape, dtype=np.uint64):
+        """Wraps the body of a DVID '?compression=lz4' response.
+
+        DVID sends a bare lz4 block.  python-lz4 expects the uncompressed
+        size as a little-endian uint32 header, which we know from the shape.
+        """
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        return cls(struct.pack('<I', nbytes) + raw_lz4, shape, dtype)
+
+    @classmethod
+    def from_array(cls, array):
+        """Compress a (C-order) array that is already in memory."""
+        array = np.ascontiguousarray(array)
+        return cls(lz4.dumps(np.getbuffer(array)), array.shape, array.dtype)
+
+    @property
+    def compressed_nbytes(self):
+        return len(self.lz4_payload)
+
+    def deserialize(self):
+        """Decompress and return the label volume as a new array."""
+        buf = lz4.loads(self.lz4_payload)
+        # Copy from the (read-only) string buffer so the result is writeable.
+        return np.frombuffer(buf, self.dtype).reshape(self.shape).copy()
+
+    def __array__(self, dtype=None):
+        array = self.deserialize()
+        if dtype is not None:
+            array = array.astype(dtype, copy=False)
+        return array
@@ -15,17 +15,284 @@ small runtime fraction of the original compression.
 
 Workflow: npy.array => CompressedNumpyArray => RDD (w/lz4 compression)
 
+Each slice is compressed with a codec, chosen by a spec string:
+
+    "lz4"                          lz4 (the default)
+    "lz4:shuffle"                  byte-shuffle, then lz4
+    "labels"                       per-block label palettes, then lz4
+                                   (3D integer arrays only; see labelblocks)
+    "raw"                          no compression
+    "zstd[:<level>]"               zstd (requires zstandard or zstd)
+    "blosc[:<cname>[:<shuffle>[:<level>]]]"
+                                   blosc (requires python-blosc), where
+                                   shuffle is noshuffle, shuffle, or
+                                   bitshuffle (default: blosc:lz4:shuffle:5)
+
+Shuffling groups the Nth byte of every element together, which helps
+a lot for float predictions and for labels whose high bytes are mostly 0.
+The labels codec compresses slabs of 32 slices (rather than single slices)
+as 32^3 blocks, and is the default for uint32 and uint64 arrays.  Arrays
+it doesn't support (e.g. 2D uint64 arrays) are compressed with lz4.
+The codec is stored with the compressed array, so an array can always
+be decompressed regardless of the current defaults.  (Arrays pickled
+before codecs existed have no codec attribute, and are read as lz4.)
+
+The codec used for new arrays can be chosen per dtype via
+set_default_codecs(), e.g.
+
+    set_default_codecs({ "default": "lz4", "float32": "blosc:lz4:shuffle" })
+
+In workflows, this is done with the "numpy-codecs" option, which is
+passed on to the executors via the DVIDSPARK_NUMPY_CODECS environment
+variable (see activate_compressed_numpy_pickling()).
+
 """
+import os
+import json
+import array
 import copy_reg
+import threading
+from functools import partial
+from multiprocessing.pool import ThreadPool
 import numpy as np
-import lz4
 import logging
+from DVIDSparkServices.util import bb_to_slicing
+from DVIDSparkServices.sparkdvid.labelblocks import encode_label_blocks, decode_label_blocks
+
+try:
+    # Newer python-lz4 releases the GIL while (de)compressing.
+    # (Same format as the old lz4.dumps/loads: a 4-byte size header, then an lz4 block.)
+    from lz4.block import compress as lz4_compress, decompress as lz4_decompress
+except ImportError:
+    from lz4 import dumps as lz4_compress, loads as lz4_decompress
+
+try:
+    import zstandard
+    _zstd = None
+except ImportError:
+    zstandard = None
+    try:
+        import zstd as _zstd
+    except ImportError:
+        _zstd = None
+
+try:
+    import blosc
+except ImportError:
+    blosc = None
+
+class _Codec(object):
+    """Compresses one C-contiguous subarray at a time: a single slice,
+    or a slab of slab_depth slices for codecs that compress 3D blocks.
+
+    Subclasses implement compress(subarray) and either decompress(data)
+    (returning the raw bytes) or decompress_into(data, out).
+    """
+    slab_depth = 1
+
+    @classmethod
+    def supports(cls, array):
+        return True
+
+    def decompress_into(self, data, out):
+        """Decompress into out, a (possibly non-contiguous) view of the result."""
+        out[...] = np.frombuffer(self.decompress(data), out.dtype).reshape(out.shape)
+
+class _RawCodec(_Codec):
+    def compress(self, subarray):
+        return np.getbuffer(subarray)[:]
+
+    def decompress(self, data):
+        return data
+
+class _Lz4Codec(_Codec):
+    def __init__(self, shuffle=False):
+        self.shuffle = shuffle
+
+    def compress(self, subarray):
+        if self.shuffle and subarray.dtype.itemsize > 1:
+            # Transpose to (byte, element) order
+            subarray = subarray.reshape(-1).view(np.uint8).reshape(-1, subarray.dtype.itemsize)
+            subarray = subarray.transpose().copy()
+        return lz4_compress( np.getbuffer(subarray) )
+
+    def decompress(self, data):
+        return lz4_decompress(data)
+
+    def decompress_into(self, data, out):
+        itemsize = out.dtype.itemsize
+        if not self.shuffle or itemsize == 1:
+            return _Codec.decompress_into(self, data, out)
+
+        shuffled = np.frombuffer(lz4_decompress(data), np.uint8).reshape(itemsize, -1)
+        if out.flags['C_CONTIGUOUS']:
+            # Unshuffle directly into the result
+            out.reshape(-1).view(np.uint8).reshape(-1, itemsize)[:] = shuffled.transpose()
+        else:
+            out[...] = shuffled.transpose().copy().view(out.dtype).reshape(out.shape)
+
+class _ZstdCodec(_Codec):
+    def __init__(self, level=3):
+        self.level = level
+
+    def compress(self, subarray):
+        if zstandard is not None:
+            return zstandard.ZstdCompressor(level=self.level).compress( np.getbuffer(subarray) )
+        return _zstd.compress( np.getbuffer(subarray), self.level )
+
+    def decompress(self, data):
+        if zstandard is not None:
+            return zstandard.ZstdDecompressor().decompress(data)
+        return _zstd.decompress(data)
+
+class _BloscCodec(_Codec):
+    def __init__(self, cname='lz4', shuffle='shuffle', level=5):
+        self.cname = cname
+        self.shuffle = { 'noshuffle': blosc.NOSHUFFLE,
+                         'shuffle': blosc.SHUFFLE,
+                         'bitshuffle': blosc.BITSHUFFLE }[shuffle]
+        self.level = level
+
+    def compress(self, subarray):
+        return blosc.compress( np.getbuffer(subarray), typesize=subarray.dtype.itemsize,
+                               clevel=self.level, shuffle=self.shuffle, cname=self.cname )
+
+    def decompress(self, data):
+        return blosc.decompress(data)
+
+    def decompress_into(self, data, out):
+        if not out.flags['C_CONTIGUOUS']:
+            return _Codec.decompress_into(self, data, out)
+        blosc.decompress_ptr(data, out.__array_interface__['data'][0])
+
+class _LabelCodec(_Codec):
+    slab_depth = 32
+
+    def compress(self, slab):
+        return lz4_compress( encode_label_blocks(slab, self.slab_depth) )
+
+    def decompress_into(self, data, out):
+        out[...] = decode_label_blocks( lz4_decompress(data), out.shape, out.dtype, self.slab_depth )
+
+    @classmethod
+    def supports(cls, array):
+        return array.ndim == 3 and array.dtype.kind in 'iu'
+
+_codecs = {}
+
+def get_codec(spec):
+    """Return the codec for the given spec string (see module docstring).
+
+    Raises ValueError if the spec is malformed, or if the codec's
+    module isn't installed.
+    """
+    try:
+        return _codecs[spec]
+    except KeyError:
+        pass
+
+    name = spec.split(':')[0]
+    args = spec.split(':')[1:]
+    try:
+        if name == 'raw' and not args:
+            codec = _RawCodec()
+        elif name == 'lz4' and args in ([], ['shuffle']):
+            codec = _Lz4Codec(shuffle=(args == ['shuffle']))
+        elif name == 'labels' and not args:
+            codec = _LabelCodec()
+        elif name == 'zstd' and len(args) <= 1:
+            if zstandard is None and _zstd is None:
+                raise ValueError("Codec '{}' requires the zstandard (or zstd) module".format(spec))
+            codec = _ZstdCodec(*map(int, args))
+        elif name == 'blosc' and len(args) <= 3:
+            if blosc is None:
+                raise ValueError("Codec '{}' requires the blosc module".format(spec))
+            if args and args[0] not in blosc.compressor_list():
+                raise ValueError("Codec '{}': blosc doesn't support {}".format(spec, args[0]))
+            codec = _BloscCodec(*(args[:2] + map(int, args[2:])))
+        else:
+            raise ValueError("Unknown numpy codec: '{}'".format(spec))
+    except (KeyError, TypeError):
+        raise ValueError("Unknown numpy codec: '{}'".format(spec))
+
+    _codecs[spec] = codec
+    return codec
+
+# Codec spec for newly compressed arrays, by dtype name (or 'default')
+_builtin_default_codecs = { 'default': 'lz4', 'uint32': 'labels', 'uint64': 'labels' }
+_default_codecs = dict(_builtin_default_codecs)
+
+def set_default_codecs(codecs):
+    """Choose the codecs used for newly compressed arrays in this process.
+
+    Args:
+        codecs (dict): { dtype name or 'default': codec spec },
+            e.g. { "default": "lz4", "float32": "lz4:shuffle" }.
+            Dtypes that aren't listed use the built-in default for
+            their dtype (labels for uint32 and uint64), or else the
+            'default' codec (lz4, if not given).
+    """
+    new_codecs = dict(_builtin_default_codecs)
+    for key, spec in codecs.items():
+        get_codec(str(spec)) # Check that it's usable
+        if key != 'default':
+            key = np.dtype(str(key)).name
+        new_codecs[key] = str(spec)
+
+    global _default_codecs
+    _default_codecs = new_codecs
+
+def default_codec(dtype):
+    """Return the codec spec used for new arrays of the given dtype."""
+    dtype = np.dtype(dtype)
+    return _default_codecs.get(dtype.name, _default_codecs['default'])
+
+# Threads for compressing/decompressing the subarrays of an array in parallel
+_compression_threads = 1
+_thread_pool = None
+_thread_pool_key = None # (pid, threads) the pool was created with
+_thread_pool_lock = threading.Lock()
+
+def set_compression_threads(num_threads):
+    """Compress/decompress the subarrays of each array with num_threads threads.
+
+    (lz4 releases the GIL in python-lz4 >= 0.8, as do zstd, blosc,
+    and most of the numpy work in the shuffle and labels codecs.)
+    """
+    global _compression_threads
+    _compression_threads = max(1, int(num_threads))
+
+def _map(func, items):
+    """map() that uses the compression threads, if there are several."""
+    if _compression_threads == 1 or len(items) <= 1:
+        return map(func, items)
+
+    global _thread_pool, _thread_pool_key
+    with _thread_pool_lock:
+        # Pools don't survive a fork (e.g. of a pyspark worker)
+        key = (os.getpid(), _compression_threads)
+        if _thread_pool_key != key:
+            if _thread_pool is not None and _thread_pool_key[0] == key[0]:
+                _thread_pool.close()
+            _thread_pool = ThreadPool(_compression_threads)
+            _thread_pool_key = key
+        pool = _thread_pool
+    return pool.map(func, items, chunksize=1)
 
 def activate_compressed_numpy_pickling():
     """
     Override the default pickle representation for numpy arrays.
     This affects all pickle behavior in the entire process.
+
+    The default codecs are taken from the DVIDSPARK_NUMPY_CODECS
+    environment variable (JSON, see set_default_codecs()), if given,
+    and the number of compression threads from DVIDSPARK_NUMPY_THREADS.
     """
+    if os.environ.get("DVIDSPARK_NUMPY_CODECS"):
+        set_default_codecs( json.loads(os.environ["DVIDSPARK_NUMPY_CODECS"]) )
+    if os.environ.get("DVIDSPARK_NUMPY_THREADS"):
+        set_compression_threads( int(os.environ["DVIDSPARK_NUMPY_THREADS"]) )
+
     copy_reg.pickle(np.ndarray, reduce_ndarray_compressed)
     
     # Handle subclasses, too.
@@ -46,15 +313,41 @@ class CompressedNumpyArray(object):
     Note: The lz4 is limited to INT_MAX size.  Since labelvolumes
     can be much smaller in compressed space, this function
     supports arbitrarily large numpy arrays.  They are serialized
-    as a list of LZ4 chunks where each chunk decompressed is 1GB.
+    as a list of LZ4 chunks where each chunk decompressed is at most 1GB.
+    (Slices larger than that are split into several chunks.)
+
+    The chunks are stored back-to-back in a single string (the frame),
+    with an index of their offsets.  They are compressed and decompressed
+    in parallel if set_compression_threads() was given more than one
+    thread, and are decompressed directly into the result array.
+
+    Besides deserialize(), a CompressedNumpyArray can be sliced with
+    ints and slices (e.g. compressed[10:20, :, 5]) or queried at a list
+    of points (values_at()), in which case only the chunks (typically
+    slices) that are needed are decompressed.  It also converts with
+    numpy.asarray().
 
     """
     MAX_LZ4_BUFFER_SIZE = 1000000000
+
+    # Arrays pickled before these attributes were added don't have them.
+    codec = 'lz4'
+    max_subarray_nbytes = MAX_LZ4_BUFFER_SIZE
    
-    def __init__(self, numpy_array):
-        """Serializes and compresses the numpy array with LZ4"""
-        
-        self.serialized_subarrays = []
+    def __init__(self, numpy_array, codec=None):
+        """Serializes and compresses the numpy array.
+
+        Args:
+            numpy_array: array to compress
+            codec (str): codec spec (see module docstring).  If None,
+                use the default for the array's dtype (see set_default_codecs()).
+        """
+        if codec is None:
+            codec = default_codec(numpy_array.dtype)
+        if not get_codec(codec).supports(numpy_array):
+            codec = 'lz4'
+        self.codec = codec
+        self.max_subarray_nbytes = self.MAX_LZ4_BUFFER_SIZE
         if numpy_array.flags['F_CONTIGUOUS']:
             self.layout = 'F'
         else:
@@ -66,43 +359,219 @@ class CompressedNumpyArray(object):
         self.dtype = numpy_array.dtype
         self.shape = numpy_array.shape
 
-        # For 1D or 0D arrays, serialize everything in one buffer.
-        if numpy_array.ndim <= 1:
-            self.serialized_subarrays.append( self.serialize_subarray(numpy_array) )
+        # For ND arrays, serialize each slice (or slab) independently, to ease RAM usage
+        subarrays = [ numpy_array[bb_to_slicing(*box) + (Ellipsis,)] for box in self._subarray_boxes() ]
+        self._set_frame( _map( partial(self.serialize_subarray, codec=codec), subarrays ) )
+
+    def _set_frame(self, serialized_subarrays):
+        self.frame = ''.join(serialized_subarrays)
+        self.offsets = array.array('l', [0])
+        for data in serialized_subarrays:
+            self.offsets.append( self.offsets[-1] + len(data) )
+
+    def __setstate__(self, state):
+        # Older pickles stored a list of strings instead of a frame.
+        serialized_subarrays = state.pop('serialized_subarrays', None)
+        self.__dict__.update(state)
+        if serialized_subarrays is not None:
+            self._set_frame(serialized_subarrays)
+
+    @property
+    def serialized_subarrays(self):
+        """The compressed subarrays (read-only buffers into the frame)."""
+        return [ buffer(self.frame, start, stop - start)
+                 for start, stop in zip(self.offsets[:-1], self.offsets[1:]) ]
+
+    @property
+    def compressed_nbytes(self):
+        return len(self.frame)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def _subarray_boxes(self):
+        """Return the (start, stop) boxes of the subarrays that are compressed
+        separately, in the stored (C-order) layout.
+
+        0D and 1D arrays are kept whole, and ND arrays are split into slabs
+        of slab_depth slices.  Any of those larger than max_subarray_nbytes
+        are split further, along their first axis that can be split.
+        """
+        shape = self.shape
+        slab_depth = get_codec(self.codec).slab_depth
+        if len(shape) <= 1:
+            slabs = [ ((0,) * len(shape), shape) ]
         else:
-            # For ND arrays, serialize each slice independently, to ease RAM usage
-            for subarray in numpy_array:
-                self.serialized_subarrays.append( self.serialize_subarray(subarray) )
+            slabs = [ ((z,) + (0,) * (len(shape) - 1), (min(z + slab_depth, shape[0]),) + shape[1:])
+                      for z in range(0, shape[0], slab_depth) ]
+
+        boxes = []
+        for slab in slabs:
+            boxes += self._split_box(slab, self.dtype.itemsize, self.max_subarray_nbytes)
+        return boxes
+
+    @classmethod
+    def _split_box(cls, box, itemsize, max_nbytes):
+        start, stop = box
+        box_shape = [b - a for (a, b) in zip(start, stop)]
+        nbytes = int(np.prod(box_shape)) * itemsize
+        if nbytes <= max_nbytes or nbytes <= itemsize:
+            return [box]
+
+        axis = [n > 1 for n in box_shape].index(True)
+        step = max(1, box_shape[axis] * max_nbytes // nbytes)
+        boxes = []
+        for a in range(start[axis], stop[axis], step):
+            sub_start = start[:axis] + (a,) + start[axis+1:]
+            sub_stop = stop[:axis] + (min(a + step, stop[axis]),) + stop[axis+1:]
+            boxes += cls._split_box((sub_start, sub_stop), itemsize, max_nbytes)
+        return boxes
 
     @classmethod
-    def serialize_subarray(cls, subarray):
+    def serialize_subarray(cls, subarray, codec='lz4'):
         if not subarray.flags['C_CONTIGUOUS']:
             subarray = subarray.copy(order='C')
-
-        # Buffers larger than 1 GB would overflow
-        # We could fix this by slicing each slice into smaller pieces...
-        assert subarray.nbytes <= cls.MAX_LZ4_BUFFER_SIZE, \
-            "FIXME: This class doesn't support arrays whose slices are each > 1 GB"
-        
-        return lz4.dumps( np.getbuffer(subarray) )
+        return get_codec(codec).compress(subarray)
         
     def deserialize(self):
         """Extract the numpy array"""
         numpy_array = np.ndarray( shape=self.shape, dtype=self.dtype )
-        
-        # See serialization of 1D and 0D arrays, above.
-        if numpy_array.ndim <= 1:
-            buf = lz4.loads(self.serialized_subarrays[0])
-            numpy_array[:] = np.frombuffer(buf, self.dtype).reshape( numpy_array.shape )
-        else:
-            for subarray, serialized_subarray in zip(numpy_array, self.serialized_subarrays):
-                buf = lz4.loads(serialized_subarray)
-                subarray[:] = np.frombuffer(buf, self.dtype).reshape( subarray.shape )
+        self._decompress_region( numpy_array, (0,) * self.ndim )
          
         if self.layout == 'F':
             numpy_array = numpy_array.transpose()
 
         return numpy_array
+
+    def __array__(self, dtype=None):
+        numpy_array = self.deserialize()
+        if dtype is not None:
+            numpy_array = numpy_array.astype(dtype, copy=False)
+        return numpy_array
+
+    def __getitem__(self, index):
+        """Return numpy_array[index], decompressing only the subarrays it touches.
+
+        Supports ints, slices, and Ellipsis.  Other indexes (e.g. index
+        arrays or None) fall back to decompressing the whole array.
+        """
+        normalized_index = self._normalize_index(index)
+        if normalized_index is None:
+            return self.deserialize()[index]
+        index = normalized_index
+
+        if self.layout == 'F':
+            index = index[::-1]
+
+        region_start = []
+        region_stop = []
+        region_index = []
+        for i, n in zip(index, self.shape):
+            if isinstance(i, slice):
+                start, stop, step = i.indices(n)
+                positions = range(start, stop, step)
+                if not positions:
+                    region_start.append(0)
+                    region_stop.append(0)
+                    region_index.append(slice(0, 0))
+                    continue
+                lo = min(positions)
+                local_stop = positions[-1] - lo + (1 if step > 0 else -1)
+                region_start.append(lo)
+                region_stop.append(max(positions) + 1)
+                region_index.append(slice(positions[0] - lo, (local_stop if local_stop >= 0 else None), step))
+            else:
+                region_start.append(i)
+                region_stop.append(i + 1)
+                region_index.append(0)
+
+        region_shape = [b - a for (a, b) in zip(region_start, region_stop)]
+        region = np.ndarray( shape=region_shape, dtype=self.dtype )
+        self._decompress_region( region, tuple(region_start) )
+        result = region[tuple(region_index) + (Ellipsis,)]
+
+        if self.layout == 'F':
+            result = result.transpose()
+        return result
+
+    def values_at(self, coords):
+        """Return the values at the given points, decompressing only the
+        subarrays that contain them.
+
+        Args:
+            coords: (N, ndim) array of (in-bounds) coordinates
+        """
+        coords = np.asarray(coords, dtype=np.int64).reshape(-1, self.ndim)
+        if self.layout == 'F':
+            coords = coords[:, ::-1]
+        assert ((coords >= 0) & (coords < self.shape)).all(), "Coordinates out of bounds"
+
+        values = np.zeros(len(coords), dtype=self.dtype)
+        codec = get_codec(self.codec)
+        boxes = self._subarray_boxes()
+        def decompress_points(i):
+            start, stop = boxes[i]
+            inside = ((coords >= start) & (coords < stop)).all(axis=1)
+            if inside.any():
+                subarray = np.ndarray( shape=np.subtract(stop, start), dtype=self.dtype )
+                codec.decompress_into(self.serialized_subarrays[i], subarray)
+                values[inside] = subarray[tuple((coords[inside] - start).transpose())]
+        _map( decompress_points, range(len(boxes)) )
+        return values
+
+    def _normalize_index(self, index):
+        """Expand index to one int or slice per (original) axis, or return None if unsupported."""
+        if not isinstance(index, tuple):
+            index = (index,)
+        ellipses = [k for k, i in enumerate(index) if i is Ellipsis]
+        if len(ellipses) > 1:
+            return None
+        if ellipses:
+            e = ellipses[0]
+            index = index[:e] + (slice(None),) * (self.ndim - len(index) + 1) + index[e+1:]
+        if len(index) > self.ndim:
+            return None
+        index += (slice(None),) * (self.ndim - len(index))
+
+        shape = self.shape if self.layout == 'C' else self.shape[::-1]
+        normalized = []
+        for i, n in zip(index, shape):
+            if isinstance(i, slice):
+                normalized.append(i)
+            elif isinstance(i, (int, long, np.integer)):
+                if not -n <= i < n:
+                    raise IndexError("index {} is out of bounds for axis with size {}".format(i, n))
+                normalized.append(int(i) % n)
+            else:
+                return None
+        return tuple(normalized)
+
+    def _decompress_region(self, region, region_start):
+        """Decompress the part of the (stored layout) array that lies
+        within region, whose first element is at region_start."""
+        codec = get_codec(self.codec)
+        region_stop = tuple(np.add(region_start, region.shape))
+
+        def decompress_subarray(box_and_data):
+            (start, stop), data = box_and_data
+            overlap_start = np.maximum(start, region_start)
+            overlap_stop = np.minimum(stop, region_stop)
+            if (overlap_start >= overlap_stop).any():
+                return
+            if (overlap_start == start).all() and (overlap_stop == stop).all():
+                # Decompress straight into the region
+                codec.decompress_into(data, region[bb_to_slicing(np.subtract(start, region_start),
+                                                                 np.subtract(stop, region_start)) + (Ellipsis,)])
+            else:
+                subarray = np.ndarray( shape=np.subtract(stop, start), dtype=self.dtype )
+                codec.decompress_into(data, subarray)
+                region[bb_to_slicing(overlap_start - region_start, overlap_stop - region_start)] = \
+                    subarray[bb_to_slicing(overlap_start - start, overlap_stop - start)]
+
+        boxes = self._subarray_boxes()
+        assert len(boxes) == len(self.offsets) - 1
+        _map( decompress_subarray, zip(boxes, self.serialized_subarrays) )
     
 def reduce_ndarray_compressed(a):
     """
@@ -118,6 +587,9 @@ def reduce_ndarray_compressed(a):
     logger = logging.getLogger(__name__)
     logger.debug("Pickling compressed numpy array: type={}, dtype={}, shape={}".format(str(type(a)), str(a.dtype), a.shape))
     assert isinstance(a, np.ndarray)
+    if a.dtype.hasobject:
+        # The buffer of an object array holds pointers, not data.
+        return a.__reduce__()
     if type(a) == np.ndarray:
         view_type = None
     else:
@@ -0,0 +1,155 @@
+"""Defines a process-wide pool of reusable DVID node service objects.
+
+Constructing a libdvid DVIDNodeService is not free: it opens a new
+connection and queries DVID for the node's metadata.  The sparkdvid
+mappers used to construct a fresh one for every subvolume (and for
+every retry), which adds up over tens of thousands of subvolumes.
+
+The pool keeps a free list of services per (server, uuid, resource_server,
+resource_port, appname) key.  A service is only ever used by one thread at
+a time (libdvid connections are not thread-safe), but it can be reused by
+later threads, e.g. the short-lived prefetch threads of each partition:
+
+  - checkout() takes a service from the free list for the duration of a
+    'with' block, and returns it afterwards.
+  - get() (for callers that never give the service back) assigns a service
+    to the calling thread, and reclaims it once the thread has exited.
+
+Services are never shared between processes (the pyspark daemon forks its
+workers, and an inherited connection must not be reused).  Entries older
+than max_age are rebuilt, and a service whose request failed is discarded.
+
+"""
+import os
+import time
+import threading
+import logging
+from contextlib import contextmanager
+
+class NodeServicePool(object):
+    """Caches node service objects created by the given factory.
+
+    The factory is called as factory(*key) whenever a key is requested
+    and no healthy service for it is available.
+
+    """
+
+    def __init__(self, factory, max_age=600.0):
+        """Initialize pool.
+
+        Args:
+            factory (callable): creates a new service from the key items
+            max_age (float): seconds before an entry is considered stale
+                and rebuilt (None to keep entries forever)
+
+        """
+        self.factory = factory
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._free = {}  # key -> [(service, created), ...] (not in use)
+        self._owned = {} # (key, thread ident) -> (service, created), see get()
+        self._counters = { "hits": 0, "misses": 0, "evictions": 0, "expirations": 0 }
+
+    def get(self, key):
+        """Return a healthy service for key, reserved for the calling thread."""
+        owner_key = (key, threading.current_thread().ident)
+        with self._lock:
+            self._check_pid()
+            entry = self._owned.pop(owner_key, None)
+            if entry is None:
+                self._reclaim_dead_threads()
+            elif self._is_fresh(entry):
+                self._counters["hits"] += 1
+                self._owned[owner_key] = entry
+                return entry[0]
+            else:
+                self._counters["expirations"] += 1
+
+        entry = self._acquire(key)
+        with self._lock:
+            self._owned[owner_key] = entry
+        return entry[0]
+
+    def evict(self, key):
+        """Discard the calling thread's service for key (e.g. after a failed request)."""
+        owner_key = (key, threading.current_thread().ident)
+        with self._lock:
+            if self._owned.pop(owner_key, None) is not None:
+                self._counters["evictions"] += 1
+
+    @contextmanager
+    def checkout(self, key):
+        """Context manager yielding a service for key, for exclusive use
+        within the 'with' block.
+
+        If the body raises, the service is discarded so that the next
+        attempt (e.g. via auto_retry) starts with a fresh connection.
+        Otherwise, it is returned to the free list.
+        """
+        entry = self._acquire(key)
+        try:
+            yield entry[0]
+        except:
+            logging.getLogger(__name__).warn("Evicting node service for {} after error".format(key))
+            with self._lock:
+                self._counters["evictions"] += 1
+            raise
+        else:
+            self._release(key, entry)
+
+    def clear(self):
+        """Discard all idle and thread-owned entries (counters are kept)."""
+        with self._lock:
+            self._free.clear()
+            self._owned.clear()
+
+    def stats(self):
+        """Return a dict of hit/miss/eviction counters and the current pool size
+        (idle and thread-owned services, not counting checked-out ones)."""
+        with self._lock:
+            stats = dict(self._counters)
+            stats["size"] = len(self._owned) + sum(len(entries) for entries in self._free.values())
+            return stats
+
+    def _acquire(self, key):
+        # Take a fresh entry from the free list, or create one.
+        with self._lock:
+            self._check_pid()
+            free_entries = self._free.get(key, [])
+            while free_entries:
+                entry = free_entries.pop()
+                if self._is_fresh(entry):
+                    self._counters["hits"] += 1
+                    return entry
+                self._counters["expirations"] += 1
+            self._counters["misses"] += 1
+
+        # Construct outside the lock; this involves a round-trip to DVID.
+        return (self.factory(*key), time.time())
+
+    def _release(self, key, entry):
+        with self._lock:
+            if self._pid == os.getpid() and self._is_fresh(entry):
+                self._free.setdefault(key, []).append(entry)
+
+    def _is_fresh(self, entry):
+        return self.max_age is None or time.time() - entry[1] < self.max_age
+
+    def _reclaim_dead_threads(self):
+        # Return services owned by threads that have exited to the free list.
+        # (Must be called with the lock held.)
+        live_threads = set( t.ident for t in threading.enumerate() )
+        for owner_key in self._owned.keys():
+            key, ident = owner_key
+            if ident not in live_threads:
+                self._free.setdefault(key, []).append( self._owned.pop(owner_key) )
+
+    def _check_pid(self):
+        # Connections inherited across fork() must not be reused.
+        # (Must be called with the lock held.)
+        pid = os.getpid()
+        if pid != self._pid:
+            self._free.clear()
+            self._owned.clear()
+            self._pid = pid
@@ -0,0 +1,181 @@
+"""Defines a Spark serializer that sends numpy arrays out of band.
+
+With the default PickleSerializer, every numpy array in an RDD record
+is reduced to a CompressedNumpyArray (see activate_compressed_numpy_pickling),
+whose compressed buffer is then copied into the pickle string, and the
+pickle string is copied again when pyspark writes it to the JVM.
+
+NumpyFramedSerializer pickles each record with a persistent_id hook
+that pulls plain numpy arrays out of the pickle.  Their buffers are
+written after the (small) pickle, as-is:
+
+    frame := magic (4 bytes) | pickle length (uint64, little-endian)
+             | pickle | array buffers
+
+Each array is referenced from the pickle by its offset and length within
+the buffer section, plus its dtype, shape, and memory layout.  Arrays are
+either written raw (C- or F-contiguous arrays are written without any
+copy), or as the frame of a CompressedNumpyArray (compress=True), which
+uses the default codec for the array's dtype.
+
+When reading, frames are read into a bytearray, so raw arrays are
+returned as (writeable) views of it via np.frombuffer, with no copy.
+Compressed arrays are decompressed directly into their result array.
+
+Arrays with dtype=object and ndarray subclasses are pickled as usual.
+
+Workflow: RDD record => pickle + out-of-band array buffers => JVM
+
+"""
+import struct
+import array
+import cPickle
+from cStringIO import StringIO
+import numpy as np
+from pyspark.serializers import FramedSerializer, SpecialLengths, read_int, write_int
+from DVIDSparkServices.sparkdvid.CompressedNumpyArray import CompressedNumpyArray
+
+class NumpyFramedSerializer(FramedSerializer):
+    """ Pickle records, but write numpy array buffers out of band.
+
+        Note: Like all FramedSerializers, frames can't be larger than 2GB.
+
+    """
+    MAGIC = 'DVNP'
+    HEADER_FORMAT = '<4sQ'
+
+    def __init__(self, compress=False):
+        """Initialize serializer.
+
+        Args:
+            compress (bool): compress arrays with CompressedNumpyArray
+                (otherwise, array buffers are written raw)
+
+        """
+        FramedSerializer.__init__(self)
+        self.compress = compress
+
+    def dumps(self, obj):
+        f = StringIO()
+        for part in self._dump_parts(obj):
+            f.write(part)
+        return f.getvalue()
+
+    def loads(self, obj):
+        return self._load_frame(obj)
+
+    def _write_with_length(self, obj, stream):
+        # Write the parts one at a time, rather than joining them first.
+        parts = self._dump_parts(obj)
+        length = sum( len(part) for part in parts )
+        if length > (1 << 31):
+            raise ValueError("can not serialize object larger than 2G")
+        write_int(length, stream)
+        for part in parts:
+            stream.write(part)
+
+    def _read_with_length(self, stream):
+        length = read_int(stream)
+        if length == SpecialLengths.END_OF_DATA_SECTION:
+            raise EOFError
+        elif length == SpecialLengths.NULL:
+            return None
+
+        # Read into a bytearray so that arrays can be writeable views of it.
+        frame = bytearray(length)
+        if hasattr(stream, 'readinto'):
+            nread = stream.readinto(frame)
+        else:
+            data = stream.read(length)
+            nread = len(data)
+            frame[:nread] = data
+        if nread < length:
+            raise EOFError
+        return self._load_frame(frame)
+
+    def _dump_parts(self, obj):
+        """Return the frame for obj, as a list of strings/buffers."""
+        buffers = []
+        buffers_nbytes = [0]
+        pids = {} # id(array) -> pid, so shared arrays are written once
+
+        def persistent_id(o):
+            if type(o) is not np.ndarray or o.dtype.hasobject:
+                return None
+            if id(o) in pids:
+                return pids[id(o)]
+            pid = self._dump_array(o, buffers, buffers_nbytes)
+            pids[id(o)] = pid
+            return pid
+
+        f = StringIO()
+        pickler = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = persistent_id
+        pickler.dump(obj)
+        pickled = f.getvalue()
+
+        return [ struct.pack(self.HEADER_FORMAT, self.MAGIC, len(pickled)), pickled ] + buffers
+
+    def _dump_array(self, o, buffers, buffers_nbytes):
+        if self.compress:
+            compressed = CompressedNumpyArray(o)
+            buf = compressed.frame
+            info = ( 'compressed', compressed.dtype.str, compressed.shape, compressed.layout,
+                     compressed.codec, compressed.max_subarray_nbytes, compressed.offsets.tostring() )
+        else:
+            if o.flags['C_CONTIGUOUS']:
+                layout = 'C'
+            elif o.flags['F_CONTIGUOUS']:
+                layout = 'F'
+            else:
+                o = np.ascontiguousarray(o)
+                layout = 'C'
+            buf = np.getbuffer(o.transpose() if layout == 'F' else o)
+            info = ( 'raw', o.dtype.str, o.shape, layout )
+
+        pid = (buffers_nbytes[0], len(buf)) + info
+        buffers.append(buf)
+        buffers_nbytes[0] += len(buf)
+        return pid
+
+    def _load_frame(self, frame):
+        header_size = struct.calcsize(self.HEADER_FORMAT)
+        magic, pickle_length = struct.unpack_from(self.HEADER_FORMAT, frame)
+        assert magic == self.MAGIC, "Not a NumpyFramedSerializer frame"
+        buffers_start = header_size + pickle_length
+
+        arrays = {} # offset -> array, for arrays that appear more than once
+
+        def persistent_load(pid):
+            if pid[0] not in arrays:
+                arrays[pid[0]] = load_array(pid)
+            return arrays[pid[0]]
+
+        def load_array(pid):
+            offset, nbytes, kind, dtype, shape = pid[:5]
+            start = buffers_start + offset
+            if kind == 'compressed':
+                layout, codec, max_subarray_nbytes, offsets = pid[5:]
+                compressed = CompressedNumpyArray.__new__(CompressedNumpyArray)
+                compressed.__dict__.update( dtype=np.dtype(dtype), shape=shape, layout=layout, codec=codec,
+                                            max_subarray_nbytes=max_subarray_nbytes,
+                                            frame=buffer(frame, start, nbytes),
+                                            offsets=array.array('l', offsets) )
+                return compressed.deserialize()
+
+            layout, = pid[5:]
+            stored_shape = shape[::-1] if layout == 'F' else shape
+            a = np.frombuffer(frame, dtype, nbytes // np.dtype(dtype).itemsize, start).reshape(stored_shape)
+            if not isinstance(frame, bytearray):
+                # Don't return read-only views of a string
+                a = a.copy()
+            if layout == 'F':
+                a = a.transpose()
+            return a
+
+        unpickler = cPickle.Unpickler( StringIO(buffer(frame, header_size, pickle_length)) )
+        unpickler.persistent_load = persistent_load
+        return unpickler.load()
+
+    def __repr__(self):
+        return "NumpyFramedSerializer(compress=%s)" % self.compress
@@ -6,6 +6,7 @@ different transformations in sparkdvid.
 
 """
 
+import array
 import collections
 import numpy as np
 
@@ -13,6 +14,49 @@ import numpy as np
 SubvolumeNamedTuple = collections.namedtuple('SubvolumeNamedTuple',
             'z1 y1 x1 z2 y2 x2')
 
+def _window_masks(roi_map, window_starts, window_shape, group_width=64, batch_size=10000):
+    """Helper for Subvolume.create_batch():
+    Extract the ROI mask for many equally-sized windows.
+    
+    The windows are processed in spatial groups (by window start, on a grid of
+    group_width blocks), so only the (dense) mask of each group's bounding box
+    is extracted from the (sparse) roi_map at any time.
+
+    Args:
+        roi_map: util.RoiMap
+        window_starts: array (N,3) of window starts (block coords)
+        window_shape: (w_z, w_y, w_x)
+    
+    Returns:
+        Generator of (indexes, windows), where windows is a bool array (n, w_z, w_y, w_x)
+        for the windows at the given indexes of window_starts, or None if they're all empty.
+    """
+    from DVIDSparkServices.util import _group_bounds
+    window_shape = np.asarray(window_shape)
+    if len(window_starts) == 0:
+        return
+
+    group_keys = window_starts // group_width
+    order = np.lexsort(group_keys.transpose()[::-1])
+    for group_start, group_stop in _group_bounds(group_keys[order]):
+        group_indexes = order[group_start:group_stop]
+        group_starts = window_starts[group_indexes]
+        region_start = group_starts.min(axis=0)
+        region = roi_map.get_mask(region_start, group_starts.max(axis=0) + window_shape)
+        if not region.any():
+            yield group_indexes, None
+            continue
+
+        window_offsets = group_starts - region_start
+        for batch_start in range(0, len(group_indexes), batch_size):
+            batch_offsets = window_offsets[batch_start:batch_start+batch_size]
+
+            # Copy each window into one (n, w_z, w_y, w_x) array, via (broadcasted) fancy indexing.
+            z_index = batch_offsets[:, 0, None, None, None] + np.arange(window_shape[0])[None, :, None, None]
+            y_index = batch_offsets[:, 1, None, None, None] + np.arange(window_shape[1])[None, None, :, None]
+            x_index = batch_offsets[:, 2, None, None, None] + np.arange(window_shape[2])[None, None, None, :]
+            yield group_indexes[batch_start:batch_start+batch_size], region[z_index, y_index, x_index]
+
 class Subvolume(object):
     """Define subvolume datatype.
 
@@ -20,94 +64,282 @@ class Subvolume(object):
     and has other information like neighboring substacks
     (if this infor is computed).  It has several functions for
     helping to determine overlap between substacks.
+
+    Subvolumes are pickled into many task closures and collected
+    to the driver, so they're kept small: the ROI blocks they
+    intersect are stored as a packed bitmask (at block resolution)
+    over the subvolume's bounding box (including border), and their
+    neighbors as a flat array of (sv_index, box) integers.
+    The intersecting_blocks and local_regions members are computed
+    from those on demand.
     
     """
 
+    __slots__ = ('sv_index', 'box', 'border_zyx', 'is_interior', '_block_bits', '_neighbors')
+
+    # ROI stored in DVID is always in 32x32x32 blocks for now
+    roi_blocksize = 32
+
     def __init__(self, sv_index, box_start_zyx, chunk_size, border, roi_map):
         """Initializes subvolume.
 
         Args:
             sv_index (int): identifier key for subvolume (must be unique)
             box_start_zyx: (z,y,x)
-            chunk_size (int): dimension of subvolume (assume isotropic)
-            border (int): border size surrounding core subvolume    
+            chunk_size: dimension of subvolume, either an int (isotropic)
+                or a (z,y,x) shape
+            border: border size surrounding core subvolume,
+                either an int or per-axis (z,y,x)
             roi_map (util.RoiMap): RoiMap for the roi this Subvolume belongs to.
+                (If None, the ROI block members are left empty, to be filled
+                in by the caller.  See create_batch().)
         """
+        from DVIDSparkServices.util import zyx_tuple
         self.sv_index = sv_index
         
-        box_stop_zyx = np.array(box_start_zyx) + chunk_size
+        box_stop_zyx = np.array(box_start_zyx) + zyx_tuple(chunk_size)
         box = np.array( (box_start_zyx, box_stop_zyx) )
-        self.box = SubvolumeNamedTuple(*box.flat)
-        self.border = border
-        self.local_regions = []
+        self.box = SubvolumeNamedTuple(*map(int, box.flat))
+        self.border_zyx = zyx_tuple(border)
 
-        # ROI stored in DVID is always in 32x32x32 blocks for now
-        self.roi_blocksize = 32
+        # Neighbors, as [sv_index, z1, y1, x1, z2, y2, x2, sv_index, z1, ...]
+        # (see local_regions)
+        self._neighbors = array.array('l')
 
-        # index off of (z,y,x) block indices
-        # TODO: Instead of listing block coordinates, it would be ~24x
-        #       more RAM-efficient to maintain a bool array of the ROI mask
-        #       (at block resolution)
-        self.intersecting_blocks = []
-        self.intersecting_blocks_noborder = []
+        # Packed bitmask of the ROI blocks within block_window (or None, for no blocks)
+        # (see intersecting_block_mask)
+        self._block_bits = None
 
         # If this subvolume (including border) is *completely* 
         # covered by the ROI, it's considered 'interior'
         self.is_interior = False
         
-        # Initialize each subvolume's 'intersecting_blocks' member for the ROI blocks it contains.
-        self._init_intersecting_blocks(roi_map)
+        # Initialize each subvolume's block mask for the ROI blocks it contains.
+        if roi_map is not None:
+            self._init_intersecting_blocks(roi_map)
+
+    @classmethod
+    def create_batch(cls, box_starts_zyx, chunk_size, border, roi_map):
+        """Create many Subvolumes at once.
+
+        Equivalent to [Subvolume(None, start, chunk_size, border, roi_map) for start in box_starts_zyx],
+        but if the subvolumes are aligned to the block grid in the same way
+        (e.g. as returned by get_roi_partition()), their ROI blocks are
+        extracted in a few vectorized passes, rather than one pass per subvolume.
+        """
+        from DVIDSparkServices.util import zyx_tuple
+        box_starts = np.asarray(box_starts_zyx, dtype=np.int64).reshape((-1,3))
+        subvolumes = [ cls(None, start, chunk_size, border, None) for start in box_starts ]
+        if len(subvolumes) == 0:
+            return subvolumes
+
+        chunk_size = np.array(zyx_tuple(chunk_size))
+        border = np.array(zyx_tuple(border))
+
+        blocksize = cls.roi_blocksize
+        starts_px = box_starts - border
+        stops_px = box_starts + chunk_size + border
+
+        # Window of ROI blocks for each subvolume (with border)
+        window_starts = starts_px // blocksize
+        window_stops = (stops_px + blocksize - 1) // blocksize
+
+        # The windows must all have the same shape
+        # (i.e. the subvolumes must be aligned to the block grid in the same way)
+        window_shape = window_stops[0] - window_starts[0]
+        if not (window_stops - window_starts == window_shape).all():
+            for sv in subvolumes:
+                sv._init_intersecting_blocks(roi_map)
+            return subvolumes
+
+        # See _init_intersecting_blocks()
+        full_subvol_size_blocks = np.prod(window_shape)
+
+        for indexes, windows in _window_masks(roi_map, window_starts, window_shape):
+            if windows is None:
+                continue # No ROI blocks (as initialized)
+            windows = windows.reshape((len(windows), -1))
+            counts = windows.sum(axis=1)
+            bits = np.packbits(windows, axis=1)
+            for i, sv_index in enumerate(indexes):
+                sv = subvolumes[sv_index]
+                sv._block_bits = bits[i].copy() if counts[i] else None
+                sv.is_interior = bool( counts[i] == full_subvol_size_blocks )
+        return subvolumes
+
+    @classmethod
+    def record_all_borders(cls, subvolumes):
+        """Record the neighbors of all the given (equally sized) subvolumes.
+
+        Equivalent to calling subvolumes[i].recordborder(subvolumes[j])
+        for all i < j, but only nearby pairs are compared, via a hash
+        of each subvolume's position on a grid of chunk-sized cells.
+        """
+        if len(subvolumes) == 0:
+            return
+        chunk_shape = np.array(subvolumes[0].box[3:6]) - subvolumes[0].box[0:3]
+        assert all( (np.array(sv.box[3:6]) - sv.box[0:3] == chunk_shape).all() for sv in subvolumes ), \
+            "record_all_borders() requires subvolumes of equal size"
+
+        cells = {}
+        cell_keys = []
+        for i, sv in enumerate(subvolumes):
+            key = tuple( np.array(sv.box[0:3]) // chunk_shape )
+            cells.setdefault(key, []).append(i)
+            cell_keys.append(key)
+
+        # Subvolumes that touch or overlap each other
+        # start within one cell of each other (in every dimension)
+        pairs = []
+        for i, (z, y, x) in enumerate(cell_keys):
+            for dz in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    for dx in (-1, 0, 1):
+                        for j in cells.get( (z+dz, y+dy, x+dx), () ):
+                            if i < j:
+                                pairs.append( (i, j) )
+
+        # Same order as the nested loop, so local_regions are listed in the same order.
+        for i, j in sorted(pairs):
+            subvolumes[i].recordborder(subvolumes[j])
+
+    @property
+    def block_window(self):
+        """
+        Read-only property.
+        (start, stop) block coordinates of the blocks that box_with_border touches.
+        """
+        start_px = np.array(self.box_with_border[0:3])
+        stop_px = np.array(self.box_with_border[3:6])
+        return ( start_px // self.roi_blocksize,
+                 (stop_px + self.roi_blocksize - 1) // self.roi_blocksize )
+
+    @property
+    def intersecting_block_mask(self):
+        """
+        Read-only property.
+        Bool mask of the ROI blocks this subvolume (including border) intersects,
+        covering block_window.
+        """
+        start, stop = self.block_window
+        shape = tuple(stop - start)
+        if self._block_bits is None:
+            return np.zeros(shape, dtype=bool)
+        bits = np.unpackbits(self._block_bits)[:np.prod(shape)]
+        return bits.view(bool).reshape(shape)
+
+    @property
+    def intersecting_blocks(self):
+        """
+        Read-only property.
+        Array of the ROI block coords [[Z,Y,X], ...] this subvolume (including border) intersects.
+        """
+        start, _stop = self.block_window
+        return self._mask_coords(self.intersecting_block_mask, start)
+
+    @property
+    def intersecting_blocks_noborder(self):
+        """
+        Read-only property.
+        Same as intersecting_blocks, but for the subvolume's box without the border.
+        """
+        window_start, _stop = self.block_window
+        core_start = np.array(self.box[0:3]) // self.roi_blocksize
+        core_stop = (np.array(self.box[3:6]) + self.roi_blocksize - 1) // self.roi_blocksize
+        core_offset = core_start - window_start
+        core_mask = self.intersecting_block_mask[ tuple( slice(a, b) for a, b in zip(core_offset, core_offset + core_stop - core_start) ) ]
+        return self._mask_coords(core_mask, core_start)
+
+    @classmethod
+    def _mask_coords(cls, mask, mask_start):
+        coords = np.transpose( mask.nonzero() ).astype(np.int64)
+        coords += mask_start
+        return coords
 
     def _init_intersecting_blocks(self, roi_map):
-        # Subvol bounding-box in pixels
-        subvol_start_px = np.array(self.box_with_border[0:3])
-        subvol_stop_px  = np.array(self.box_with_border[3:6])
+        window_start, window_stop = self.block_window
 
-        # How many blocks fit in this subvolume (regardless of ROI)?
-        full_subvol_size_blocks = np.prod( (subvol_stop_px - subvol_start_px) // self.roi_blocksize )
+        # How many blocks does this subvolume touch (regardless of ROI)?
+        full_subvol_size_blocks = np.prod(window_stop - window_start)
 
-        subvol_block_coords = self.roi_coords_for_box(roi_map, subvol_start_px, subvol_stop_px)
+        window_mask = self._roi_window_mask(roi_map, window_start, window_stop)
+        num_blocks = window_mask.sum()
 
         # Save
-        self.intersecting_blocks = subvol_block_coords
+        self._block_bits = np.packbits(window_mask.reshape(-1)) if num_blocks else None
         
         # We're "interior" if all blocks are present in the ROI
-        self.is_interior = ( len(subvol_block_coords) == full_subvol_size_blocks )
+        self.is_interior = bool( num_blocks == full_subvol_size_blocks )
 
-        # Find intersecting blocks without border
-        self.intersecting_blocks_noborder = self.roi_coords_for_box( roi_map,
-                                                                     np.array(self.box[0:3]),
-                                                                     np.array(self.box[3:6]) )
-        
-    def roi_coords_for_box(self, roi_map, subvol_start_px, subvol_stop_px):
-        from DVIDSparkServices.util import bb_to_slicing, RoiMap
+    @classmethod
+    def _roi_window_mask(cls, roi_map, window_start, window_stop):
+        """
+        Extract the ROI mask within the given window (block coords),
+        (False where the window extends beyond the ROI).
+        """
+        from DVIDSparkServices.util import RoiMap
         assert isinstance(roi_map, RoiMap)
+        return roi_map.get_mask(window_start, window_stop)
 
+    def roi_coords_for_box(self, roi_map, subvol_start_px, subvol_stop_px):
         # Subvol bounding box in block coords
         subvol_blocks_start = subvol_start_px // self.roi_blocksize
         subvol_blocks_stop = (subvol_stop_px + self.roi_blocksize-1) // self.roi_blocksize
-        subvol_blocks_shape = subvol_blocks_stop - subvol_blocks_start
 
-        # Where does this subvolume start within roi_map.block_mask?
-        # Offset, since the ROI didn't necessarily start at (0,0,0)
-        subvol_blocks_offset = subvol_blocks_start - roi_map.blocks_start
-        
-        # Clip the extracted region, since subvol may extend outside of ROI and therefore outside of roi_map.block_mask
-        subvol_blocks_clipped_start = np.maximum(subvol_blocks_offset, (0,0,0))
-        subvol_blocks_clipped_stop = np.minimum(roi_map.blocks_shape, (subvol_blocks_start + subvol_blocks_shape) - roi_map.blocks_start)
-        
-        # Extract the portion of the mask for this subvol
-        subvol_blocks_mask = roi_map.block_mask[bb_to_slicing(subvol_blocks_clipped_start, subvol_blocks_clipped_stop)]
-        subvol_block_coords = np.transpose( subvol_blocks_mask.nonzero() )
-        
-        # Un-offset.
-        subvol_block_coords += (subvol_blocks_clipped_start + roi_map.blocks_start)
-        return subvol_block_coords
+        window_mask = self._roi_window_mask(roi_map, subvol_blocks_start, subvol_blocks_stop)
+        return self._mask_coords(window_mask, subvol_blocks_start)
+
+    def _set_intersecting_blocks(self, block_coords):
+        """Set the block mask from a list of block coords (within block_window)."""
+        block_coords = np.asarray(block_coords, dtype=np.int64).reshape((-1,3))
+        if len(block_coords) == 0:
+            self._block_bits = None
+            return
+        start, stop = self.block_window
+        window_mask = np.zeros(stop - start, dtype=bool)
+        window_mask[tuple((block_coords - start).transpose())] = True
+        self._block_bits = np.packbits(window_mask.reshape(-1))
+
+    def __getstate__(self):
+        # Plain tuples and strings pickle much more compactly than numpy objects.
+        block_bits = None
+        if self._block_bits is not None:
+            block_bits = self._block_bits.tostring()
+        return (self.sv_index, tuple(self.box), self.border_zyx, bool(self.is_interior),
+                block_bits, self._neighbors)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            self._setstate_from_dict(state)
+            return
+        sv_index, box, self.border_zyx, self.is_interior, block_bits, self._neighbors = state
+        self.sv_index = sv_index
+        self.box = SubvolumeNamedTuple(*box)
+        self._block_bits = None
+        if block_bits is not None:
+            self._block_bits = np.frombuffer(block_bits, dtype=np.uint8)
+
+    def _setstate_from_dict(self, state):
+        # Subvolumes pickled before Subvolume used __slots__
+        # stored plain attributes, including a single 'border' int
+        # (before per-axis borders were supported).
+        self.sv_index = state['sv_index']
+        self.box = SubvolumeNamedTuple(*map(int, state['box']))
+        if 'border_zyx' in state:
+            self.border_zyx = tuple(state['border_zyx'])
+        else:
+            self.border_zyx = (state['border'],) * 3
+        self.is_interior = state['is_interior']
+        self._set_intersecting_blocks(state['intersecting_blocks'])
+        self._neighbors = array.array('l')
+        for sv_index, box in state['local_regions']:
+            self._neighbors.append(sv_index)
+            self._neighbors.extend(box)
 
     def __eq__(self, other):
         return (self.sv_index == other.sv_index and
                 self.box == other.box and
-                self.border == other.border)
+                self.border_zyx == other.border_zyx)
 
     def __ne__(self, other):
         return not self.__eq__(other)
@@ -120,6 +352,18 @@ class Subvolume(object):
         #return hash( (self.sv_index, self.box, self.border) )
         return hash(self.sv_index)
 
+    @property
+    def border(self):
+        """
+        Read-only property.
+        The border width, for subvolumes whose border is the same on every axis.
+        (Code that handles per-axis borders should use border_zyx instead.)
+        """
+        bz, by, bx = self.border_zyx
+        assert bz == by == bx, \
+            "Subvolume {} has a per-axis border {}; use border_zyx".format(self, self.border_zyx)
+        return bz
+
     @property
     def box_with_border(self):
         """
@@ -127,8 +371,28 @@ class Subvolume(object):
         Same as self.box, but expanded to include the border.
         """
         z1, y1, x1, z2, y2, x2 = self.box
-        return SubvolumeNamedTuple(z1 - self.border, y1 - self.border, x1 - self.border,
-                                   z2 + self.border, y2 + self.border, x2 + self.border)
+        bz, by, bx = self.border_zyx
+        return SubvolumeNamedTuple(z1 - bz, y1 - by, x1 - bx,
+                                   z2 + bz, y2 + by, x2 + bx)
+
+    @property
+    def shape_with_border(self):
+        """
+        Read-only property.
+        (z,y,x) shape of box_with_border.
+        """
+        z1, y1, x1, z2, y2, x2 = self.box_with_border
+        return (z2 - z1, y2 - y1, x2 - x1)
+
+    @property
+    def local_regions(self):
+        """
+        Read-only property.
+        List of this subvolume's neighbors, as [(sv_index, box), ...]
+        (see recordborder()).
+        """
+        n = self._neighbors
+        return [ (n[i], SubvolumeNamedTuple(*n[i+1:i+7])) for i in range(0, len(n), 7) ]
 
 
     def __str__(self):
@@ -164,8 +428,10 @@ class Subvolume(object):
         or (self.touches(liney1[0], liney1[1], liney2[0], liney2[1]) and self.intersects(linex1, linex2) and self.intersects(linez1, linez2)) \
         or (self.touches(linez1[0], linez1[1], linez2[0], linez2[1]) and self.intersects(liney1, liney2) and self.intersects(linex1, linex2)):
             # save overlapping substacks
-            self.local_regions.append((box2.sv_index, box2.box))
-            box2.local_regions.append((self.sv_index, self.box))
+            self._neighbors.append(box2.sv_index)
+            self._neighbors.extend(box2.box)
+            box2._neighbors.append(self.sv_index)
+            box2._neighbors.extend(self.box)
 
     @classmethod
     def subvol_list_to_json(cls, subvol_list):
@@ -201,10 +467,50 @@ class Subvolume(object):
         
         return buf.getvalue()
 
+    @classmethod
+    def estimate_costs(cls, subvols, measured_seconds=None):
+        """Estimate the relative processing cost of each subvolume.
+
+        By default, the cost is the number of ROI blocks the subvolume
+        (including its border) intersects.
+
+        Args:
+            subvols: list of Subvolumes
+            measured_seconds (dict): (Optional) processing times from a previous
+                run, keyed by subvolume box start "z_y_x" (see cost_key()).
+                Measured subvolumes use their measured time; the others use their
+                block count, scaled by the median seconds-per-block of the measured ones.
+
+        Returns:
+            array of costs, in the same order as subvols
+        """
+        costs = np.array([len(sv.intersecting_blocks) for sv in subvols], dtype=np.float64)
+        if not measured_seconds:
+            return costs
+
+        measured = [ (i, measured_seconds[sv.cost_key()]) for i, sv in enumerate(subvols)
+                     if sv.cost_key() in measured_seconds ]
+        if not measured:
+            return costs
+        indexes, seconds = map(np.array, zip(*measured))
+
+        nonempty = costs[indexes] > 0
+        if nonempty.any():
+            seconds_per_block = np.median( seconds[nonempty] / costs[indexes][nonempty] )
+            costs *= seconds_per_block
+        costs[indexes] = seconds
+        return costs
+
+    def cost_key(self):
+        """Key for this subvolume in the measured_seconds dict of estimate_costs()."""
+        return "{}_{}_{}".format(*self.box[0:3])
+
     @classmethod
     def subvol_list_all_blocks(cls, subvols):
-        all_blocks_zyx = np.empty((0,3), np.int64)
-        for subvol in subvols:
-            all_blocks_zyx = np.append(all_blocks_zyx, subvol.intersecting_blocks_noborder, axis=0)
-        return all_blocks_zyx
+        """Return the ROI blocks (without border) of all the given subvolumes, as one (N,3) array."""
+        # One allocation for the result (rather than growing it with np.append)
+        block_lists = [ subvol.intersecting_blocks_noborder for subvol in subvols ]
+        if not block_lists:
+            return np.empty((0,3), np.int64)
+        return np.concatenate(block_lists)
         
@@ -0,0 +1,216 @@
+"""Defines a small token service for coordinating DVID access across a cluster.
+
+Without a resource server, every libdvid request is throttled within
+its own process only, and all requests from a process are serialized.
+That leaves DVID either under-used (one request per process) or
+over-loaded (no throttle, many executors).
+
+TokenServer runs in a background thread on the driver.  Before each
+DVID request, an executor connects to it and asks for a 'read' or
+'write' token of a given size (bytes to transfer).  A token is granted
+once the number of requests of that kind in flight is below its limit
+and the bytes in flight fit the byte budget.  The token is held for as
+long as the connection stays open, so a task that dies mid-request
+releases its token automatically.
+
+Protocol (one token per connection):
+
+    client: "<kind> <nbytes>\\n"     (kind is 'read' or 'write')
+    server: "ok\\n"                  (once granted)
+    client: closes the connection    (releases the token)
+
+"""
+import time
+import socket
+import threading
+import logging
+import SocketServer
+from collections import deque
+from contextlib import contextmanager
+
+TOKEN_KINDS = ('read', 'write')
+
+class TokenBudget(object):
+    """Tracks tokens in flight and grants them in FIFO order.
+
+    A request larger than max_bytes on its own is still granted when
+    nothing else is in flight, so it can't wait forever.
+    """
+
+    def __init__(self, max_requests, max_bytes=None):
+        assert max_requests is None or max_requests >= 1
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.requests_in_flight = 0
+        self.bytes_in_flight = 0
+        self._waiting = deque()
+        self._cond = threading.Condition()
+        self._counters = { "granted": 0, "peak_requests": 0, "peak_bytes": 0, "wait_seconds": 0.0 }
+
+    def acquire(self, nbytes):
+        """Block until a token for nbytes is available, and take it."""
+        ticket = object()
+        start = time.time()
+        with self._cond:
+            self._waiting.append(ticket)
+            while not (self._waiting[0] is ticket and self._fits(nbytes)):
+                self._cond.wait()
+            self._waiting.popleft()
+            self.requests_in_flight += 1
+            self.bytes_in_flight += nbytes
+
+            c = self._counters
+            c["granted"] += 1
+            c["peak_requests"] = max(c["peak_requests"], self.requests_in_flight)
+            c["peak_bytes"] = max(c["peak_bytes"], self.bytes_in_flight)
+            c["wait_seconds"] += time.time() - start
+
+            # The next waiter might fit, too.
+            self._cond.notify_all()
+
+    def release(self, nbytes):
+        with self._cond:
+            self.requests_in_flight -= 1
+            self.bytes_in_flight -= nbytes
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._counters)
+            stats["waiting"] = len(self._waiting)
+            stats["requests_in_flight"] = self.requests_in_flight
+            stats["bytes_in_flight"] = self.bytes_in_flight
+            return stats
+
+    def _fits(self, nbytes):
+        if self.max_requests is not None and self.requests_in_flight >= self.max_requests:
+            return False
+        if self.max_bytes is None or self.bytes_in_flight == 0:
+            return True
+        return self.bytes_in_flight + nbytes <= self.max_bytes
+
+class _TokenRequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        try:
+            kind, nbytes = line.split()
+            budget = self.server.budgets[kind]
+            nbytes = int(nbytes)
+        except (ValueError, KeyError):
+            self.wfile.write("error bad request\n")
+            return
+
+        budget.acquire(nbytes)
+        try:
+            self.wfile.write("ok\n")
+            self.wfile.flush()
+            # Hold the token until the client hangs up.
+            while self.rfile.read(1024):
+                pass
+        except socket.error:
+            pass
+        finally:
+            budget.release(nbytes)
+
+class _ThreadingTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+class TokenServer(object):
+    """Grants DVID read/write tokens to clients over TCP.
+
+    Example (on the driver):
+
+        server = TokenServer(max_reads=32, max_writes=8, max_bytes_in_flight=4*2**30)
+        server.start()
+        address = server.address # (host, port) to pass to the executors
+        ...
+        server.shutdown()
+    """
+
+    def __init__(self, max_reads, max_writes, max_bytes_in_flight=None, host="", port=0):
+        """Initialize server.
+
+        Args:
+            max_reads (int): maximum concurrent read requests (None for no limit)
+            max_writes (int): maximum concurrent write requests (None for no limit)
+            max_bytes_in_flight (int): maximum bytes being transferred
+                (reads and writes each get their own budget of this size;
+                None for no limit)
+            host (str): interface to listen on (default: all)
+            port (int): port to listen on (default: any free port)
+
+        """
+        self.budgets = { 'read': TokenBudget(max_reads, max_bytes_in_flight),
+                         'write': TokenBudget(max_writes, max_bytes_in_flight) }
+        self._server = _ThreadingTCPServer((host, port), _TokenRequestHandler)
+        self._server.budgets = self.budgets
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="TokenServer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def shutdown(self):
+        """Stop serving and log the final stats."""
+        if self._thread is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._thread = None
+        self.log_stats()
+
+    def stats(self):
+        """Return { kind: stats dict } for reads and writes."""
+        return { kind: budget.stats() for kind, budget in self.budgets.items() }
+
+    def log_stats(self):
+        logger = logging.getLogger(__name__)
+        for kind, stats in sorted(self.stats().items()):
+            logger.info("DVID {} tokens: {} granted, peak {} requests / {} bytes in flight, {:.1f} seconds waiting"
+                        .format( kind, stats["granted"], stats["peak_requests"],
+                                 stats["peak_bytes"], stats["wait_seconds"] ))
+
+@contextmanager
+def dvid_token(token_server, kind, nbytes):
+    """Context manager that holds a token from a TokenServer.
+
+    Args:
+        token_server: (host, port) of the TokenServer, or None
+            (in which case this does nothing)
+        kind (str): 'read' or 'write'
+        nbytes (int): size of the transfer
+
+    If the server can't be reached, a warning is logged and the
+    request proceeds without a token, rather than failing the task.
+    """
+    assert kind in TOKEN_KINDS
+    if token_server is None:
+        yield
+        return
+
+    sock = None
+    try:
+        sock = socket.create_connection(tuple(token_server))
+        sock.sendall("{} {}\n".format(kind, int(nbytes)))
+        reply = sock.makefile('r').readline()
+        if reply.strip() != "ok":
+            raise socket.error("Unexpected reply from token server: {!r}".format(reply))
+    except socket.error as ex:
+        logging.getLogger(__name__).warn("Proceeding without a DVID {} token: {}".format(kind, ex))
+        if sock is not None:
+            sock.close()
+            sock = None
+
+    try:
+        yield
+    finally:
+        if sock is not None:
+            sock.close()
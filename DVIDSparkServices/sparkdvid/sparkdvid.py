@@ -12,28 +12,34 @@ unique subvolume key.  The mapping operations map only the values
 and perserve the partitioner to make future joins faster.
 
 Note: Access to DVID is done through the python bindings to libdvid-cpp.
-For now, all volume GET/POST acceses are throttled (only one at a time)
-because DVID is only being run on one server.  This will obviously
-greatly reduce scalability but will be changed as soon as DVID
-is backed by a clustered DB.
+Unless a resource server or the driver's token server (see TokenService)
+is configured, all volume GET/POST acceses are throttled by libdvid
+(only one at a time per process).  With the token server, each request
+first takes a read or write token, so the number of requests and bytes
+in flight are limited across the whole cluster instead.
 
 """
 
+import os
+import threading
 import numpy as np
 from DVIDSparkServices.sparkdvid.Subvolume import Subvolume
 
 import logging
 logger = logging.getLogger(__name__)
 
-from DVIDSparkServices.auto_retry import auto_retry
-from DVIDSparkServices.util import mask_roi, RoiMap
+from DVIDSparkServices.auto_retry import auto_retry, RetryCountsParam
+from DVIDSparkServices.util import mask_roi, RoiMap, zero_where_reference_zero, prefetch_map, runlength_decode, zorder_index, \
+                                   split_by_cost, zyx_tuple
+from DVIDSparkServices.sparkdvid.NodeServicePool import NodeServicePool
+from DVIDSparkServices.sparkdvid.CompressedLabelVolume import CompressedLabelVolume
+from DVIDSparkServices.sparkdvid.TokenService import dvid_token
+from DVIDSparkServices.sparkdvid.BlockCache import process_block_cache
     
 
-def retrieve_node_service(server, uuid, resource_server, resource_port, appname="sparkservices"):
+def _create_node_service(server, uuid, resource_server, resource_port, appname):
     """Create a DVID node service object"""
 
-    server = str(server)  
-   
     # refresh dvid server meta if localhost (since it is exclusive or points to global db)
     """
     if server.startswith("http://127.0.0.1") or  \
@@ -56,13 +62,266 @@ def retrieve_node_service(server, uuid, resource_server, resource_port, appname=
     username = os.environ["USER"]
 
     if resource_server != "":
-        node_service = DVIDNodeService(server, str(uuid), username, appname, str(resource_server), resource_port)
+        node_service = DVIDNodeService(server, uuid, username, appname, resource_server, resource_port)
     else:
-        node_service = DVIDNodeService(server, str(uuid), username, appname)
+        node_service = DVIDNodeService(server, uuid, username, appname)
 
 
     return node_service
 
+# Process-wide cache of node services (see NodeServicePool)
+node_service_pool = NodeServicePool(_create_node_service)
+
+def _node_service_key(server, uuid, resource_server, resource_port, appname):
+    return (str(server), str(uuid), str(resource_server), int(resource_port), str(appname))
+
+def retrieve_node_service(server, uuid, resource_server="", resource_port=0, appname="sparkservices"):
+    """Return a DVID node service object for the given server and uuid.
+
+    The service is taken from the process-wide node_service_pool and
+    reserved for the calling thread, so repeated calls from the same thread
+    reuse the same connection.  Prefer checkout_node_service() in worker
+    code, which returns the service to the pool for other threads.
+    """
+    key = _node_service_key(server, uuid, resource_server, resource_port, appname)
+    return node_service_pool.get(key)
+
+def checkout_node_service(server, uuid, resource_server="", resource_port=0, appname="sparkservices"):
+    """Like retrieve_node_service(), but as a context manager.
+
+    If the body of the 'with' statement raises, the pooled service is
+    evicted so that a retry will establish a fresh connection.
+    
+    Example:
+    
+        with checkout_node_service(server, uuid) as node_service:
+            node_service.get_gray3D(...)
+    """
+    key = _node_service_key(server, uuid, resource_server, resource_port, appname)
+    return node_service_pool.checkout(key)
+
+def is_retryable_dvid_error(ex):
+    """Classify an exception raised while talking to DVID.
+
+    Programming errors and HTTP 4xx responses (other than 408 and 429)
+    won't be fixed by trying again.  Everything else (5xx responses,
+    connection errors, timeouts) is assumed to be transient.
+    """
+    if isinstance(ex, (AssertionError, TypeError, ValueError, KeyError,
+                       AttributeError, NotImplementedError, MemoryError)):
+        return False
+
+    import re
+    status = getattr(ex, 'status_code', None) or getattr(ex, 'status', None)
+    if status is None:
+        match = re.search(r'status(?: code)?\D{0,3}(\d{3})', str(ex), re.IGNORECASE)
+        if match:
+            status = match.group(1)
+    try:
+        status = int(status)
+    except (TypeError, ValueError):
+        return True
+    return not (400 <= status < 500) or status in (408, 429)
+
+def dvid_read_retry(call_site, retry_counts=None):
+    """auto_retry() decorator with the backoff policy for DVID reads.
+
+    Pauses 5, 10, 20 seconds (+/- 50%) between tries, up to 2 minutes in total.
+    """
+    return auto_retry(4, pause_between_tries=5.0, backoff_factor=2.0, max_pause=60.0,
+                      jitter=0.5, max_total_pause=120.0, is_retryable=is_retryable_dvid_error,
+                      retry_counts=retry_counts, call_site=call_site, logging_name=__name__)
+
+def dvid_write_retry(call_site, retry_counts=None):
+    """auto_retry() decorator with the backoff policy for DVID writes.
+
+    Writes are more likely to fail because DVID is overloaded,
+    so they back off longer: 15, 30, 60, 120 seconds (+/- 50%), up to 10 minutes in total.
+    """
+    return auto_retry(5, pause_between_tries=15.0, backoff_factor=2.0, max_pause=300.0,
+                      jitter=0.5, max_total_pause=600.0, is_retryable=is_retryable_dvid_error,
+                      retry_counts=retry_counts, call_site=call_site, logging_name=__name__)
+
+# Process-wide thread pool for issuing concurrent DVID requests within a task
+# (created on first use; see fetch_thread_pool())
+_fetch_thread_pool = None
+_fetch_thread_pool_pid = None
+_fetch_thread_pool_lock = threading.Lock()
+
+def fetch_thread_pool():
+    """Return this process's thread pool for concurrent DVID fetches.
+
+    The pool (and therefore its threads) persists across tasks.
+    """
+    global _fetch_thread_pool, _fetch_thread_pool_pid
+    with _fetch_thread_pool_lock:
+        if _fetch_thread_pool is None or _fetch_thread_pool_pid != os.getpid():
+            from multiprocessing.pool import ThreadPool
+            _fetch_thread_pool = ThreadPool(2)
+            _fetch_thread_pool_pid = os.getpid()
+        return _fetch_thread_pool
+
+def get_labels3D_lz4(node_service, label_name, shape_zyx, offset_zyx):
+    """Fetch a labelblk volume without decompressing it.
+
+    Like node_service.get_labels3D(..., compress=True), but the lz4
+    payload sent by DVID is returned as a CompressedLabelVolume.
+
+    Note: This request is issued via custom_request(), which is not
+          throttled by libdvid or by a resource server.  Use it only when
+          a DVID token server (see TokenService) is configured, and hold
+          a DVID token while calling it.  Otherwise, use get_labels3D().
+    """
+    from libdvid import ConnectionMethod
+    size_z, size_y, size_x = shape_zyx
+    z, y, x = offset_zyx
+    endpoint = "{}/raw/0_1_2/{}_{}_{}/{}_{}_{}?compression=lz4"\
+               .format(label_name, size_x, size_y, size_z, x, y, z)
+    raw_lz4 = node_service.custom_request(str(endpoint), "", ConnectionMethod.GET)
+    return CompressedLabelVolume.from_dvid_lz4(raw_lz4, shape_zyx, np.uint64)
+
+def assemble_roi_blocks(fetch_box, subvolume, dtype):
+    """Fetch only the ROI blocks of a subvolume and assemble them into a dense array.
+
+    The subvolume's intersecting_blocks (which include its border) are
+    grouped into runs along X, and one request is issued per run, clipped
+    to the subvolume's bounding box.  Voxels outside the ROI are left 0,
+    so the result needs no further ROI masking.
+
+    Args:
+        fetch_box (callable): fetch_box(shape_zyx, offset_zyx) -> ndarray
+        subvolume (Subvolume): subvolume to fetch (including border)
+        dtype: dtype of the returned array
+
+    Returns:
+        ndarray covering subvolume.box_with_border
+    """
+    from DVIDSparkServices.util import runlength_encode, bb_to_slicing
+
+    sv_start = np.array(subvolume.box_with_border[0:3])
+    sv_stop = np.array(subvolume.box_with_border[3:6])
+    volume = np.zeros( sv_stop - sv_start, dtype=dtype )
+
+    blocksize = subvolume.roi_blocksize
+    for (z, y, x1, x2) in runlength_encode(subvolume.intersecting_blocks, assume_sorted=True):
+        run_start = np.array((z, y, x1)) * blocksize
+        run_stop = np.array((z+1, y+1, x2+1)) * blocksize
+        
+        # Clip to the subvolume
+        run_start = np.maximum(run_start, sv_start)
+        run_stop = np.minimum(run_stop, sv_stop)
+
+        # Note: libdvid uses zyx order for python functions
+        run_data = fetch_box( tuple(run_stop - run_start), tuple(run_start) )
+        volume[bb_to_slicing(run_start - sv_start, run_stop - sv_start)] = run_data
+
+    return volume
+
+def coalesce_label_writes(boxes_and_segs, max_request_bytes=2**30, skip_zero_blocks=False, blocksize=32):
+    """Merge label volumes that are adjacent along X into larger write requests.
+
+    Args:
+        boxes_and_segs: iterable of ((z1,y1,x1,z2,y2,x2), volume),
+            sorted in (z,y,x) order (i.e. DVID block key order)
+        max_request_bytes (int): don't merge beyond this many (uncompressed) bytes
+        skip_zero_blocks (bool): drop columns of blocks (all Z and Y, blocksize in X)
+            that are entirely 0, splitting the request around them
+        blocksize (int): DVID block width
+
+    Returns:
+        generator of (offset_zyx, C-contiguous volume), in the same order
+    """
+    def requests_for_run(offset_zyx, segs):
+        if len(segs) == 1:
+            volume = np.ascontiguousarray(segs[0])
+        else:
+            volume = np.concatenate(segs, axis=2)
+
+        if not skip_zero_blocks:
+            yield (offset_zyx, volume)
+            return
+
+        # Find runs of block columns that contain any label
+        x_starts = range(0, volume.shape[2], blocksize)
+        nonzero = np.array([volume[:, :, x:x+blocksize].any() for x in x_starts] + [False])
+        run_x1 = None
+        for x, column_nonzero in zip(x_starts + [volume.shape[2]], nonzero):
+            if column_nonzero and run_x1 is None:
+                run_x1 = x
+            elif not column_nonzero and run_x1 is not None:
+                z, y, x0 = offset_zyx
+                yield ( (z, y, x0 + run_x1), np.ascontiguousarray(volume[:, :, run_x1:x]) )
+                run_x1 = None
+
+    run_box = None
+    run_segs = []
+    run_bytes = 0
+    for box, seg in boxes_and_segs:
+        box = tuple(box)
+        assert seg.shape == tuple(np.array(box[3:6]) - box[0:3])
+
+        # Extend the current run if this box continues it along X
+        if run_segs and box[0:2] == run_box[0:2] and box[3:5] == run_box[3:5] \
+           and box[2] == run_box[5] and run_bytes + seg.nbytes <= max_request_bytes:
+            run_segs.append(seg)
+            run_box = run_box[0:5] + (box[5],)
+            run_bytes += seg.nbytes
+            continue
+
+        if run_segs:
+            for request in requests_for_run(run_box[0:3], run_segs):
+                yield request
+        run_box, run_segs, run_bytes = box, [seg], seg.nbytes
+
+    if run_segs:
+        for request in requests_for_run(run_box[0:3], run_segs):
+            yield request
+
+def cached_fetch_box(fetch_box, instance_key, dtype, block_cache_bytes, hit_counter=None, miss_counter=None):
+    """Wrap fetch_box(shape_zyx, offset_zyx) to go through this process's BlockCache."""
+    block_cache = process_block_cache(block_cache_bytes)
+    def fetch_cached(shape_zyx, offset_zyx):
+        return block_cache.get_box( fetch_box, instance_key, shape_zyx, offset_zyx, dtype,
+                                    hit_counter, miss_counter )
+    return fetch_cached
+
+def map_subvolume_values(distsubvolumes, mapper, prefetch=0, prefetch_max_bytes=None, bytes_per_voxel=1):
+    """Like distsubvolumes.mapValues(mapper), with optional prefetching.
+
+    If prefetch > 0, each partition is processed via prefetch_map(),
+    so the mapper runs in a background thread up to 'prefetch' subvolumes
+    (of the same partition -- see prefetch_subvolumes_per_partition())
+    ahead of the downstream computation, and at most prefetch_max_bytes
+    of results (estimated as bytes_per_voxel times each subvolume's
+    volume, including its border) are held in memory at once.
+    """
+    if prefetch == 0:
+        return distsubvolumes.mapValues(mapper)
+
+    def map_value( (key, subvolume) ):
+        return (key, mapper(subvolume))
+
+    def estimate_nbytes( (_key, subvolume) ):
+        box = subvolume.box_with_border
+        return bytes_per_voxel * (box[3]-box[0]) * (box[4]-box[1]) * (box[5]-box[2])
+
+    def map_partition(key_subvolumes):
+        return prefetch_map(map_value, key_subvolumes, prefetch, prefetch_max_bytes, estimate_nbytes)
+
+    return distsubvolumes.mapPartitions(map_partition, preservesPartitioning=True)
+
+def prefetch_subvolumes_per_partition(prefetch, subvolumes_per_partition=1):
+    """Return how many subvolumes each partition should hold so that
+    map_subvolume_values() can prefetch.
+
+    prefetch_map() only looks ahead within a partition, so with one
+    subvolume per partition, prefetching does nothing.  If prefetch > 0,
+    partitions hold at least 4*prefetch subvolumes.
+    """
+    if prefetch > 0:
+        return max(subvolumes_per_partition, 4*prefetch)
+    return subvolumes_per_partition
+
 class sparkdvid(object):
     """Creates a spark dvid context that holds the spark context.
 
@@ -89,34 +348,116 @@ class sparkdvid(object):
         self.uuid = dvid_uuid
         self.workflow = workflow
 
+        # Counts retries of DVID requests in all tasks, by call site
+        # (see auto_retry and report_retry_counts())
+        self.retry_counts = context.accumulator({}, RetryCountsParam())
+
+        # Counts blocks served from/fetched into executors' block caches
+        # (see BlockCache and report_block_cache_stats())
+        self.block_cache_hits = context.accumulator(0)
+        self.block_cache_misses = context.accumulator(0)
+
+    def report_retry_counts(self):
+        """Log the DVID retry counts accumulated so far (call on the driver)."""
+        counts = self.retry_counts.value
+        if not counts:
+            return
+        for (call_site, event), count in sorted(counts.items()):
+            logger.info("DVID retry counts: {} {}: {}".format(call_site, event, count))
+
+    def report_block_cache_stats(self):
+        """Log the block cache hit rate accumulated so far (call on the driver)."""
+        hits = self.block_cache_hits.value
+        misses = self.block_cache_misses.value
+        if hits + misses == 0:
+            return
+        logger.info("Block cache: {} hits, {} misses ({:.1f}% hit rate)"
+                    .format(hits, misses, 100.0 * hits / (hits + misses)))
+
     # Produce RDDs for each subvolume partition (this will replace default implementation)
     # Treats subvolum index as the RDD key and maximizes partition count for now
     # Assumes disjoint subsvolumes in ROI
-    def parallelize_roi(self, roi, chunk_size, border=0, find_neighbors=False, partition_method='ask-dvid', partition_filter=None):
+    def parallelize_roi(self, roi, chunk_size, border=0, find_neighbors=False, partition_method='ask-dvid', partition_filter=None,
+                        subvolumes_per_partition=1, load_balance=False, measured_seconds=None):
         """Creates an RDD from subvolumes found in an ROI.
 
         This is analogous to the Spark parallelize function.
-        It currently defines the number of partitions as the 
+        By default, it defines the number of partitions as the 
         number of subvolumes.
 
-        TODO: implement general partitioner given other
-        input such as bounding box coordinates.
-        
         Args:
             roi (str): name of DVID ROI at current server and uuid
-            chunk_size (int): the desired dimension of the subvolume
-            border (int): size of the border surrounding the subvolume
+            chunk_size: the desired dimension of the subvolume,
+                either an int (cubes) or a (z,y,x) shape
+            border: size of the border surrounding the subvolume,
+                either an int or per-axis (z,y,x)
             find_neighbors (bool): whether to identify neighbors
+            subvolumes_per_partition (int): if > 1, subvolumes are sorted
+                in Z-order (see util.zorder_index) and each partition holds
+                this many spatially adjacent subvolumes, so that neighbors
+                (and their shared borders) are mostly processed together
+            load_balance (bool): if True, weigh subvolumes by their estimated
+                cost (see Subvolume.estimate_costs).  Partitions are listed
+                (and therefore scheduled) heaviest first, and with
+                subvolumes_per_partition > 1, the Z-ordered subvolumes are
+                split into runs of equal cost rather than equal count.
+            measured_seconds (dict): optional measured costs for estimate_costs()
 
         Returns:
             RDD as [(subvolume id, subvolume)] and # of subvolumes
 
         """
         subvolumes = self._initialize_subvolumes(roi, chunk_size, border, find_neighbors, partition_method, partition_filter)
+
+        costs = None
+        if load_balance:
+            costs = Subvolume.estimate_costs(subvolumes, measured_seconds)
+
+        return self.parallelize_subvolumes(subvolumes, chunk_size, subvolumes_per_partition, costs)
+
+    def parallelize_subvolumes(self, subvolumes, chunk_size, subvolumes_per_partition=1, costs=None):
+        """Creates an RDD of [(subvolume id, subvolume)] from a list of subvolumes.
+
+        Partitions are formed as in parallelize_roi(), which calls this
+        function.  Use it to re-parallelize a subset of those subvolumes
+        (e.g. one iteration's worth) with the same grouping.
+
+        Args:
+            subvolumes: list of Subvolume
+            chunk_size: the subvolume dimension (int or (z,y,x) shape),
+                used to find each subvolume's position in Z-order
+            subvolumes_per_partition (int): see parallelize_roi()
+            costs: optional array of each subvolume's estimated cost
+                (see Subvolume.estimate_costs), to load-balance as in
+                parallelize_roi()
+
+        """
         enumerated_subvolumes = [(sv.sv_index, sv) for sv in subvolumes]
 
-        # Potential TODO: custom partitioner for grouping close regions
-        return self.sc.parallelize(enumerated_subvolumes, len(enumerated_subvolumes))
+        if subvolumes_per_partition <= 1 or len(subvolumes) == 0:
+            if costs is not None:
+                # Spark launches tasks in partition order, so start with the heaviest ones.
+                heaviest_first = np.argsort(-np.asarray(costs), kind='mergesort')
+                enumerated_subvolumes = [enumerated_subvolumes[i] for i in heaviest_first]
+            return self.sc.parallelize(enumerated_subvolumes, len(enumerated_subvolumes) or None)
+
+        # Group close regions: parallelize() slices the list into contiguous
+        # partitions, so sort the list along a space-filling curve.
+        box_starts = np.array([sv.box[0:3] for sv in subvolumes])
+        grid_coords = (box_starts - box_starts.min(axis=0)) // zyx_tuple(chunk_size)
+        zorder = np.argsort(zorder_index(grid_coords), kind='mergesort')
+        enumerated_subvolumes = [enumerated_subvolumes[i] for i in zorder]
+
+        num_partitions = (len(enumerated_subvolumes) + subvolumes_per_partition - 1) // subvolumes_per_partition
+        if costs is None:
+            return self.sc.parallelize(enumerated_subvolumes, num_partitions)
+
+        # Contiguous runs (in Z-order) of roughly equal cost, heaviest first
+        costs = np.asarray(costs)[zorder]
+        runs = [ (start, stop) for (start, stop) in split_by_cost(costs, num_partitions) if stop > start ]
+        runs.sort(key=lambda (start, stop): -costs[start:stop].sum())
+        partitions = [ enumerated_subvolumes[start:stop] for (start, stop) in runs ]
+        return self.sc.parallelize(partitions, len(partitions)).flatMap(lambda partition: partition)
 
     def _initialize_subvolumes(self, roi, chunk_size, border=0, find_neighbors=False, partition_method='ask-dvid', partition_filter=None):
         assert partition_method in ('ask-dvid', 'grid-aligned')
@@ -128,11 +469,11 @@ class sparkdvid(object):
         substack_tuples = self.get_roi_partition(roi, chunk_size, partition_method)
 
         # Create dense representation of ROI
-        roi_map = RoiMap( self.get_roi(roi) )
+        roi_map = RoiMap.from_runs( self.get_roi_runs(roi) )
 
         # Initialize all Subvolumes (sv_index is updated below)
-        subvolumes = map( lambda ss: Subvolume(None, (ss.z, ss.y, ss.x), chunk_size, border, roi_map),
-                          substack_tuples )
+        subvolumes = Subvolume.create_batch( [(ss.z, ss.y, ss.x) for ss in substack_tuples],
+                                             chunk_size, border, roi_map )
 
         # Discard empty subvolumes (ones that don't intersect the ROI at all).
         # The 'grid-aligned' partition-method can return such subvolumes;
@@ -149,10 +490,7 @@ class sparkdvid(object):
 
         # grab all neighbors for each substack
         if find_neighbors:
-            # inefficient search for all boundaries
-            for i in range(0, len(subvolumes)-1):
-                for j in range(i+1, len(subvolumes)):
-                    subvolumes[i].recordborder(subvolumes[j])
+            Subvolume.record_all_borders(subvolumes)
 
         return subvolumes
 
@@ -161,21 +499,50 @@ class sparkdvid(object):
         An alternate implementation of libdvid.DVIDNodeService.get_roi(),
         since DVID sometimes returns strange 503 errors and DVIDNodeService.get_roi()
         doesn't know how to handle them.
+
+        Returns:
+            Array of block coordinates [[Z,Y,X], ...]
+            (Use get_roi_runs() to avoid listing every block.)
+        """
+        return runlength_decode( self.get_roi_runs(roi) )
+
+    def get_roi_runs(self, roi):
         """
+        Fetch the given ROI in DVID's run-length encoded form:
+        an array of [[Z,Y,X1,X2], ...] block runs (X2 inclusive).
+
+        If the workflow specifies a "roi-cache-dir" option, the runs
+        are stored there (as .npy) and later reused for the same
+        server, uuid, and ROI name without asking DVID.
+        (Delete the file if the ROI at that uuid has changed.)
+        """
+        cache_path = None
+        cache_dir = self.workflow.roi_cache_dir
+        if cache_dir:
+            import re
+            cache_name = "{}_{}_{}.npy".format(self.dvid_server, self.uuid, roi)
+            cache_path = os.path.join( cache_dir, re.sub(r'[^A-Za-z0-9_.-]', '_', cache_name) )
+            if os.path.exists(cache_path):
+                return np.load(cache_path)
+
         # grab roi blocks (should use libdvid but there are problems handling 206 status)
         import requests
         addr = self.dvid_server + "/api/node/" + str(self.uuid) + "/" + str(roi) + "/roi"
         if not self.dvid_server.startswith("http://"):
             addr = "http://" + addr
         data = requests.get(addr)
-        roi_blockruns = data.json()
-        
-        roi_blocks = []
-        for (z,y,x_first, x_last) in roi_blockruns:
-            for x in range(x_first, x_last+1):
-                roi_blocks.append((z,y,x))
-        
-        return roi_blocks
+        roi_blockruns = np.array(data.json(), dtype=np.int64).reshape((-1,4))
+
+        if cache_path:
+            # Write to a temporary file first, so other readers never see a partial file.
+            from DVIDSparkServices.util import mkdir_p
+            mkdir_p(cache_dir)
+            tmp_path = cache_path + ".{}.tmp".format(os.getpid())
+            with open(tmp_path, 'wb') as f:
+                np.save(f, roi_blockruns)
+            os.rename(tmp_path, cache_path)
+
+        return roi_blockruns
 
     def get_roi_partition(self, roi_name, subvol_size, partition_method):
         """
@@ -184,30 +551,37 @@ class sparkdvid(object):
         roi_name:
             string
         subvol_size:
-            The size of the substack without overlap border
+            The size of the substack without overlap border,
+            either an int (cubes) or a (z,y,x) shape
         partition_method:
             One of 'ask-dvid' or 'grid-aligned'.
             Note: If using 'grid-aligned', the set of Substacks may
                   include 'empty' substacks that don't overlap the ROI at all.
+            Note: DVID only partitions ROIs into cubes, so non-cubic
+                  shapes require 'grid-aligned'.  In that case, the
+                  returned tuples list the z-size as their 'size'.
             
         """
-        assert subvol_size % self.BLK_SIZE == 0, \
+        subvol_shape = np.array(zyx_tuple(subvol_size))
+        assert (subvol_shape % self.BLK_SIZE == 0).all(), \
             "This function assumes chunk size is a multiple of block size"
 
-        node_service = retrieve_node_service(self.dvid_server, self.uuid, self.workflow.resource_server, self.workflow.resource_port)
         if partition_method == 'ask-dvid':
-            subvol_tuples, _ = node_service.get_roi_partition(str(roi_name), subvol_size // self.BLK_SIZE)
+            assert (subvol_shape == subvol_shape[0]).all(), \
+                "DVID can only partition ROIs into cubes.  Use the 'grid-aligned' partition-method for {}".format(tuple(subvol_shape))
+            node_service = retrieve_node_service(self.dvid_server, self.uuid, self.workflow.resource_server, self.workflow.resource_port)
+            subvol_tuples, _ = node_service.get_roi_partition(str(roi_name), int(subvol_shape[0]) // self.BLK_SIZE)
             return subvol_tuples
 
         from libdvid import SubstackZYX
 
         if partition_method == 'grid-aligned':        
-            roi_blocks = np.asarray(list(self.get_roi(roi_name)))
-            roi_blocks_start = np.min(roi_blocks, axis=0)
-            roi_blocks_stop = 1 + np.max(roi_blocks, axis=0)
+            roi_runs = self.get_roi_runs(roi_name)
+            roi_blocks_start = np.min(roi_runs[:, (0,1,2)], axis=0)
+            roi_blocks_stop = 1 + np.max(roi_runs[:, (0,1,3)], axis=0)
             roi_blocks_shape = roi_blocks_stop - roi_blocks_start
     
-            sv_size_in_blocks = (subvol_size // self.BLK_SIZE)
+            sv_size_in_blocks = (subvol_shape // self.BLK_SIZE)
             
             # How many subvolumes wide is the ROI in each dimension?
             roi_shape_in_subvols = (roi_blocks_shape + sv_size_in_blocks - 1) // sv_size_in_blocks
@@ -215,9 +589,9 @@ class sparkdvid(object):
             subvol_tuples = []
             for subvol_index in np.ndindex(*roi_shape_in_subvols):
                 subvol_index = np.array(subvol_index)
-                subvol_start = subvol_size*subvol_index + (roi_blocks_start*self.BLK_SIZE)
+                subvol_start = subvol_shape*subvol_index + (roi_blocks_start*self.BLK_SIZE)
                 z_start, y_start, x_start = subvol_start
-                subvol_tuples.append( SubstackZYX(subvol_size, z_start, y_start, x_start) )
+                subvol_tuples.append( SubstackZYX(int(subvol_shape[0]), z_start, y_start, x_start) )
             return subvol_tuples
 
         # Shouldn't get here
@@ -245,7 +619,8 @@ class sparkdvid(object):
             return newrdd
 
 
-    def map_grayscale8(self, distsubvolumes, gray_name):
+    def map_grayscale8(self, distsubvolumes, gray_name, fetch_mode="dense", prefetch=0, prefetch_max_bytes=2**30,
+                       block_cache_bytes=0):
         """Creates RDD of grayscale data from subvolumes.
 
         Note: Since EM grayscale is not highly compressible
@@ -254,24 +629,39 @@ class sparkdvid(object):
         Args:
             distsubvolumes (RDD): (subvolume id, subvolume)
             gray_name (str): name of grayscale instance
+            fetch_mode (str): "dense" fetches the whole subvolume box;
+                "roi-blocks" fetches only the ROI blocks that intersect
+                each subvolume (voxels outside the ROI will be 0)
+            prefetch (int): number of subvolumes to fetch ahead of the
+                downstream computation in each task (0 to disable)
+            prefetch_max_bytes (int): memory budget for prefetched subvolumes
+                (including the one being processed downstream)
+            block_cache_bytes (int): size of each executor's block cache
+                (see BlockCache), so that overlapping borders of neighboring
+                subvolumes are fetched only once (0 to disable)
 
         Returns:
             RDD of grayscale data (partitioner perserved)
     
         """
+        assert fetch_mode in ("dense", "roi-blocks")
+
         # copy local context to minimize sent data
         server = self.dvid_server
         uuid = self.uuid
         resource_server = self.workflow.resource_server
         resource_port = self.workflow.resource_port
+        retry_counts = self.retry_counts
+        dvid_tokens = self.workflow.dvid_tokens
+        throttle = (resource_server == "" and dvid_tokens is None)
+        block_cache_hits = self.block_cache_hits
+        block_cache_misses = self.block_cache_misses
 
         # only grab value
         def mapper(subvolume):
             # extract grayscale x
             # get sizes of subvolume
-            size_x = subvolume.box.x2 + 2*subvolume.border - subvolume.box.x1
-            size_y = subvolume.box.y2 + 2*subvolume.border - subvolume.box.y1
-            size_z = subvolume.box.z2 + 2*subvolume.border - subvolume.box.z1
+            size_z, size_y, size_x = subvolume.shape_with_border
 
             #logger = logging.getLogger(__name__)
             #logger.warn("FIXME: As a temporary hack, this introduces a pause before accessing grayscale, to offset accesses to dvid")
@@ -280,26 +670,32 @@ class sparkdvid(object):
             #time.sleep( random.randint(0,512) )
 
             # retrieve data from box start position considering border
-            @auto_retry(3, pause_between_tries=60.0, logging_name=__name__)
+            @dvid_read_retry("map_grayscale8", retry_counts)
             def get_gray():
                 # Note: libdvid uses zyx order for python functions
-                node_service = retrieve_node_service(server, uuid,resource_server, resource_port)
-                if resource_server != "":
-                    return node_service.get_gray3D( str(gray_name),
-                                                    (size_z, size_y, size_x),
-                                                    (subvolume.box.z1-subvolume.border, subvolume.box.y1-subvolume.border, subvolume.box.x1-subvolume.border), throttle=False )
-                else:
-                    return node_service.get_gray3D( str(gray_name),
-                                                    (size_z, size_y, size_x),
-                                                    (subvolume.box.z1-subvolume.border, subvolume.box.y1-subvolume.border, subvolume.box.x1-subvolume.border) )
+                with checkout_node_service(server, uuid, resource_server, resource_port) as node_service:
+                    def fetch_box(shape_zyx, offset_zyx):
+                        with dvid_token(dvid_tokens, 'read', np.prod(shape_zyx)):
+                            return node_service.get_gray3D( str(gray_name), shape_zyx, offset_zyx, throttle=throttle )
+
+                    if block_cache_bytes:
+                        fetch_box = cached_fetch_box( fetch_box, (server, uuid, gray_name), np.uint8, block_cache_bytes,
+                                                      block_cache_hits, block_cache_misses )
+
+                    if fetch_mode == "roi-blocks" and not subvolume.is_interior:
+                        return assemble_roi_blocks(fetch_box, subvolume, np.uint8)
+
+                    return fetch_box( (size_z, size_y, size_x),
+                                      subvolume.box_with_border[0:3] )
 
             gray_volume = get_gray()
 
             return (subvolume, gray_volume)
 
-        return distsubvolumes.mapValues(mapper)
+        return map_subvolume_values(distsubvolumes, mapper, prefetch, prefetch_max_bytes, 1)
 
-    def map_labels64(self, distrois, label_name, border, roiname=""):
+    def map_labels64(self, distrois, label_name, border, roiname="", fetch_mode="dense", compressed=False,
+                     prefetch=0, prefetch_max_bytes=2**30, block_cache_bytes=0):
         """Creates RDD of labelblk data from subvolumes.
 
         Note: Numpy arrays are compressed which leads to some savings.
@@ -307,55 +703,95 @@ class sparkdvid(object):
         Args:
             distrois (RDD): (subvolume id, subvolume)
             label_name (str): name of labelblk instance
-            border (int): size of substack border
+            border: size of substack border (int, or per-axis (z,y,x))
             roiname (str): name of the roi (to restrict fetch precisely)
-            compress (bool): true return compressed numpy
+            fetch_mode (str): "dense" fetches the whole subvolume box and
+                masks it with the ROI; "roi-blocks" fetches only the ROI
+                blocks that intersect each subvolume (requires roiname)
+            compressed (bool): if True, RDD values are CompressedLabelVolume
+                objects instead of numpy arrays.  Where no ROI masking is
+                needed, they hold DVID's lz4 payload without ever decompressing it.
+                (Only if a DVID token server is configured, since that request
+                can't be throttled by libdvid or by a resource server.)
+            prefetch (int): number of subvolumes to fetch ahead of the
+                downstream computation in each task (0 to disable)
+            prefetch_max_bytes (int): memory budget for prefetched subvolumes
+                (including the one being processed downstream)
+            block_cache_bytes (int): size of each executor's block cache
+                (see BlockCache), so that overlapping borders of neighboring
+                subvolumes are fetched only once (0 to disable).
+                Don't use this for labels that the workflow modifies.
 
         Returns:
             RDD of compressed lableblk data (partitioner perserved)
             (subvolume, label_comp)
     
         """
+        assert fetch_mode in ("dense", "roi-blocks")
+        assert fetch_mode == "dense" or roiname != "", \
+            "The roi-blocks fetch mode requires an ROI"
 
         # copy local context to minimize sent data
         server = self.dvid_server
         uuid = self.uuid
         resource_server = self.workflow.resource_server
         resource_port = self.workflow.resource_port
+        retry_counts = self.retry_counts
+        dvid_tokens = self.workflow.dvid_tokens
+        throttle = (resource_server == "" and dvid_tokens is None)
+        block_cache_hits = self.block_cache_hits
+        block_cache_misses = self.block_cache_misses
 
         def mapper(subvolume):
             # get sizes of box
-            size_x = subvolume.box.x2 + 2*subvolume.border - subvolume.box.x1
-            size_y = subvolume.box.y2 + 2*subvolume.border - subvolume.box.y1
-            size_z = subvolume.box.z2 + 2*subvolume.border - subvolume.box.z1
+            size_z, size_y, size_x = subvolume.shape_with_border
 
-            @auto_retry(3, pause_between_tries=60.0, logging_name=__name__)
+            needs_mask = (roiname != "" and not subvolume.is_interior)
+
+            @dvid_read_retry("map_labels64", retry_counts)
             def get_labels():
                 # extract labels 64
                 # retrieve data from box start position considering border
                 # Note: libdvid uses zyx order for python functions
-                node_service = retrieve_node_service(server, uuid, resource_server, resource_port)
-                if resource_server != "":
-                    data = node_service.get_labels3D( str(label_name),
-                                                      (size_z, size_y, size_x),
-                                                      (subvolume.box.z1-subvolume.border, subvolume.box.y1-subvolume.border, subvolume.box.x1-subvolume.border),
-                                                      compress=True, throttle=False )
-                else:
-                    data = node_service.get_labels3D( str(label_name),
-                                                      (size_z, size_y, size_x),
-                                                      (subvolume.box.z1-subvolume.border, subvolume.box.y1-subvolume.border, subvolume.box.x1-subvolume.border),
-                                                      compress=True )
-
-                # mask ROI
-                if roiname != "":
-                    mask_roi(data, subvolume, border=border)        
-
+                with checkout_node_service(server, uuid, resource_server, resource_port) as node_service:
+                    if compressed and not needs_mask and not block_cache_bytes and dvid_tokens is not None:
+                        # Keep the lz4 payload from the wire as-is
+                        # (Only with a token server: get_labels3D_lz4 isn't throttled by libdvid
+                        #  or by a resource server.)
+                        with dvid_token(dvid_tokens, 'read', 8*size_z*size_y*size_x):
+                            return get_labels3D_lz4( node_service, label_name,
+                                                     (size_z, size_y, size_x),
+                                                     subvolume.box_with_border[0:3] )
+
+                    def fetch_box(shape_zyx, offset_zyx):
+                        with dvid_token(dvid_tokens, 'read', 8*np.prod(shape_zyx)):
+                            return node_service.get_labels3D( str(label_name), shape_zyx, offset_zyx,
+                                                              compress=True, throttle=throttle )
+
+                    if block_cache_bytes:
+                        fetch_box = cached_fetch_box( fetch_box, (server, uuid, label_name), np.uint64, block_cache_bytes,
+                                                      block_cache_hits, block_cache_misses )
+
+                    if fetch_mode == "roi-blocks" and needs_mask:
+                        # Blocks outside the ROI are never fetched, so no masking is needed.
+                        data = assemble_roi_blocks(fetch_box, subvolume, np.uint64)
+                    else:
+                        data = fetch_box( (size_z, size_y, size_x),
+                                          subvolume.box_with_border[0:3] )
+
+                        # mask ROI
+                        if needs_mask:
+                            mask_roi(data, subvolume, border=border)        
+
+                if compressed:
+                    return CompressedLabelVolume.from_array(data)
                 return data
             return get_labels()
-        return distrois.mapValues(mapper)
+        return map_subvolume_values(distrois, mapper, prefetch, prefetch_max_bytes, 8)
 
     
-    def map_labels64_pair(self, distrois, label_name, dvidserver2, uuid2, label_name2, roiname=""):
+    def map_labels64_pair(self, distrois, label_name, dvidserver2, uuid2, label_name2, roiname="",
+                          prefetch=0, prefetch_max_bytes=2**30):
         """Creates RDD of two subvolumes (same ROI but different datasets)
 
         This functionality is used to compare two subvolumes.
@@ -369,11 +805,17 @@ class sparkdvid(object):
             uuid2 (str): dataset uuid version for label_name2
             label_name2 (str): name of labelblk instance
             roiname (str): name of the roi (to restrict fetch precisely)
+            prefetch (int): number of subvolumes to fetch ahead of the
+                downstream computation in each task (0 to disable)
+            prefetch_max_bytes (int): memory budget for prefetched subvolume pairs
+                (including the one being processed downstream)
 
         Returns:
             RDD of compressed lableblk, labelblk data (partitioner perserved).
             (subvolume, label1_comp, label2_comp)
 
+        Note: The two volumes are fetched concurrently, via fetch_thread_pool().
+
         """
 
         # copy local context to minimize sent data
@@ -382,6 +824,9 @@ class sparkdvid(object):
         uuid = self.uuid
         resource_server = self.workflow.resource_server
         resource_port = self.workflow.resource_port
+        retry_counts = self.retry_counts
+        dvid_tokens = self.workflow.dvid_tokens
+        throttle = (resource_server == "" and dvid_tokens is None)
 
         def mapper(subvolume):
             # get sizes of box
@@ -389,52 +834,51 @@ class sparkdvid(object):
             size_y = subvolume.box.y2 - subvolume.box.y1
             size_z = subvolume.box.z2 - subvolume.box.z1
 
-            @auto_retry(3, pause_between_tries=60.0, logging_name=__name__)
+            @dvid_read_retry("map_labels64_pair", retry_counts)
             def get_labels():
                 # extract labels 64
                 # retrieve data from box start position
                 # Note: libdvid uses zyx order for python functions
-                node_service = retrieve_node_service(server, uuid, resource_server, resource_port)
-                if resource_server != "":
-                    data = node_service.get_labels3D( str(label_name),
-                                                      (size_z, size_y, size_x),
-                                                      (subvolume.box.z1, subvolume.box.y1, subvolume.box.x1), throttle=False)
-                else:
+                with checkout_node_service(server, uuid, resource_server, resource_port) as node_service, \
+                        dvid_token(dvid_tokens, 'read', 8*size_z*size_y*size_x):
                     data = node_service.get_labels3D( str(label_name),
                                                       (size_z, size_y, size_x),
-                                                      (subvolume.box.z1, subvolume.box.y1, subvolume.box.x1))
+                                                      (subvolume.box.z1, subvolume.box.y1, subvolume.box.x1), throttle=throttle)
 
-
-                # mask ROI
+                # mask ROI (this data has no border)
                 if roiname != "":
-                    mask_roi(data, subvolume)        
+                    mask_roi(data, subvolume, border=0)
 
                 return data
-            label_volume = get_labels()
 
-            @auto_retry(3, pause_between_tries=60.0, logging_name=__name__)
+            @dvid_read_retry("map_labels64_pair[2]", retry_counts)
             def get_labels2():
                 # fetch second label volume
                 # retrieve data from box start position
                 # Note: libdvid uses zyx order for python functions
-                node_service2 = retrieve_node_service(server2, uuid2, resource_server, resource_port)
-                if resource_server != "":
+                with checkout_node_service(server2, uuid2, resource_server, resource_port) as node_service2, \
+                        dvid_token(dvid_tokens, 'read', 8*size_z*size_y*size_x):
                     return node_service2.get_labels3D( str(label_name2),
                                                        (size_z, size_y, size_x),
-                                                       (subvolume.box.z1, subvolume.box.y1, subvolume.box.x1), throttle=False)
-                else:
-                    return node_service2.get_labels3D( str(label_name2),
-                                                       (size_z, size_y, size_x),
-                                                       (subvolume.box.z1, subvolume.box.y1, subvolume.box.x1))
+                                                       (subvolume.box.z1, subvolume.box.y1, subvolume.box.x1), throttle=throttle)
+
+            # Issue both fetches concurrently (each one retries independently)
+            fetch_pool = fetch_thread_pool()
+            labels_result = fetch_pool.apply_async(get_labels)
+            labels2_result = fetch_pool.apply_async(get_labels2)
 
-            label_volume2 = get_labels2()
+            # Wait for both before raising, so no fetch outlives this task
+            labels_result.wait()
+            labels2_result.wait()
+            label_volume = labels_result.get()
+            label_volume2 = labels2_result.get()
 
             # zero out label_volume2 where GT is 0'd out !!
-            label_volume2[label_volume==0] = 0
+            zero_where_reference_zero(label_volume2, label_volume)
 
             return (subvolume, label_volume, label_volume2)
 
-        return distrois.mapValues(mapper)
+        return map_subvolume_values(distrois, mapper, prefetch, prefetch_max_bytes, 16)
 
 
     # foreach will write graph elements to DVID storage
@@ -462,6 +906,7 @@ class sparkdvid(object):
         uuid = self.uuid
         resource_server = self.workflow.resource_server
         resource_port = self.workflow.resource_port
+        dvid_tokens = self.workflow.dvid_tokens
         
         def writer(element_pairs):
             from libdvid import Vertex, Edge
@@ -483,10 +928,12 @@ class sparkdvid(object):
     
             node_service = retrieve_node_service(server, uuid, resource_server, resource_port)
             if len(vertices) > 0:
-                node_service.update_vertices(str(graph_name), vertices) 
+                with dvid_token(dvid_tokens, 'write', 16*len(vertices)):
+                    node_service.update_vertices(str(graph_name), vertices) 
             
             if len(edges) > 0:
-                node_service.update_edges(str(graph_name), edges) 
+                with dvid_token(dvid_tokens, 'write', 24*len(edges)):
+                    node_service.update_edges(str(graph_name), edges) 
             
             return []
 
@@ -494,7 +941,9 @@ class sparkdvid(object):
 
     # (key, (ROI, segmentation compressed+border))
     # => segmentation output in DVID
-    def foreach_write_labels3d(self, label_name, seg_chunks, roi_name=None, mutateseg="auto"):
+    def foreach_write_labels3d(self, label_name, seg_chunks, roi_name=None, mutateseg="auto",
+                               write_mode="per-subvolume", num_partitions=None, max_request_bytes=2**30,
+                               skip_zero_blocks=False):
         """Writes RDD of label volumes to DVID.
 
         For each subvolume ID, this function writes the subvolume
@@ -507,14 +956,29 @@ class sparkdvid(object):
             roi_name (str): restrict write to within this ROI
             mutateseg (str): overwrite previous seg ("auto", "yes", "no"
             "auto" will check existence of labels beforehand)
+            write_mode (str): "per-subvolume" issues one request per subvolume;
+                "coalesced" sorts the subvolumes by DVID block key (z,y,x),
+                merges neighbors along X into larger requests (see
+                coalesce_label_writes())
+            num_partitions (int): number of write tasks in "coalesced" mode
+                (default: same as seg_chunks)
+            max_request_bytes (int): maximum size of a merged request
+            skip_zero_blocks (bool): in "coalesced" mode, don't write all-zero
+                block columns.  Only safe if the labelblk has no data at these
+                subvolumes yet, i.e. the caller created it in this run.
+                (Also enabled if the labelblk is created by this function.)
 
         """
+        assert write_mode in ("per-subvolume", "coalesced")
 
         # copy local context to minimize sent data
         server = self.dvid_server
         uuid = self.uuid
         resource_server = self.workflow.resource_server
         resource_port = self.workflow.resource_port
+        retry_counts = self.retry_counts
+        dvid_tokens = self.workflow.dvid_tokens
+        throttle = (resource_server == "" and dvid_tokens is None)
 
         # create labels type
         node_service = retrieve_node_service(server, uuid, resource_server, resource_port)
@@ -525,47 +989,71 @@ class sparkdvid(object):
         if (not success and mutateseg == "auto") or mutateseg == "yes":
             mutate=True
 
-        def writer(subvolume_seg):
-            import numpy
-            # write segmentation
-            
-            (key, (subvolume, seg)) = subvolume_seg
+        def put_labels(seg, offset_zyx):
+            @dvid_write_retry("foreach_write_labels3d", retry_counts)
+            def put():
+                # send data from box start position
+                # Note: libdvid uses zyx order for python functions
+                with checkout_node_service(server, uuid, resource_server, resource_port) as node_service, \
+                        dvid_token(dvid_tokens, 'write', seg.nbytes):
+                    if roi_name is None:
+                        node_service.put_labels3D( str(label_name),
+                                                   seg,
+                                                   offset_zyx,
+                                                   compress=True, throttle=throttle,
+                                                   mutate=mutate )
+                    else: 
+                        node_service.put_labels3D( str(label_name),
+                                                   seg,
+                                                   offset_zyx,
+                                                   compress=True, throttle=throttle,
+                                                   roi=str(roi_name),
+                                                   mutate=mutate )
+            put()
+
+        def extract_seg(subvolume, seg):
             # get sizes of subvolume 
             size1 = subvolume.box.x2-subvolume.box.x1
             size2 = subvolume.box.y2-subvolume.box.y1
             size3 = subvolume.box.z2-subvolume.box.z1
 
-            border = subvolume.border
+            bz, by, bx = subvolume.border_zyx
 
             # extract seg ignoring borders (z,y,x)
-            seg = seg[border:size3+border, border:size2+border, border:size1+border]
+            return seg[bz:size3+bz, by:size2+by, bx:size1+bx]
+
+        def writer(subvolume_seg):
+            import numpy
+            # write segmentation
+            
+            (key, (subvolume, seg)) = subvolume_seg
+            seg = extract_seg(subvolume, seg)
 
             # copy the slice to make contiguous before sending 
             seg = numpy.copy(seg, order='C')
-
-            @auto_retry(3, pause_between_tries=600.0, logging_name= __name__)
-            def put_labels():
-                # send data from box start position
-                # Note: libdvid uses zyx order for python functions
-                node_service = retrieve_node_service(server, uuid, resource_server, resource_port)
-                
-                throttlev = True
-                if resource_server != "":
-                    throttlev = False
-                if roi_name is None:
-                    node_service.put_labels3D( str(label_name),
-                                               seg,
-                                               (subvolume.box.z1, subvolume.box.y1, subvolume.box.x1),
-                                               compress=True, throttle=throttlev,
-                                               mutate=mutate )
-                else: 
-                    node_service.put_labels3D( str(label_name),
-                                               seg,
-                                               (subvolume.box.z1, subvolume.box.y1, subvolume.box.x1),
-                                               compress=True, throttle=throttlev,
-                                               roi=str(roi_name),
-                                               mutate=mutate )
-            put_labels()
-
-        return seg_chunks.foreach(writer)
-
+            put_labels(seg, (subvolume.box.z1, subvolume.box.y1, subvolume.box.x1))
+
+        if write_mode == "per-subvolume":
+            return seg_chunks.foreach(writer)
+
+        # If the labelblk was just created, it has no data at our subvolumes yet,
+        # so skipping all-zero blocks leaves the same result in DVID.
+        # (An existing labelblk may hold old labels there, even when not mutating.)
+        skip_zero_blocks = (skip_zero_blocks or success) and not mutate
+
+        blocksize = self.BLK_SIZE
+        def coalesced_writer(sorted_subvolume_segs):
+            boxes_and_segs = ( ( (sv.box.z1, sv.box.y1, sv.box.x1, sv.box.z2, sv.box.y2, sv.box.x2),
+                                 extract_seg(sv, seg) )
+                               for (_key, (sv, seg)) in sorted_subvolume_segs )
+            for offset_zyx, seg in coalesce_label_writes(boxes_and_segs, max_request_bytes,
+                                                         skip_zero_blocks, blocksize):
+                put_labels(seg, offset_zyx)
+
+        # Key by block coordinate; sortByKey() range-partitions the keys,
+        # so neighboring subvolumes end up (in order) in the same partition.
+        def block_key( (_key, (subvolume, seg)) ):
+            return ((subvolume.box.z1, subvolume.box.y1, subvolume.box.x1), (subvolume, seg))
+
+        sorted_seg_chunks = seg_chunks.map(block_key).sortByKey(numPartitions=num_partitions)
+        return sorted_seg_chunks.foreachPartition(coalesced_writer)
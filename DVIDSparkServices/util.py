@@ -13,6 +13,18 @@ def bb_to_slicing(start, stop):
     """
     return tuple( starmap( slice, zip(start, stop) ) )
 
+def zyx_tuple(size):
+    """
+    Normalize a size (e.g. a chunk size or border width) that was given either
+    as a single int (isotropic) or as a per-axis (z,y,x) sequence.
+
+    Returns: (z, y, x) tuple of ints
+    """
+    if np.ndim(size) == 0:
+        return (int(size),) * 3
+    assert len(size) == 3, "Expected an int or a (z,y,x) sequence, not {}".format(size)
+    return tuple(int(s) for s in size)
+
 def boxlist_to_json( bounds_list, indent=0 ):
     # The 'json' module doesn't have nice pretty-printing options for our purposes,
     # so we'll do this ourselves.
@@ -52,19 +64,149 @@ def mkdir_p(path):
 class RoiMap(object):
     """
     Little utility class to help with ROI manipulations
+
+    The ROI mask (at block resolution) is stored sparsely, in cubic chunks
+    of chunk_width blocks (aligned to multiples of chunk_width):
+    chunks that don't intersect the ROI aren't stored at all, chunks that
+    lie entirely inside the ROI are stored as True, and only the remaining
+    (boundary) chunks hold a dense bool array.  So memory scales with the
+    ROI's occupancy (really, its surface), not with its bounding box.
+    (A dense mask of a 100k^3-pixel bounding box would need 30 GB.)
+
+    Use get_mask() to extract the mask for a region (block coords).
+    """
+
+    def __init__(self, roi_blocks, chunk_width=32):
+        """
+        roi_blocks: list of block coords [[Z,Y,X], ...]
+        chunk_width: width of the chunks the mask is stored in (in blocks)
+        """
+        coords = np.asarray(list(roi_blocks), dtype=np.int64).reshape((-1,3))
+        assert len(coords) > 0, "ROI is empty"
+        self._init_chunks(coords.min(axis=0), 1 + coords.max(axis=0), chunk_width)
+
+        # Group the coords by chunk
+        keys = coords // chunk_width
+        order = np.lexsort(keys.transpose()[::-1])
+        keys = keys[order]
+        coords = coords[order]
+        for group_start, group_stop in _group_bounds(keys):
+            key = keys[group_start]
+            self._fill_chunk( tuple(key), coords[group_start:group_stop] - key*chunk_width )
+
+    @classmethod
+    def from_runs(cls, roi_runs, chunk_width=32):
+        """
+        Construct a RoiMap directly from DVID's run-length encoded ROI,
+        i.e. an array of [[Z,Y,X1,X2], ...] runs (X2 inclusive),
+        without listing the individual block coordinates of the whole ROI.
+        """
+        roi_runs = np.asarray(roi_runs, dtype=np.int64).reshape((-1,4))
+        assert len(roi_runs) > 0, "ROI is empty"
+        blocks_start = np.min(roi_runs[:, (0,1,2)], axis=0)
+        blocks_stop = 1 + np.max(roi_runs[:, (0,1,3)], axis=0)
+
+        roi_map = cls.__new__(cls)
+        roi_map._init_chunks(blocks_start, blocks_stop, chunk_width)
+
+        # Split the runs at chunk boundaries, so each run lies within one chunk.
+        split_runs = []
+        while len(roi_runs):
+            chunk_last_x = (roi_runs[:, 2] // chunk_width + 1) * chunk_width - 1
+            crosses = roi_runs[:, 3] > chunk_last_x
+            head = roi_runs.copy()
+            head[crosses, 3] = chunk_last_x[crosses]
+            split_runs.append(head)
+            roi_runs = roi_runs[crosses]
+            roi_runs[:, 2] = chunk_last_x[crosses] + 1
+        roi_runs = np.concatenate(split_runs)
+
+        # Group the runs by chunk, and decode one chunk at a time.
+        keys = roi_runs[:, 0:3] // chunk_width
+        order = np.lexsort(keys.transpose()[::-1])
+        keys = keys[order]
+        roi_runs = roi_runs[order]
+        for group_start, group_stop in _group_bounds(keys):
+            key = keys[group_start]
+            coords = runlength_decode(roi_runs[group_start:group_stop])
+            roi_map._fill_chunk( tuple(key), coords - key*chunk_width )
+        return roi_map
+
+    def _init_chunks(self, blocks_start, blocks_stop, chunk_width):
+        self.chunk_width = chunk_width
+        self.blocks_start = np.asarray(blocks_start)
+        self.blocks_stop = np.asarray(blocks_stop)
+        self.blocks_shape = self.blocks_stop - self.blocks_start
+
+        # { chunk coord (block coord // chunk_width): True or bool array }
+        self._chunks = {}
+
+    def _fill_chunk(self, key, local_coords):
+        w = self.chunk_width
+        chunk = np.zeros((w,w,w), dtype=bool)
+        chunk[tuple(local_coords.transpose())] = True
+        if chunk.all():
+            chunk = True
+        self._chunks[key] = chunk
+
+    def get_mask(self, start, stop):
+        """
+        Return the (dense) ROI mask for the given region,
+        (start, stop) in block coordinates.
+        The region need not lie within the ROI's bounding box.
+        """
+        start = np.asarray(start, dtype=np.int64)
+        stop = np.asarray(stop, dtype=np.int64)
+        mask = np.zeros( np.maximum(stop - start, 0), dtype=bool )
+        if (stop <= start).any():
+            return mask
+
+        w = self.chunk_width
+        chunks_start = start // w
+        chunks_stop = (stop - 1) // w + 1
+        if np.prod(chunks_stop - chunks_start) <= len(self._chunks):
+            keys = ( tuple(chunks_start + c) for c in np.ndindex(*(chunks_stop - chunks_start)) )
+            keys = filter(self._chunks.__contains__, keys)
+        else:
+            keys = [ key for key in self._chunks
+                     if (chunks_start <= key).all() and (key < chunks_stop).all() ]
+
+        for key in keys:
+            chunk = self._chunks[key]
+            chunk_start = np.array(key) * w
+            overlap_start = np.maximum(start, chunk_start)
+            overlap_stop = np.minimum(stop, chunk_start + w)
+            if chunk is True:
+                mask[bb_to_slicing(overlap_start - start, overlap_stop - start)] = True
+            else:
+                mask[bb_to_slicing(overlap_start - start, overlap_stop - start)] = \
+                    chunk[bb_to_slicing(overlap_start - chunk_start, overlap_stop - chunk_start)]
+        return mask
+
+    @property
+    def block_mask(self):
+        """
+        Read-only property.
+        Dense mask of the ROI's entire bounding box (starting at blocks_start).
+        Note: For large ROIs, this is expensive.  Use get_mask() instead.
+        """
+        return self.get_mask(self.blocks_start, self.blocks_stop)
+
+    @property
+    def nbytes(self):
+        """Bytes used by the stored chunks."""
+        return sum( chunk.nbytes for chunk in self._chunks.values() if chunk is not True )
+
+def _group_bounds(sorted_keys):
+    """
+    Given an array of (lexicographically) sorted keys (one per row),
+    return the (start, stop) of each run of identical keys.
     """
-    def __init__(self, roi_blocks):
-        # Make a map of the entire ROI
-        # Since roi blocks are 32^2, this won't be too huge.
-        # For example, a ROI that's 10k*10k*100k pixels, this will be ~300 MB
-        # For a 100k^3 ROI, this will be 30 GB (still small enough to fit in RAM on the driver)
-        block_mask, (blocks_start, blocks_stop) = coordlist_to_boolmap(roi_blocks)
-        blocks_shape = blocks_stop - blocks_start
-
-        self.block_mask = block_mask
-        self.blocks_start = blocks_start
-        self.blocks_stop = blocks_stop
-        self.blocks_shape = blocks_shape
+    if len(sorted_keys) == 0:
+        return []
+    bounds = 1 + np.flatnonzero( (np.diff(sorted_keys, axis=0) != 0).any(axis=1) )
+    bounds = np.concatenate(([0], bounds, [len(sorted_keys)]))
+    return zip(bounds[:-1], bounds[1:])
         
 
 def coordlist_to_boolmap(coordlist, bounding_box=None):
@@ -124,37 +266,35 @@ def dense_roi_mask_for_subvolume(subvolume, border='default'):
     Return a dense (pixel-level) mask for the given subvolume,
     according to the ROI blocks it lists in its 'intersecting_blocks' member.
     
-    border: How much border to incorporate into the mask beyond the subvolume's own bounding box.
-            By default, just use the subvolume's own 'border' attribute.
+    border: How much border to incorporate into the mask beyond the subvolume's own bounding box,
+            either an int or per-axis (z,y,x).
+            By default, just use the subvolume's own border (border_zyx).
+
+    Note: To mask a volume, use mask_roi() instead, which never needs a pixel-level mask.
+    """
+    start_px, stop_px = _roi_mask_box(subvolume, border)
+    mask = np.ones(stop_px - start_px, dtype=bool)
+    mask_roi(mask, subvolume, border)
+    return mask
+
+def _roi_mask_box(subvolume, border):
+    """
+    Helper for mask_roi() and dense_roi_mask_for_subvolume():
+    Return the subvolume's bounding box (start, stop) in pixels, expanded by the given border.
     """
     sv = subvolume
-    if border == 'default':
-        border = sv.border
+    if isinstance(border, str) and border == 'default':
+        border = np.array(sv.border_zyx)
     else:
-        assert border <= sv.border, \
+        border = np.array(zyx_tuple(border))
+        assert (border <= sv.border_zyx).all(), \
             "Subvolumes don't store ROI blocks outside of their known border "\
             "region, so I can't produce a mask outside that area."
     
-    # subvol bounding box/shape (not block-aligned)
+    # subvol bounding box (not block-aligned)
     sv_start_px = np.array((sv.box.z1, sv.box.y1, sv.box.x1)) - border
     sv_stop_px  = np.array((sv.box.z2, sv.box.y2, sv.box.x2)) + border
-    sv_shape_px = sv_stop_px - sv_start_px
-    
-    # subvol bounding box/shape in block coordinates
-    sv_start_blocks = sv_start_px // sv.roi_blocksize
-    sv_stop_blocks = (sv_stop_px + sv.roi_blocksize-1) // sv.roi_blocksize
-
-    intersecting_block_mask, _ = coordlist_to_boolmap(sv.intersecting_blocks, (sv_start_blocks, sv_stop_blocks))
-    intersecting_dense = block_mask_to_px_mask(intersecting_block_mask, sv.roi_blocksize)
-
-    # bounding box of the sv dense coordinates within the block-aligned intersecting_dense
-    dense_start = sv_start_px % sv.roi_blocksize
-    dense_stop = dense_start + sv_shape_px
-    
-    # Extract the pixels we want from the (block-aligned) intersecting_dense
-    sv_intersecting_dense = intersecting_dense[bb_to_slicing(dense_start, dense_stop)]
-    assert sv_intersecting_dense.shape == tuple(sv_shape_px)
-    return sv_intersecting_dense
+    return sv_start_px, sv_stop_px
 
 def runlength_encode(coord_list_zyx, assume_sorted=False):
     """
@@ -186,9 +326,12 @@ def runlength_encode(coord_list_zyx, assume_sorted=False):
     
     Timing notes:
         The FIB-25 'seven_column_roi' consists of 927971 block indices.
-        On that ROI, this function takes 1.65 seconds, but with numba installed,
-        it takes 35 ms (after ~400 ms warmup).
-        So, JIT speedup is ~45x.
+        On that ROI, the original (pure python) loop took 1.65 seconds,
+        or 35 ms with numba installed (after ~400 ms warmup).
+        This implementation is vectorized and needs no JIT:
+        on a synthetic ROI of the same size (933044 shuffled block indices),
+        it takes 0.18 seconds, vs. 2.1 seconds for the old loop.
+        (Most of that is sorting; with assume_sorted, it takes ~70 ms.)
     """
     coord_list_zyx = np.asarray(coord_list_zyx)
     assert coord_list_zyx.ndim == 2
@@ -197,13 +340,28 @@ def runlength_encode(coord_list_zyx, assume_sorted=False):
         return np.ndarray( (0,4), np.int64 )
     
     if not assume_sorted:
-        sorting_ind = np.lexsort(coord_list_zyx.transpose()[::-1])
-        coord_list_zyx = coord_list_zyx[sorting_ind]
+        coord_list_zyx = _sort_coords_zyx(coord_list_zyx)
 
     return _runlength_encode(coord_list_zyx)
 
-# See conditional jit activation, below
-#@numba.jit(nopython=True)
+def _sort_coords_zyx(coord_list_zyx):
+    """
+    Helper for runlength_encode():
+    Sort the given coordinates in Z-Y-X order.
+    
+    Sorting a single (raveled) int64 key is much faster than np.lexsort() on three keys,
+    so that's what we do, unless the coords' bounding box is too large to ravel.
+    """
+    coord_list_zyx = np.asarray(coord_list_zyx, dtype=np.int64)
+    start = coord_list_zyx.min(axis=0)
+    shape = coord_list_zyx.max(axis=0) - start + 1
+    if np.prod(shape.astype(np.float64)) >= 2**62:
+        return coord_list_zyx[np.lexsort(coord_list_zyx.transpose()[::-1])]
+
+    keys = np.ravel_multi_index( tuple((coord_list_zyx - start).transpose()), shape )
+    keys.sort()
+    return np.transpose( np.unravel_index(keys, shape) ) + start
+
 def _runlength_encode(coord_list_zyx):
     """
     Helper function for runlength_encode(), above.
@@ -212,51 +370,274 @@ def _runlength_encode(coord_list_zyx):
         Array of shape (N,3), of form [[Z,Y,X], [Z,Y,X], ...],
         pre-sorted in Z-Y-X order.  Duplicates permitted.
     """
-    # Numba doesn't allow us to use empty lists at all,
-    # so we have to initialize this list with a dummy row,
-    # which we'll omit in the return value
-    runs = [0,0,0,0]
-    
-    # Start the first run
-    (prev_z, prev_y, prev_x) = current_run_start = coord_list_zyx[0]
-    
-    for i in range(1, len(coord_list_zyx)):
-        (z,y,x) = coord = coord_list_zyx[i]
+    coord_list_zyx = np.asarray(coord_list_zyx, dtype=np.int64)
+    steps = np.diff(coord_list_zyx, axis=0)
+
+    # Drop duplicates
+    is_new = np.concatenate(( [True], steps.any(axis=1) ))
+    coord_list_zyx = coord_list_zyx[is_new]
+    steps = np.diff(coord_list_zyx, axis=0)
 
-        # If necessary, end the current run and start a new one
-        # (Also, support duplicate coords without breaking the current run.)
-        if (z != prev_z) or (y != prev_y) or (x not in (prev_x, 1+prev_x)):
-            runs += list(current_run_start) + [prev_x]
-            current_run_start = coord
+    # A run ends wherever Z or Y changes, or X doesn't advance by exactly 1.
+    run_breaks = (steps[:,0] != 0) | (steps[:,1] != 0) | (steps[:,2] != 1)
+    run_firsts = np.concatenate(( [0], 1 + np.flatnonzero(run_breaks) ))
+    run_lasts = np.concatenate(( run_firsts[1:] - 1, [len(coord_list_zyx) - 1] ))
 
-        (prev_z, prev_y, prev_x) = (z,y,x)
+    runs = np.empty( (len(run_firsts), 4), dtype=np.int64 )
+    runs[:, :3] = coord_list_zyx[run_firsts]
+    runs[:, 3] = coord_list_zyx[run_lasts, 2]
+    return runs
 
-    # End the last run
-    runs += list(current_run_start) + [prev_x]
+def runlength_decode(runs_zyx):
+    """
+    Inverse of runlength_encode():
+    Given an array of runs [[Z,Y,X1,X2], ...] (X2 INCLUSIVE),
+    return the array of coordinates [[Z,Y,X], ...] they cover, in the same order.
+    """
+    runs_zyx = np.asarray(runs_zyx, dtype=np.int64).reshape((-1,4))
+    lengths = runs_zyx[:,3] - runs_zyx[:,2] + 1
+    assert (lengths > 0).all(), "Invalid runs: X2 < X1"
 
-    # Return as 2D array
-    runs = np.array(runs).reshape((-1,4))
-    return runs[1:, :] # omit dummy row (see above)
+    # Position of each coordinate within its run
+    run_starts = np.cumsum(lengths) - lengths
+    offsets = np.arange(lengths.sum()) - np.repeat(run_starts, lengths)
 
-# Enable JIT if numba is available
-try:
-    import numba
-    _runlength_encode = numba.jit(nopython=True)(_runlength_encode)
-except ImportError:
-    pass
+    coords = np.repeat(runs_zyx[:, :3], lengths, axis=0)
+    coords[:,2] += offsets
+    return coords
 
 
+def zorder_index(coords_zyx):
+    """
+    Return the Z-order (Morton) index of each of the given coordinates,
+    i.e. the bits of Z, Y, and X interleaved (Z most significant).
+    Sorting by this index keeps nearby coordinates close together.
+    
+    coords_zyx: Array of shape (N,3), non-negative, less than 2**21
+    
+    Returns: uint64 array of shape (N,)
+    """
+    coords_zyx = np.asarray(coords_zyx, dtype=np.uint64).reshape((-1,3))
+    assert (coords_zyx < 2**21).all(), "Coordinates are too large for a 64-bit Z-order index"
+
+    def spread_bits(v):
+        # Insert two 0-bits between each of the (21) low bits of v
+        v = v & np.uint64(0x1fffff)
+        v = (v | (v << np.uint64(32))) & np.uint64(0x1f00000000ffff)
+        v = (v | (v << np.uint64(16))) & np.uint64(0x1f0000ff0000ff)
+        v = (v | (v << np.uint64(8)))  & np.uint64(0x100f00f00f00f00f)
+        v = (v | (v << np.uint64(4)))  & np.uint64(0x10c30c30c30c30c3)
+        v = (v | (v << np.uint64(2)))  & np.uint64(0x1249249249249249)
+        return v
+
+    z, y, x = coords_zyx.transpose()
+    return (spread_bits(z) << np.uint64(2)) | (spread_bits(y) << np.uint64(1)) | spread_bits(x)
+
+def pack_bins(costs, num_bins):
+    """
+    Assign items to bins so that the bins' total costs are balanced,
+    using the greedy "longest processing time first" heuristic:
+    each item, heaviest first, goes into the bin with the least total cost so far.
+    
+    Returns: list of num_bins lists of item indexes.
+             Within each bin, the items are listed heaviest first,
+             and the bins themselves are sorted heaviest first.
+    """
+    import heapq
+    costs = np.asarray(costs, dtype=np.float64)
+    assert num_bins >= 1
+    bins = [[] for _ in range(num_bins)]
+    bin_heap = [(0.0, b) for b in range(num_bins)]
+    for i in np.argsort(-costs, kind='mergesort'):
+        total, b = heapq.heappop(bin_heap)
+        bins[b].append(i)
+        heapq.heappush(bin_heap, (total + costs[i], b))
+
+    totals = [sum(costs[i] for i in items) for items in bins]
+    return [bins[b] for b in sorted(range(num_bins), key=lambda b: -totals[b])]
+
+def split_by_cost(costs, num_bins):
+    """
+    Split a sequence of items into num_bins contiguous runs of roughly equal total cost.
+    (Unlike pack_bins(), this keeps the items' order, e.g. a spatial ordering.)
+    
+    Returns: list of num_bins (start, stop) index ranges (some may be empty)
+    """
+    costs = np.asarray(costs, dtype=np.float64)
+    assert num_bins >= 1
+    if len(costs) == 0:
+        return [(0, 0)] * num_bins
+
+    # prefix[i] is the total cost of items [0, i)
+    prefix = np.concatenate(([0.0], np.cumsum(costs)))
+    targets = prefix[-1] * np.arange(1, num_bins) / num_bins
+
+    # Each run ends at the item boundary closest to the next multiple of total/num_bins
+    after = np.searchsorted(prefix, targets).clip(1, len(prefix)-1)
+    before = after - 1
+    stops = np.where(targets - prefix[before] <= prefix[after] - targets, before, after)
+    stops = np.maximum.accumulate(stops)
+
+    bounds = np.concatenate(([0], stops, [len(costs)])).astype(int)
+    return list(zip(bounds[:-1], bounds[1:]))
+
 def mask_roi(data, subvolume, border='default'):
     """
     masks data to 0 if outside of ROI stored in subvolume
     
+    Interior subvolumes (entirely within the ROI) are left untouched.
+    Otherwise, the data is zeroed one run of (non-ROI) blocks at a time,
+    so no pixel-level mask is ever allocated.
+
+    border: How much border the data includes beyond the subvolume's own bounding box
+            (see dense_roi_mask_for_subvolume())
+
     Note: This function operates on data IN-PLACE
     """
-    mask = dense_roi_mask_for_subvolume(subvolume, border)
-    assert data.shape == mask.shape
-    data[np.logical_not(mask)] = 0
+    sv = subvolume
+    sv_start_px, sv_stop_px = _roi_mask_box(sv, border)
+    assert data.shape == tuple(sv_stop_px - sv_start_px)
+    if sv.is_interior:
+        return None
+
+    # The subvolume's block mask, cropped to the blocks this data touches
+    bs = sv.roi_blocksize
+    sv_start_blocks = sv_start_px // bs
+    sv_stop_blocks = (sv_stop_px + bs - 1) // bs
+    window_start, _window_stop = sv.block_window
+    outside_roi = np.logical_not( sv.intersecting_block_mask[bb_to_slicing(sv_start_blocks - window_start,
+                                                                            sv_stop_blocks - window_start)] )
+    if not outside_roi.any():
+        return None
+
+    # Pixel bounds of each block along each axis, relative to the data (clipped to the data)
+    z_bounds, y_bounds, x_bounds = [ np.clip( bs*np.arange(block_start, block_stop+1) - px_start, 0, width )
+                                     for (block_start, block_stop, px_start, width)
+                                     in zip(sv_start_blocks, sv_stop_blocks, sv_start_px, data.shape) ]
+
+    # Zero each run of non-ROI blocks along X
+    for bz, by in np.transpose( outside_roi.any(axis=2).nonzero() ):
+        edges = np.diff( np.concatenate(([0], outside_roi[bz, by].view(np.int8), [0])) )
+        for bx_start, bx_stop in zip( np.flatnonzero(edges == 1), np.flatnonzero(edges == -1) ):
+            data[ z_bounds[bz]:z_bounds[bz+1],
+                  y_bounds[by]:y_bounds[by+1],
+                  x_bounds[bx_start]:x_bounds[bx_stop] ] = 0
     return None # Emphasize in-place behavior
 
+def zero_where_reference_zero(data, reference):
+    """
+    Set data to 0 wherever reference is 0.
+    
+    Equivalent to data[reference == 0] = 0, but the mask is computed
+    one slice at a time, so no full-size temporary is allocated.
+
+    Note: This function operates on data IN-PLACE
+    """
+    assert data.shape == reference.shape
+    if data.ndim <= 2:
+        data[reference == 0] = 0
+        return None
+
+    for data_slice, reference_slice in zip(data, reference):
+        data_slice[reference_slice == 0] = 0
+    return None # Emphasize in-place behavior
+
+
+def prefetch_map(func, items, max_prefetch=2, max_bytes=None, nbytes_estimate=None):
+    """
+    Like itertools.imap(func, items), but func is applied in a background thread,
+    which runs ahead of the consumer by up to max_prefetch items.
+    Useful in mapPartitions(), to fetch the next items while the current one is processed.
+    
+    max_bytes: (Optional) Limit the results in memory to this many bytes, according to
+               nbytes_estimate.  That includes the result the consumer is currently
+               processing (until it asks for the next one), as well as results that
+               are computed or being computed, but not yet consumed.
+               (At least one result is always permitted, regardless of its size.)
+    
+    nbytes_estimate: (Optional) Function item -> expected size of func(item), in bytes.
+    
+    Exceptions raised by func (or by iterating over items) are re-raised in the consumer.
+    If the consumer stops early, the background thread stops after its current item.
+    
+    >>> rdd.mapPartitions(lambda part: prefetch_map(fetch, part, 4), preservesPartitioning=True)
+    """
+    import sys
+    import threading
+    from collections import deque
+
+    assert max_prefetch >= 1
+    finished = deque() # (result, nbytes, exc_info)
+    cond = threading.Condition()
+    # 'pending' and 'pending_bytes' include the result held by the consumer (if 'held')
+    state = { 'pending': 0, 'pending_bytes': 0, 'held': 0, 'done': False, 'stop': False }
+
+    def has_room(nbytes):
+        if state['pending'] == 0:
+            return True
+        if state['pending'] - state['held'] >= max_prefetch:
+            return False
+        return max_bytes is None or state['pending_bytes'] + nbytes <= max_bytes
+
+    def produce():
+        try:
+            for item in items:
+                nbytes = 0
+                if nbytes_estimate is not None:
+                    nbytes = nbytes_estimate(item)
+                with cond:
+                    while not state['stop'] and not has_room(nbytes):
+                        cond.wait()
+                    if state['stop']:
+                        return
+                    state['pending'] += 1
+                    state['pending_bytes'] += nbytes
+
+                result = func(item)
+                with cond:
+                    finished.append( (result, nbytes, None) )
+                    cond.notify_all()
+        except:
+            with cond:
+                state['pending'] += 1
+                finished.append( (None, 0, sys.exc_info()) )
+        finally:
+            with cond:
+                state['done'] = True
+                cond.notify_all()
+
+    producer = threading.Thread(target=produce, name="prefetch_map")
+    producer.daemon = True
+    producer.start()
+
+    try:
+        while True:
+            with cond:
+                while not finished and not state['done']:
+                    cond.wait()
+                if not finished:
+                    return
+                result, nbytes, exc_info = finished.popleft()
+                # No longer ahead of the consumer, but still in memory
+                state['held'] = 1
+                cond.notify_all()
+
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            yield result
+            del result # Don't hold on to the result while waiting for the next one
+
+            # The consumer is done with the previous result
+            with cond:
+                state['held'] = 0
+                state['pending'] -= 1
+                state['pending_bytes'] -= nbytes
+                cond.notify_all()
+    finally:
+        with cond:
+            state['stop'] = True
+            cond.notify_all()
+
 
 def select_item(rdd, *indexes):
     """
@@ -27,6 +27,30 @@ class Workflow(object):
 
     """
 
+    # options shared by all workflows (merged into each workflow's "options")
+    OptionsSchema = """
+{
+  "dvid-max-reads": {
+    "description": "Maximum concurrent DVID read requests across the cluster, coordinated by a token server on the driver (0 -- no limit).  Ignored if a resource server is given.",
+    "type": "integer",
+    "minimum": 0,
+    "default": 0
+  },
+  "dvid-max-writes": {
+    "description": "Maximum concurrent DVID write requests across the cluster (0 -- no limit).  Ignored if a resource server is given.",
+    "type": "integer",
+    "minimum": 0,
+    "default": 0
+  },
+  "dvid-max-bytes-in-flight": {
+    "description": "Maximum bytes being read (and, separately, written) from DVID across the cluster (0 -- no limit).  Ignored if a resource server is given.",
+    "type": "integer",
+    "minimum": 0,
+    "default": 0
+  }
+}
+"""
+
     def __init__(self, jsonfile, schema, appname, corespertask=1):
         """Initialization of workflow object.
 
@@ -39,6 +63,11 @@ class Workflow(object):
 
         self.config_data = None
         schema_data = json.loads(schema)
+        options_schema = schema_data.get("properties", {}).get("options")
+        if options_schema is not None:
+            options_properties = options_schema.setdefault("properties", {})
+            for name, option in json.loads(self.OptionsSchema).items():
+                options_properties.setdefault(name, option)
 
         if jsonfile.startswith('http'):
             try:
@@ -64,6 +93,10 @@ class Workflow(object):
         self.corespertask=corespertask
         self.sc = self._init_spark(appname)
 
+        # coordinate DVID access from the driver (if requested)
+        self.dvid_token_server = None
+        self.dvid_tokens = None
+        self._init_dvid_tokens()
 
 
     def _init_spark(self, appname):
@@ -103,6 +136,9 @@ class Workflow(object):
             self.resource_server = str(self.config_data["options"]["resource-server"])
             self.resource_port = int(self.config_data["options"]["resource-port"])
 
+        # optional directory for caching ROIs fetched from DVID (see sparkdvid.get_roi_runs)
+        self.roi_cache_dir = str(self.config_data["options"].get("roi-cache-dir", ""))
+
         # currently using LZ4 compression: should not degrade runtime much
         # but will help with some operations like shuffling, especially when
         # dealing with things object like highly compressible label volumes
@@ -110,10 +146,60 @@ class Workflow(object):
         worker_env = {}
         if "DVIDSPARK_WORKFLOW_TMPDIR" in os.environ and os.environ["DVIDSPARK_WORKFLOW_TMPDIR"]:
             worker_env["DVIDSPARK_WORKFLOW_TMPDIR"] = os.environ["DVIDSPARK_WORKFLOW_TMPDIR"]
+
+        # optional per-dtype codecs for pickled numpy arrays (see CompressedNumpyArray)
+        numpy_codecs = self.config_data["options"].get("numpy-codecs", {})
+        if numpy_codecs:
+            from DVIDSparkServices.sparkdvid.CompressedNumpyArray import set_default_codecs
+            set_default_codecs(numpy_codecs)
+            worker_env["DVIDSPARK_NUMPY_CODECS"] = json.dumps(numpy_codecs)
+
+        # use all of a task's cores to (de)compress pickled numpy arrays
+        worker_env["DVIDSPARK_NUMPY_THREADS"] = str(corespertask)
         
+        # optionally send numpy arrays out of band, rather than pickled (see NumpyFramedSerializer)
+        serializer_name = self.config_data["options"].get("spark-serializer", "pickle")
+        serializer_kwargs = {}
+        if serializer_name in ("numpy-raw", "numpy-compressed"):
+            from DVIDSparkServices.sparkdvid.NumpyFramedSerializer import NumpyFramedSerializer
+            serializer_kwargs["serializer"] = NumpyFramedSerializer(compress=(serializer_name == "numpy-compressed"))
+        elif serializer_name == "columnar-lz4":
+            # for shuffles of many small keyed records (see ColumnarSerializerLZ4)
+            from DVIDSparkServices.sparkdvid.ColumnarSerializerLZ4 import ColumnarSerializerLZ4
+            serializer_kwargs["serializer"] = ColumnarSerializerLZ4()
+        else:
+            assert serializer_name == "pickle", "Unknown spark-serializer: {}".format(serializer_name)
+
         # Auto-batching heuristic doesn't work well with our auto-compressed numpy array pickling scheme.
         # Therefore, disable batching with batchSize=1
-        return SparkContext(conf=sconfig, batchSize=1, environment=worker_env)
+        # (This also lets NumpyFramedSerializer write each record's array buffers without joining them.)
+        return SparkContext(conf=sconfig, batchSize=1, environment=worker_env, **serializer_kwargs)
+
+    def _init_dvid_tokens(self):
+        """Internal function to start a DVID token server on the driver
+
+        If any of the "dvid-max-reads", "dvid-max-writes", or
+        "dvid-max-bytes-in-flight" options is non-zero (and no resource
+        server is given), sparkdvid readers and writers take a token from
+        this server before each DVID request (see TokenService).
+        A limit of 0 means no limit.
+
+        """
+        options = self.config_data.get("options", {})
+        max_reads, max_writes, max_bytes = [ int(options.get(opt, 0)) or None
+                                             for opt in ("dvid-max-reads",
+                                                         "dvid-max-writes",
+                                                         "dvid-max-bytes-in-flight") ]
+        if self.resource_server != "" or (max_reads, max_writes, max_bytes) == (None, None, None):
+            return
+
+        from DVIDSparkServices.sparkdvid.TokenService import TokenServer
+        self.dvid_token_server = TokenServer(max_reads, max_writes, max_bytes)
+        self.dvid_token_server.start()
+
+        import socket
+        driver_host = self.sc.getConf().get("spark.driver.host", socket.getfqdn())
+        self.dvid_tokens = (driver_host, self.dvid_token_server.port)
 
     # make this an explicit abstract method ??
     def execute(self):
@@ -1,5 +1,5 @@
 import unittest
-from DVIDSparkServices.auto_retry import auto_retry
+from DVIDSparkServices.auto_retry import auto_retry, RetryCountsParam
 
 class TestAutoRetry(unittest.TestCase):
 
@@ -28,5 +28,42 @@ class TestAutoRetry(unittest.TestCase):
         except AssertionError:
             assert False, "should_succeed() didn't succeed!"
 
+    def test_not_retryable(self):
+        calls = []
+        @auto_retry(3, 0.0, is_retryable=lambda ex: not isinstance(ex, ValueError))
+        def bad_request():
+            calls.append(1)
+            raise ValueError("400 bad request")
+
+        with self.assertRaises(ValueError):
+            bad_request()
+        assert len(calls) == 1
+
+    def test_max_total_pause(self):
+        # The second pause (0.01 * 10) would exceed the total budget
+        should_fail = auto_retry(5, 0.01, backoff_factor=10.0, max_total_pause=0.05)(self._check_counter)
+        with self.assertRaises(AssertionError):
+            should_fail()
+        assert self.COUNTER == 1
+
+    def test_retry_counts(self):
+        class FakeAccumulator(object):
+            def __init__(self):
+                self.param = RetryCountsParam()
+                self.value = self.param.zero({})
+            def add(self, term):
+                self.value = self.param.addInPlace(self.value, term)
+
+        counts = FakeAccumulator()
+        should_succeed = auto_retry(3, 0.0, jitter=0.5, retry_counts=counts, call_site='check')(self._check_counter)
+        should_succeed()
+        assert counts.value == { ('check', 'retry'): 2 }
+
+        self.COUNTER = 3
+        should_fail = auto_retry(2, 0.0, retry_counts=counts, call_site='check')(self._check_counter)
+        with self.assertRaises(AssertionError):
+            should_fail()
+        assert counts.value == { ('check', 'retry'): 3, ('check', 'exhausted'): 1 }
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,81 @@
+import numpy as np
+from DVIDSparkServices.util import bb_to_slicing
+from DVIDSparkServices.sparkdvid.BlockCache import BlockCache
+
+class _Counter(object):
+    def __init__(self):
+        self.value = 0
+    def add(self, n):
+        self.value += n
+
+def _make_fetcher(full_volume, offset):
+    requests = []
+    def fetch_box(shape_zyx, offset_zyx):
+        requests.append((shape_zyx, offset_zyx))
+        start = np.array(offset_zyx) - offset
+        return full_volume[bb_to_slicing(start, start + shape_zyx)]
+    return fetch_box, requests
+
+def test_neighboring_boxes():
+    # Volume covers [-64, 192) in each dimension
+    full_volume = np.random.randint(0, 255, size=(256,256,256)).astype(np.uint8)
+    fetch_box, requests = _make_fetcher(full_volume, -64)
+    cache = BlockCache(2**30)
+    hits = _Counter()
+    misses = _Counter()
+
+    def get(start, stop):
+        start = np.array(start)
+        stop = np.array(stop)
+        box = cache.get_box(fetch_box, ('emdata:8000', 'abc123', 'grayscale'),
+                            tuple(stop - start), tuple(start), np.uint8, hits, misses)
+        expected = full_volume[bb_to_slicing(start + 64, stop + 64)]
+        assert box.shape == expected.shape
+        assert box.flags['C_CONTIGUOUS']
+        assert (box == expected).all()
+
+    # Two neighboring subvolumes (64 wide, with 10 voxel borders)
+    get((-10, -10, -10), (74, 74, 74))
+    assert requests == [((128, 128, 128), (-32, -32, -32))]
+    assert misses.value == 64
+    assert hits.value == 0
+
+    get((-10, -10, 54), (74, 74, 138))
+    # Only the blocks that weren't fetched already
+    assert requests[1] == ((128, 128, 64), (-32, -32, 96))
+    assert hits.value == 32
+    assert misses.value == 64 + 32
+
+    stats = cache.stats()
+    assert stats["blocks"] == 96
+    assert stats["bytes"] == 96 * 32**3
+
+def test_eviction():
+    full_volume = np.random.randint(0, 255, size=(32,32,256)).astype(np.uint8)
+    fetch_box, requests = _make_fetcher(full_volume, 0)
+
+    # Room for 4 blocks only
+    cache = BlockCache(4 * 32**3)
+    for x in (0, 64, 128):
+        cache.get_box(fetch_box, 'gray', (32, 32, 64), (0,0,x), np.uint8)
+    stats = cache.stats()
+    assert stats["blocks"] == 4
+    assert stats["evictions"] == 2
+
+    # The most recent blocks are still cached; the oldest ones are not.
+    cache.get_box(fetch_box, 'gray', (32, 32, 64), (0,0,128), np.uint8)
+    cache.get_box(fetch_box, 'gray', (32, 32, 64), (0,0,64), np.uint8)
+    assert len(requests) == 3
+    cache.get_box(fetch_box, 'gray', (32, 32, 32), (0,0,0), np.uint8)
+    assert len(requests) == 4
+
+    # Different instances don't share blocks
+    cache.get_box(fetch_box, 'other-gray', (32, 32, 32), (0,0,64), np.uint8)
+    assert len(requests) == 5
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,61 @@
+import numpy as np
+from pyspark.serializers import PickleSerializer
+from DVIDSparkServices.sparkdvid.ColumnarSerializerLZ4 import ColumnarSerializerLZ4
+
+def _roundtrip(records):
+    serializer = ColumnarSerializerLZ4()
+    frame = serializer.dumps(records)
+    return frame, serializer.loads(frame)
+
+def test_graph_elements():
+    vertices = np.unique(np.random.randint(1, 10**9, size=1000).astype(np.uint64))
+    elements = [((v, -1), 1) for v in vertices]
+    elements += [((int(v), int(v)+1), 0.5) for v in vertices[:100]]
+
+    for batch in (elements[:-100], elements[-100:]):
+        frame, loaded = _roundtrip(batch)
+        assert frame[0] == 'C'
+        assert loaded == batch
+        for (key, value), (_, value_expected) in zip(loaded, batch):
+            assert type(key[0]) is int
+            assert type(value) is type(value_expected)
+
+    # Much smaller than the pickled records
+    frame, _ = _roundtrip(elements[:-100])
+    assert len(frame) < len(PickleSerializer().dumps(elements[:-100])) / 4
+
+def test_pickled_values():
+    boundaries = [((i, i+1), ('subvol', np.zeros((4,4,4), np.uint64), set([(1,2)]))) for i in range(100)]
+    frame, loaded = _roundtrip(boundaries)
+    assert frame[0] == 'C'
+    for (key, value), (key_expected, value_expected) in zip(loaded, boundaries):
+        assert key == key_expected
+        assert value[0] == value_expected[0]
+        assert (value[1] == value_expected[1]).all()
+        assert value[2] == value_expected[2]
+
+def test_not_columnar():
+    batches = [ [((1,2), 3)], # too few records
+                ["a", 1, (2,3)] * 10,
+                [((1,2), 3)] * 10 + [((1,2,3), 3)] * 10, # different key lengths
+                [((1, 2.5), 3)] * 20, # float keys
+                [((1, 2**64), 3)] * 20, # too large for int64
+                [((np.uint64(2**63), 2), 3)] * 20 ]
+    for batch in batches:
+        frame, loaded = _roundtrip(batch)
+        assert frame[0] == 'P'
+        assert loaded == batch
+
+    # Mixed ints and floats (or bools) are pickled, so their types are preserved.
+    for batch in ([((1, 2), 3)] * 10 + [((1, 2), 3.5)] * 10, [((1, 2), True)] * 20):
+        frame, loaded = _roundtrip(batch)
+        assert frame[0] == 'C'
+        assert loaded == batch
+        assert map(type, zip(*loaded)[1]) == map(type, zip(*batch)[1])
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,44 @@
+import cPickle as pickle
+import numpy as np
+import lz4
+from DVIDSparkServices.sparkdvid.CompressedLabelVolume import CompressedLabelVolume
+
+def _labels():
+    labels = np.zeros((64,64,64), dtype=np.uint64)
+    labels[10:20, :, :] = 7
+    labels[:, 30:, 5:9] = 2**40
+    return labels
+
+def test_from_array():
+    labels = _labels()
+    compressed = CompressedLabelVolume.from_array(labels)
+    assert compressed.shape == labels.shape
+    assert compressed.compressed_nbytes < labels.nbytes
+
+    uncompressed = compressed.deserialize()
+    assert uncompressed.dtype == np.uint64
+    assert uncompressed.flags.writeable
+    assert (uncompressed == labels).all()
+    assert (np.asarray(compressed) == labels).all()
+
+def test_from_dvid_lz4():
+    labels = _labels()
+    # DVID sends a bare lz4 block (no python-lz4 size header)
+    raw_lz4 = lz4.dumps(np.getbuffer(labels))[4:]
+    compressed = CompressedLabelVolume.from_dvid_lz4(raw_lz4, labels.shape)
+    assert (compressed.deserialize() == labels).all()
+
+def test_pickle():
+    labels = _labels()
+    compressed = CompressedLabelVolume.from_array(labels)
+    pickled = pickle.dumps(compressed, protocol=2)
+    assert len(pickled) < 2*compressed.compressed_nbytes
+    unpickled = pickle.loads(pickled)
+    assert (unpickled.deserialize() == labels).all()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
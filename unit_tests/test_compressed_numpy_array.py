@@ -1,6 +1,9 @@
+import pickle
 import numpy as np
 from numpy_allocation_tracking.decorators import assert_mem_usage_factor
-from DVIDSparkServices.sparkdvid.CompressedNumpyArray import CompressedNumpyArray
+from DVIDSparkServices.sparkdvid.CompressedNumpyArray import CompressedNumpyArray, get_codec, \
+                                                         set_default_codecs, default_codec, \
+                                                         set_compression_threads
 
 class TestCompressedNumpyArray(object):
     
@@ -68,6 +71,108 @@ class TestCompressedNumpyArray(object):
 
         assert (uncompressed == original).all()
 
+    def test_codecs(self):
+        original = np.random.random((10,100,100)).astype(np.float32)
+        for codec in ('lz4', 'lz4:shuffle', 'raw'):
+            compressed = CompressedNumpyArray(original, codec)
+            assert compressed.codec == codec
+            uncompressed = compressed.deserialize()
+            assert uncompressed.dtype == original.dtype
+            assert (uncompressed == original).all()
+
+        for codec in ('foo', 'lz4:foo', 'raw:1'):
+            try:
+                get_codec(codec)
+            except ValueError:
+                pass
+            else:
+                assert False, "Expected an error for codec '{}'".format(codec)
+
+    def test_label_codec(self):
+        labels = np.zeros((70,64,100), dtype=np.uint64)
+        labels[10:20, :, :] = 7
+        labels[:, 30:, 5:9] = 2**40
+        for original in (labels, labels.transpose(), labels.astype(np.uint32)):
+            compressed = CompressedNumpyArray(original)
+            assert compressed.codec == 'labels'
+            assert len(compressed.serialized_subarrays) == 3
+            uncompressed = compressed.deserialize()
+            assert uncompressed.dtype == original.dtype
+            assert (uncompressed == original).all()
+
+        # Not a 3D volume: lz4 instead
+        compressed = CompressedNumpyArray(labels[0], 'labels')
+        assert compressed.codec == 'lz4'
+        assert (compressed.deserialize() == labels[0]).all()
+
+    def test_threads(self):
+        original = np.random.random((100,100,100)).astype(np.float32)
+        try:
+            set_compression_threads(4)
+            for codec in ('lz4', 'lz4:shuffle'):
+                compressed = CompressedNumpyArray(original, codec)
+                assert (compressed.deserialize() == original).all()
+        finally:
+            set_compression_threads(1)
+
+    def test_split_large_slices(self):
+        original = np.random.random((10,100,100)).astype(np.float32)
+        max_size = CompressedNumpyArray.MAX_LZ4_BUFFER_SIZE
+        try:
+            # Each slice is split into 4 subarrays
+            CompressedNumpyArray.MAX_LZ4_BUFFER_SIZE = original[0].nbytes // 4
+            compressed = CompressedNumpyArray(original)
+        finally:
+            CompressedNumpyArray.MAX_LZ4_BUFFER_SIZE = max_size
+        assert len(compressed.serialized_subarrays) == 40
+
+        unpickled = pickle.loads(pickle.dumps(compressed, 2))
+        assert (unpickled.deserialize() == original).all()
+
+    def test_slicing(self):
+        original = np.random.random((50,60,70)).astype(np.float32)
+        for array in (original, original.transpose()):
+            compressed = CompressedNumpyArray(array)
+            for index in ( 3, -1, np.s_[10:20], np.s_[:, 5], np.s_[2:40:7, ::-1, 3:4],
+                           np.s_[..., 0], np.s_[5, 6, 7], np.s_[10:10] ):
+                expected = array[index]
+                sliced = compressed[index]
+                assert np.shape(sliced) == np.shape(expected)
+                assert (sliced == expected).all()
+
+            # Fancy indexing decompresses everything first, but still works.
+            assert (compressed[[1,2]] == array[[1,2]]).all()
+            assert (np.asarray(compressed) == array).all()
+
+    def test_values_at(self):
+        original = np.random.randint(0, 1000, size=(50,60,70)).astype(np.uint64)
+        compressed = CompressedNumpyArray(original)
+        coords = np.array([(0,0,0), (49,59,69), (10,20,30), (10,21,30)])
+        assert (compressed.values_at(coords) == original[tuple(coords.transpose())]).all()
+
+    def test_old_pickle(self):
+        # Arrays pickled before codecs existed have no codec attribute,
+        # and store a list of per-slice strings instead of a frame.
+        original = np.random.random((10,100,100)).astype(np.float32)
+        compressed = CompressedNumpyArray(original, 'lz4')
+        compressed.__dict__ = { 'layout': 'C', 'dtype': original.dtype, 'shape': original.shape,
+                                'serialized_subarrays': [ bytes(buf) for buf in compressed.serialized_subarrays ] }
+        unpickled = pickle.loads(pickle.dumps(compressed, 2))
+        assert (unpickled.deserialize() == original).all()
+
+    def test_default_codecs(self):
+        try:
+            set_default_codecs({ "float32": "lz4:shuffle" })
+            assert default_codec(np.float32) == "lz4:shuffle"
+            assert default_codec(np.uint8) == "lz4"
+            assert default_codec(np.uint64) == "labels"
+            assert CompressedNumpyArray(np.zeros((10,10), np.float32)).codec == "lz4:shuffle"
+
+            set_default_codecs({ "default": "raw" })
+            assert default_codec(np.float32) == "raw"
+        finally:
+            set_default_codecs({})
+
 if __name__ == "__main__":
     import sys
     import nose
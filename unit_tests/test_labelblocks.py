@@ -0,0 +1,45 @@
+import numpy as np
+from DVIDSparkServices.sparkdvid.labelblocks import encode_label_blocks, decode_label_blocks
+
+def _labels():
+    labels = np.zeros((70,64,100), dtype=np.uint64)
+    labels[10:20, :, :] = 7
+    labels[:, 30:, 5:9] = 2**40
+    labels[40:, 40:, 40:] = np.random.randint(0, 300, size=(30,24,60))
+    return labels
+
+def test_roundtrip():
+    labels = _labels()
+    encoded = encode_label_blocks(labels)
+    assert len(encoded) < labels.nbytes / 4
+    decoded = decode_label_blocks(encoded, labels.shape, labels.dtype)
+    assert decoded.dtype == np.uint64
+    assert decoded.flags['C_CONTIGUOUS']
+    assert (decoded == labels).all()
+
+def test_palette_sizes():
+    # Palette sizes up to (and including) a full block of distinct labels
+    for num_labels in (1, 2, 3, 4, 5, 255, 256, 257, 32**3):
+        labels = (np.arange(32**3, dtype=np.int32) % num_labels).reshape((32,32,32)) - 10
+        decoded = decode_label_blocks(encode_label_blocks(labels), labels.shape, labels.dtype)
+        assert (decoded == labels).all(), "Wrong result for {} labels".format(num_labels)
+
+def test_uniform_blocks():
+    labels = np.zeros((64,64,64), dtype=np.uint32)
+    labels[32:] = 3
+    encoded = encode_label_blocks(labels)
+    # Just the palette sizes and one label per block
+    assert len(encoded) == 8*2 + 8*4
+    assert (decode_label_blocks(encoded, labels.shape, labels.dtype) == labels).all()
+
+def test_empty():
+    labels = np.zeros((0,10,10), dtype=np.uint64)
+    decoded = decode_label_blocks(encode_label_blocks(labels), labels.shape, labels.dtype)
+    assert decoded.shape == labels.shape
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
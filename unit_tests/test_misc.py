@@ -6,7 +6,7 @@ from numpy_allocation_tracking.decorators import assert_mem_usage_factor
 import DVIDSparkServices
 from DVIDSparkServices.reconutils.misc import select_channels, normalize_channels_in_place, \
                                               find_large_empty_regions, naive_membrane_predictions, \
-                                              seeded_watershed
+                                              seeded_watershed, quantize_predictions, dequantize_predictions
 
 import logging
 logger = logging.getLogger("unit_tests.test_misc")
@@ -76,6 +76,33 @@ def test_normalize_channels_in_place():
 
     assert a[50,50,0] == a[50,50,1] == a[50,50,2]
 
+def test_quantize_predictions():
+    a = np.random.random((10,20,30,3)).astype(np.float32)
+    a[0,0,0] = [0.0, 1.0, 0.5]
+    a[0,0,1] = [-0.1, 1.1, 0.2]
+    
+    assert quantize_predictions(a, np.float32) is a
+    for dtype in (np.uint8, np.uint16):
+        max_value = np.iinfo(dtype).max
+        q = quantize_predictions(a, dtype)
+        assert q.dtype == dtype
+        assert q.shape == a.shape
+        assert list(q[0,0,0]) == [0, max_value, (max_value+1)//2]
+        assert list(q[0,0,1]) == [0, max_value, int(0.2*max_value + 0.5)]
+
+        d = dequantize_predictions(q)
+        assert d.dtype == np.float32
+        assert list(d[0,0,0,:2]) == [0.0, 1.0]
+        assert np.abs(d - np.clip(a, 0, 1)).max() <= 0.5 / max_value + 1e-6
+
+        # Float predictions are left alone
+        assert dequantize_predictions(a) is a
+        assert quantize_predictions(q, dtype) is q
+
+    # uint16 -> uint8
+    q16 = quantize_predictions(a, np.uint16)
+    assert (quantize_predictions(q16, np.uint8) == quantize_predictions(a, np.uint8)).all()
+
 class TestMemoryUsage(object):
 
     @classmethod
@@ -0,0 +1,103 @@
+import threading
+from DVIDSparkServices.sparkdvid.NodeServicePool import NodeServicePool
+
+class _FakeService(object):
+    def __init__(self, *key):
+        self.key = key
+
+def test_hit_and_miss():
+    pool = NodeServicePool(_FakeService)
+    key = ('emdata:8000', 'abc123', '', 0, 'sparkservices')
+
+    s1 = pool.get(key)
+    s2 = pool.get(key)
+    assert s1 is s2
+    assert s1.key == key
+
+    s3 = pool.get(('emdata:8000', 'def456', '', 0, 'sparkservices'))
+    assert s3 is not s1
+
+    stats = pool.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+    assert stats["size"] == 2
+
+def test_checkout_evicts_on_error():
+    pool = NodeServicePool(_FakeService)
+    key = ('emdata:8000', 'abc123', '', 0, 'sparkservices')
+
+    with pool.checkout(key) as s1:
+        pass
+
+    try:
+        with pool.checkout(key) as s2:
+            assert s2 is s1
+            raise RuntimeError("broken connection")
+    except RuntimeError:
+        pass
+    else:
+        assert False, "Exception should have propagated"
+
+    # The broken service was discarded
+    with pool.checkout(key) as s3:
+        assert s3 is not s1
+    assert pool.stats()["evictions"] == 1
+
+def test_expiration():
+    pool = NodeServicePool(_FakeService, max_age=0.0)
+    key = ('emdata:8000', 'abc123', '', 0, 'sparkservices')
+    s1 = pool.get(key)
+    s2 = pool.get(key)
+    assert s1 is not s2
+    assert pool.stats()["expirations"] == 1
+
+def test_per_thread():
+    pool = NodeServicePool(_FakeService)
+    key = ('emdata:8000', 'abc123', '', 0, 'sparkservices')
+    s1 = pool.get(key)
+
+    other = []
+    t = threading.Thread(target=lambda: other.append(pool.get(key)))
+    t.start()
+    t.join()
+
+    assert other[0] is not s1
+    assert pool.get(key) is s1
+
+    # Once the other thread has exited, its service can be reused by another thread.
+    t = threading.Thread(target=lambda: other.append(pool.get(key)))
+    t.start()
+    t.join()
+    assert other[1] is other[0]
+    assert pool.stats()["misses"] == 2
+
+def test_checkout_exclusive():
+    pool = NodeServicePool(_FakeService)
+    key = ('emdata:8000', 'abc123', '', 0, 'sparkservices')
+
+    # Never handed out twice at the same time
+    with pool.checkout(key) as s1:
+        with pool.checkout(key) as s2:
+            assert s2 is not s1
+
+    # Returned services are reused, by any thread.
+    other = []
+    def use_service():
+        with pool.checkout(key) as s:
+            other.append(s)
+    t = threading.Thread(target=use_service)
+    t.start()
+    t.join()
+    assert other[0] in (s1, s2)
+
+    with pool.checkout(key) as s3:
+        assert s3 in (s1, s2)
+    assert pool.stats()["misses"] == 2
+    assert pool.stats()["size"] == 2
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,64 @@
+from cStringIO import StringIO
+import numpy as np
+from DVIDSparkServices.sparkdvid.NumpyFramedSerializer import NumpyFramedSerializer
+
+def _records():
+    seg = np.random.randint(0, 10, size=(40,50,60)).astype(np.uint64)
+    pred = np.random.random((3,20,30,40)).astype(np.float32)
+    return [ (1, seg),
+             ("pred", { "pred": pred, "meta": [1,2,3] }),
+             (2, np.asfortranarray(seg)),
+             (3, seg[:, ::2, 10:20]), # not contiguous
+             (4, np.array(5, dtype=np.int16)), # 0-d
+             (5, np.array(["a", None], dtype=object)),
+             (6, [seg, seg]) ]
+
+def _check_same(loaded, expected):
+    assert len(loaded) == len(expected)
+    for (k, v), (k_expected, v_expected) in zip(loaded, expected):
+        assert k == k_expected
+        if isinstance(v_expected, dict):
+            assert v["meta"] == v_expected["meta"]
+            v, v_expected = v["pred"], v_expected["pred"]
+        if isinstance(v_expected, list):
+            assert v[0] is v[1], "Shared arrays should be written once"
+            v, v_expected = v[0], v_expected[0]
+        assert v.dtype == v_expected.dtype
+        assert v.shape == v_expected.shape
+        assert (v == v_expected).all()
+        assert v.flags['F_CONTIGUOUS'] or v.flags['C_CONTIGUOUS']
+
+def test_roundtrip():
+    records = _records()
+    for compress in (False, True):
+        serializer = NumpyFramedSerializer(compress)
+        _check_same([serializer.loads(serializer.dumps(r)) for r in records], records)
+
+def test_stream():
+    records = _records()
+    for compress in (False, True):
+        serializer = NumpyFramedSerializer(compress)
+        stream = StringIO()
+        serializer.dump_stream(iter(records), stream)
+        stream.seek(0)
+        loaded = list(serializer.load_stream(stream))
+        _check_same(loaded, records)
+
+        # Raw arrays are writeable views of the frame they were read into.
+        if not compress:
+            seg = loaded[0][1]
+            assert seg.flags['WRITEABLE']
+            assert not seg.flags['OWNDATA']
+
+def test_out_of_band():
+    # Arrays are not pickled: the frame is barely larger than the array buffers.
+    seg = np.random.randint(0, 1000, size=(100,100,100)).astype(np.uint64)
+    frame = NumpyFramedSerializer().dumps((1, seg))
+    assert len(frame) < seg.nbytes + 200
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,150 @@
+import threading
+import numpy as np
+from DVIDSparkServices.util import RoiMap, bb_to_slicing, dense_roi_mask_for_subvolume
+from DVIDSparkServices.sparkdvid.Subvolume import Subvolume
+from DVIDSparkServices.sparkdvid.sparkdvid import sparkdvid, assemble_roi_blocks, is_retryable_dvid_error, coalesce_label_writes, \
+                                                 map_subvolume_values, prefetch_subvolumes_per_partition
+
+class FakeRDD(object):
+    """Just enough of an RDD to check how records are partitioned."""
+    def __init__(self, partitions):
+        self.partitions = partitions
+
+    def flatMap(self, f):
+        return FakeRDD([[y for x in partition for y in f(x)] for partition in self.partitions])
+
+    def mapPartitions(self, f, preservesPartitioning=False):
+        # Lazy, like Spark: the caller iterates over each partition's output
+        return FakeRDD([f(iter(partition)) for partition in self.partitions])
+
+class FakeContext(object):
+    def parallelize(self, items, num_partitions):
+        # Contiguous slices, like SparkContext.parallelize()
+        n = len(items)
+        return FakeRDD([ items[i*n//num_partitions:(i+1)*n//num_partitions] for i in range(num_partitions) ])
+
+def test_assemble_roi_blocks():
+    # L-shaped ROI, 4x4x4 blocks
+    roi_blocks = [(z,y,x) for z in range(4) for y in range(4) for x in range(4) if (y < 2 or x < 2)]
+    roi_map = RoiMap(roi_blocks)
+
+    # Subvolume with a (non-block-aligned) border
+    subvol = Subvolume(0, (32,32,32), 64, 10, roi_map)
+    assert not subvol.is_interior
+
+    full_volume = np.random.randint(1, 1000, size=(128,128,128)).astype(np.uint64)
+    requests = []
+    def fetch_box(shape_zyx, offset_zyx):
+        requests.append((shape_zyx, offset_zyx))
+        start = np.array(offset_zyx)
+        return full_volume[bb_to_slicing(start, start + shape_zyx)]
+
+    assembled = assemble_roi_blocks(fetch_box, subvol, np.uint64)
+
+    # Expected: the dense fetch, masked by the ROI.
+    start = np.array(subvol.box_with_border[0:3])
+    stop = np.array(subvol.box_with_border[3:6])
+    expected = full_volume[bb_to_slicing(start, stop)].copy()
+    expected[np.logical_not(dense_roi_mask_for_subvolume(subvol))] = 0
+
+    assert assembled.dtype == np.uint64
+    assert (assembled == expected).all()
+
+    # One request per run of blocks in X, none of which extends beyond the subvolume.
+    for shape_zyx, offset_zyx in requests:
+        assert (np.array(offset_zyx) >= start).all()
+        assert (np.array(offset_zyx) + shape_zyx <= stop).all()
+
+def test_is_retryable_dvid_error():
+    assert is_retryable_dvid_error(RuntimeError("DVID returned status code 503"))
+    assert is_retryable_dvid_error(RuntimeError("Connection refused"))
+    assert is_retryable_dvid_error(RuntimeError("DVID returned status code 429"))
+    assert not is_retryable_dvid_error(RuntimeError("DVID returned status code 404"))
+    assert not is_retryable_dvid_error(AssertionError("bad shape"))
+
+def test_coalesce_label_writes():
+    full_volume = np.zeros((64,64,256), dtype=np.uint64)
+    full_volume[:, :, 0:100] = 1
+    full_volume[:, :, 200:210] = 2
+
+    # Row of 4 subvolumes along X (64 wide), one subvolume in the next Y row
+    boxes = [(0, 0, x, 64, 32, x+64) for x in range(0, 256, 64)] + [(0, 32, 0, 64, 64, 64)]
+    boxes_and_segs = [ (box, full_volume[bb_to_slicing(box[0:3], box[3:6])]) for box in boxes ]
+
+    requests = list(coalesce_label_writes(boxes_and_segs))
+    assert [offset for offset, _ in requests] == [(0,0,0), (0,32,0)]
+    assert (requests[0][1] == full_volume[:, 0:32, :]).all()
+    assert requests[0][1].flags['C_CONTIGUOUS']
+
+    # Request size limit
+    requests = list(coalesce_label_writes(boxes_and_segs, max_request_bytes=2*64*32*64*8))
+    assert [offset for offset, _ in requests] == [(0,0,0), (0,0,128), (0,32,0)]
+
+    # All-zero block columns (x = 128:192 and 224:256) are skipped
+    requests = list(coalesce_label_writes(boxes_and_segs, skip_zero_blocks=True))
+    assert [(offset, vol.shape) for offset, vol in requests] == [ ((0,0,0), (64,32,128)),
+                                                                  ((0,0,192), (64,32,32)),
+                                                                  ((0,32,0), (64,32,64)) ]
+    assert (requests[1][1] == full_volume[:, 0:32, 192:224]).all()
+
+def test_parallelize_subvolumes():
+    # 4x4 subvolumes in one Z-plane, in scrambled order
+    starts = [(0, y, x) for y in range(0, 256, 64) for x in range(0, 256, 64)]
+    roi_map = RoiMap([(z,y,x) for z in range(2) for y in range(8) for x in range(8)])
+    subvolumes = [Subvolume(i, start, 64, 0, roi_map) for i, start in enumerate(starts)]
+    subvolumes = [subvolumes[i] for i in np.random.permutation(len(subvolumes))]
+
+    context = sparkdvid.__new__(sparkdvid)
+    context.sc = FakeContext()
+
+    # Each partition is a 2x2 square of subvolumes
+    partitions = context.parallelize_subvolumes(subvolumes, 64, subvolumes_per_partition=4).partitions
+    assert len(partitions) == 4
+    for partition in partitions:
+        assert all(sv_index == sv.sv_index for sv_index, sv in partition)
+        box_starts = np.array([sv.box[0:3] for _, sv in partition])
+        assert (box_starts.max(axis=0) - box_starts.min(axis=0) == (0, 64, 64)).all()
+
+    # With costs, partitions are listed heaviest first
+    costs = [1000 if sv.box[1] >= 128 and sv.box[2] >= 128 else 1 for sv in subvolumes]
+    cost_of = dict((sv.sv_index, cost) for sv, cost in zip(subvolumes, costs))
+    partitions = context.parallelize_subvolumes(subvolumes, 64, 4, costs).partitions
+    partition_costs = [sum(cost_of[sv_index] for sv_index, _ in partition) for partition in partitions]
+    assert partition_costs == sorted(partition_costs, reverse=True)
+    assert sorted(sv_index for partition in partitions for sv_index, _ in partition) == range(16)
+
+    # One subvolume per partition, heaviest first
+    partitions = context.parallelize_subvolumes(subvolumes, 64, 1, costs).partitions
+    assert len(partitions) == 16
+    assert all(partition[0][1].box[1] >= 128 and partition[0][1].box[2] >= 128 for partition in partitions[:4])
+
+def test_map_subvolume_values_prefetch():
+    roi_map = RoiMap([(0,0,x) for x in range(16)])
+    subvolumes = [Subvolume(i, (0, 0, 32*i), 32, 0, roi_map) for i in range(16)]
+
+    context = sparkdvid.__new__(sparkdvid)
+    context.sc = FakeContext()
+    prefetch = 1
+    distsubvolumes = context.parallelize_subvolumes(subvolumes, 32, prefetch_subvolumes_per_partition(prefetch))
+    assert len(distsubvolumes.partitions) == 4
+
+    mapped = dict((sv.sv_index, threading.Event()) for sv in subvolumes)
+    def mapper(subvolume):
+        mapped[subvolume.sv_index].set()
+        return subvolume.sv_index
+
+    mapped_partitions = map_subvolume_values(distsubvolumes, mapper, prefetch).partitions
+    for mapped_partition, partition in zip(mapped_partitions, distsubvolumes.partitions):
+        next_keys = [key for key, _ in partition[1:]] + [None]
+        for (key, value), next_key in zip(mapped_partition, next_keys):
+            assert value == key
+            # The mapper for the next item runs before this one is consumed
+            if next_key is not None:
+                assert mapped[next_key].wait(1.0)
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
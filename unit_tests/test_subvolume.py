@@ -0,0 +1,155 @@
+import numpy as np
+from DVIDSparkServices.util import RoiMap
+from DVIDSparkServices.sparkdvid.Subvolume import Subvolume
+
+def _random_roi():
+    # Random blobby ROI, roughly 12x12x12 blocks
+    roi_blocks = np.random.randint(-2, 10, size=(1500,3))
+    return np.array(list(set(map(tuple, roi_blocks))))
+
+def _check_same(batch, expected):
+    assert len(batch) == len(expected)
+    for sv, sv_expected in zip(batch, expected):
+        assert sv.box == sv_expected.box
+        assert sv.is_interior == sv_expected.is_interior
+        assert (np.asarray(sv.intersecting_blocks) == sv_expected.intersecting_blocks).all()
+        assert (np.asarray(sv.intersecting_blocks_noborder) == sv_expected.intersecting_blocks_noborder).all()
+
+def test_create_batch():
+    roi_map = RoiMap(_random_roi())
+    for border in (0, 10, 32, 40):
+        starts = [(z,y,x) for z in range(-64, 320, 64) for y in range(-64, 320, 64) for x in range(-64, 320, 64)]
+        batch = Subvolume.create_batch(starts, 64, border, roi_map)
+        expected = [Subvolume(None, start, 64, border, roi_map) for start in starts]
+        _check_same(batch, expected)
+
+def test_create_batch_small_roi_chunks():
+    # Windows spanning many RoiMap chunks
+    roi_blocks = _random_roi()
+    roi_map = RoiMap(roi_blocks, chunk_width=3)
+    dense_roi_map = RoiMap(roi_blocks)
+    starts = [(z,y,x) for z in range(-64, 320, 64) for y in range(-64, 320, 64) for x in range(-64, 320, 64)]
+    batch = Subvolume.create_batch(starts, 64, 10, roi_map)
+    expected = [Subvolume(None, start, 64, 10, dense_roi_map) for start in starts]
+    _check_same(batch, expected)
+
+def test_create_batch_not_grid():
+    # Subvolumes that don't lie on a common grid use the per-subvolume path.
+    roi_map = RoiMap(_random_roi())
+    starts = [(0,0,0), (0,0,64), (0,32,160)]
+    batch = Subvolume.create_batch(starts, 64, 10, roi_map)
+    expected = [Subvolume(None, start, 64, 10, roi_map) for start in starts]
+    _check_same(batch, expected)
+
+def test_anisotropic():
+    roi_map = RoiMap(_random_roi())
+    chunk_shape = (32, 64, 128)
+    border = (4, 10, 32)
+    starts = [(z,y,x) for z in range(-32, 320, 32) for y in range(-64, 320, 64) for x in range(-128, 320, 128)]
+    batch = Subvolume.create_batch(starts, chunk_shape, border, roi_map)
+    expected = [Subvolume(None, start, chunk_shape, border, roi_map) for start in starts]
+    _check_same(batch, expected)
+
+    sv = batch[0]
+    assert sv.border_zyx == border
+    assert tuple(sv.box_with_border) == (-36, -74, -160, 4, 10, 32)
+    assert sv.shape_with_border == (40, 84, 192)
+    try:
+        sv.border
+    except AssertionError:
+        pass
+    else:
+        assert False, "Expected an error for a per-axis border"
+
+    # Isotropic borders can still be given as a single int
+    sv = Subvolume(None, (0,0,0), 64, 10, roi_map)
+    assert sv.border == 10
+    assert sv.border_zyx == (10, 10, 10)
+
+def test_unpickle_old_state():
+    roi_map = RoiMap(_random_roi())
+    sv = Subvolume(3, (0,0,0), 64, 10, roi_map)
+
+    # Subvolumes used to be pickled as a plain __dict__ with a single border
+    state = { 'sv_index': 3, 'box': sv.box, 'border': 10, 'roi_blocksize': 32,
+              'local_regions': [(4, (0,0,64,64,64,128))],
+              'intersecting_blocks': sv.intersecting_blocks,
+              'intersecting_blocks_noborder': sv.intersecting_blocks_noborder,
+              'is_interior': sv.is_interior }
+
+    old_sv = Subvolume.__new__(Subvolume)
+    old_sv.__setstate__(state)
+    assert old_sv == sv
+    assert old_sv.border_zyx == (10, 10, 10)
+    assert old_sv.local_regions == [(4, (0,0,64,64,64,128))]
+    _check_same([old_sv], [sv])
+
+def test_pickle():
+    import pickle
+    roi_map = RoiMap(_random_roi())
+    subvolumes = [Subvolume(None, (z,0,0), 64, 10, roi_map) for z in (0, 64)]
+    for i, sv in enumerate(subvolumes):
+        sv.sv_index = i
+    Subvolume.record_all_borders(subvolumes)
+
+    for protocol in (0, 2):
+        unpickled = pickle.loads(pickle.dumps(subvolumes, protocol))
+        _check_same(unpickled, subvolumes)
+        for sv, sv_expected in zip(unpickled, subvolumes):
+            assert sv == sv_expected
+            assert sv.local_regions == sv_expected.local_regions
+
+    # Much smaller than listing the block coordinates
+    coords_nbytes = subvolumes[0].intersecting_blocks.nbytes
+    assert len(pickle.dumps(subvolumes[0], 2)) < coords_nbytes / 4
+
+def test_record_all_borders():
+    roi_map = RoiMap([(0,0,0)])
+    starts = [(z,y,x) for z in range(0, 256, 64) for y in range(0, 256, 64) for x in range(0, 256, 64)]
+    # A few subvolumes that are offset from the others
+    starts += [(256, 32, 32), (256, 96, 32), (-64, 10, 0)]
+
+    def make_subvolumes():
+        subvolumes = [Subvolume(None, start, 64, 10, roi_map) for start in starts]
+        for i, sv in enumerate(subvolumes):
+            sv.sv_index = i
+        return subvolumes
+
+    expected = make_subvolumes()
+    for i in range(0, len(expected)-1):
+        for j in range(i+1, len(expected)):
+            expected[i].recordborder(expected[j])
+
+    subvolumes = make_subvolumes()
+    Subvolume.record_all_borders(subvolumes)
+
+    for sv, sv_expected in zip(subvolumes, expected):
+        assert sv.local_regions == sv_expected.local_regions
+
+def test_estimate_costs():
+    roi_map = RoiMap([(0,0,0), (0,0,1), (0,0,2), (0,0,3)])
+    subvolumes = [Subvolume(None, start, 64, 0, roi_map) for start in [(0,0,0), (0,0,64), (0,0,128)]]
+    assert list(Subvolume.estimate_costs(subvolumes)) == [2, 2, 0]
+
+    # Unmeasured subvolumes are scaled by the measured seconds-per-block
+    costs = Subvolume.estimate_costs(subvolumes, { "0_0_0": 10.0 })
+    assert list(costs) == [10.0, 10.0, 0.0]
+
+    costs = Subvolume.estimate_costs(subvolumes, { "0_0_64": 3.0, "0_0_128": 1.0 })
+    assert list(costs) == [3.0, 3.0, 1.0]
+
+def test_subvol_list_all_blocks():
+    roi_map = RoiMap(_random_roi())
+    subvolumes = Subvolume.create_batch([(0,0,0), (0,0,64), (64,64,64)], 64, 10, roi_map)
+    all_blocks = Subvolume.subvol_list_all_blocks(subvolumes)
+    expected = np.concatenate([sv.intersecting_blocks_noborder for sv in subvolumes])
+    assert all_blocks.dtype == np.int64
+    assert (all_blocks == expected).all()
+    assert Subvolume.subvol_list_all_blocks([]).shape == (0,3)
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,110 @@
+import time
+import socket
+import threading
+from DVIDSparkServices.sparkdvid.TokenService import TokenServer, TokenBudget, dvid_token
+
+def _run_concurrently(func, count):
+    threads = [threading.Thread(target=func) for _ in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+def test_max_requests():
+    server = TokenServer(max_reads=2, max_writes=1)
+    server.start()
+    try:
+        address = ('localhost', server.port)
+        lock = threading.Lock()
+        active = [0]
+        peak = [0]
+        def read():
+            with dvid_token(address, 'read', 100):
+                with lock:
+                    active[0] += 1
+                    peak[0] = max(peak[0], active[0])
+                time.sleep(0.05)
+                with lock:
+                    active[0] -= 1
+
+        _run_concurrently(read, 6)
+        assert peak[0] == 2
+
+        # The server notices the last disconnect asynchronously
+        for _ in range(100):
+            stats = server.stats()
+            if stats['read']['requests_in_flight'] == 0:
+                break
+            time.sleep(0.01)
+        assert stats['read']['granted'] == 6
+        assert stats['read']['peak_requests'] == 2
+        assert stats['read']['requests_in_flight'] == 0
+        assert stats['write']['granted'] == 0
+    finally:
+        server.shutdown()
+
+def test_bytes_in_flight():
+    budget = TokenBudget(max_requests=10, max_bytes=1000)
+    budget.acquire(600)
+
+    # Doesn't fit until the first token is released
+    acquired = threading.Event()
+    def acquire_second():
+        budget.acquire(600)
+        acquired.set()
+    t = threading.Thread(target=acquire_second)
+    t.start()
+    assert not acquired.wait(0.1)
+
+    budget.release(600)
+    assert acquired.wait(1.0)
+    t.join()
+    budget.release(600)
+
+    # An oversized request is still granted when nothing else is in flight
+    budget.acquire(5000)
+    assert budget.stats()["peak_bytes"] == 5000
+    budget.release(5000)
+
+def test_no_request_limit():
+    # Only the bytes are limited
+    budget = TokenBudget(max_requests=None, max_bytes=1000)
+    for _ in range(100):
+        budget.acquire(10)
+    assert budget.stats()["peak_requests"] == 100
+
+def test_released_on_disconnect():
+    server = TokenServer(max_reads=1, max_writes=1)
+    server.start()
+    try:
+        # Take a token with a raw connection, then drop it without a goodbye.
+        sock = socket.create_connection(('localhost', server.port))
+        sock.sendall("write 10\n")
+        assert sock.makefile('r').readline() == "ok\n"
+        sock.close()
+
+        # The next request must not block forever
+        with dvid_token(('localhost', server.port), 'write', 10):
+            pass
+    finally:
+        server.shutdown()
+
+def test_no_server():
+    # No token server configured
+    with dvid_token(None, 'read', 10):
+        pass
+
+    # Unreachable token server: proceed anyway
+    s = socket.socket()
+    s.bind(('localhost', 0))
+    unused_port = s.getsockname()[1]
+    s.close()
+    with dvid_token(('localhost', unused_port), 'read', 10):
+        pass
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
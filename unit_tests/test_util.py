@@ -1,5 +1,7 @@
 import numpy as np
-from DVIDSparkServices.util import runlength_encode
+from DVIDSparkServices.util import runlength_encode, runlength_decode, zero_where_reference_zero, prefetch_map, RoiMap, zorder_index, \
+                                   pack_bins, split_by_cost, zyx_tuple, dense_roi_mask_for_subvolume, \
+                                   coordlist_to_boolmap, bb_to_slicing, mask_roi
 
 def test_runlength_encode():
     mask = np.array( [[[0,1,1,0,1],
@@ -20,9 +22,232 @@ def test_runlength_encode():
     rle = runlength_encode(coords)
     assert (rle == expected_rle).all()
 
+def test_runlength_encode_unsorted_duplicates():
+    coords = np.array([[1,2,3], [0,0,5], [1,2,2], [0,0,5], [-1,0,0], [0,0,4], [1,2,5]])
+    expected_rle = np.array([[-1,0,0,0],
+                             [0,0,4,5],
+                             [1,2,2,3],
+                             [1,2,5,5]])
+    assert (runlength_encode(coords) == expected_rle).all()
+
+    # A bounding box too large to ravel into a single sort key
+    coords[0] = (2**40, 2**30, 0)
+    expected_rle = np.array([[-1,0,0,0],
+                             [0,0,4,5],
+                             [1,2,2,2],
+                             [1,2,5,5],
+                             [2**40,2**30,0,0]])
+    assert (runlength_encode(coords) == expected_rle).all()
+
+def test_runlength_roundtrip():
+    coords = np.array(list(set(map(tuple, np.random.randint(-50, 50, size=(5000,3))))))
+    rle = runlength_encode(coords)
+    decoded = runlength_decode(rle)
+    assert (decoded == coords[np.lexsort(coords.transpose()[::-1])]).all()
+    assert (runlength_encode(decoded, assume_sorted=True) == rle).all()
+
+def test_runlength_decode():
+    coords = np.array([[0,0,1], [0,0,2], [0,0,4], [1,2,0], [1,2,1], [1,2,2]])
+    rle = runlength_encode(coords)
+    assert (runlength_decode(rle) == coords).all()
+    assert runlength_decode(np.zeros((0,4), np.int64)).shape == (0,3)
+
+def test_roimap_from_runs():
+    roi_blocks = np.random.randint(-5, 10, size=(100,3))
+    roi_blocks = np.array(list(set(map(tuple, roi_blocks))))
+    expected = RoiMap(roi_blocks)
+    roi_map = RoiMap.from_runs( runlength_encode(roi_blocks) )
+
+    assert (roi_map.blocks_start == expected.blocks_start).all()
+    assert (roi_map.blocks_stop == expected.blocks_stop).all()
+    assert (roi_map.blocks_shape == expected.blocks_shape).all()
+    assert (roi_map.block_mask == expected.block_mask).all()
+
+def test_roimap_sparse():
+    # A solid 8x8x8 cube of blocks, plus some random blocks
+    roi_blocks = set( (z,y,x) for z in range(8) for y in range(8) for x in range(8) )
+    roi_blocks |= set(map(tuple, np.random.randint(-10, 20, size=(200,3))))
+    roi_blocks = np.array(list(roi_blocks))
+    dense, (start, stop) = coordlist_to_boolmap(roi_blocks)
+
+    for roi_map in ( RoiMap(roi_blocks, chunk_width=4),
+                     RoiMap.from_runs(runlength_encode(roi_blocks), chunk_width=4) ):
+        assert (roi_map.blocks_start == start).all()
+        assert (roi_map.blocks_stop == stop).all()
+        assert (roi_map.block_mask == dense).all()
+
+        # Chunks inside the cube are stored as True, not as arrays
+        assert roi_map._chunks[(0,0,0)] is True
+        assert roi_map.nbytes < len(roi_map._chunks) * 4**3
+
+        # Arbitrary regions, including ones outside the bounding box
+        padded = np.zeros(np.array(dense.shape) + 80, dtype=bool)
+        padded[40:-40, 40:-40, 40:-40] = dense
+        for _ in range(20):
+            region_start = np.random.randint(-20, 20, size=3)
+            region_stop = region_start + np.random.randint(1, 15, size=3)
+            expected = padded[bb_to_slicing(region_start - start + 40, region_stop - start + 40)]
+            assert (roi_map.get_mask(region_start, region_stop) == expected).all()
+
+def test_mask_roi():
+    from DVIDSparkServices.sparkdvid.Subvolume import Subvolume
+    roi_blocks = np.random.randint(0, 6, size=(80,3))
+    roi_map = RoiMap(roi_blocks)
+    dense_roi = np.zeros((6*32, 6*32, 6*32), dtype=bool)
+    for z, y, x in roi_blocks:
+        dense_roi[z*32:(z+1)*32, y*32:(y+1)*32, x*32:(x+1)*32] = True
+
+    # Non-block-aligned border, and a smaller border than the subvolume's own
+    sv = Subvolume(None, (64, 64, 64), 64, (10, 20, 40), roi_map)
+    for border in ('default', (10, 20, 40), (0, 5, 8)):
+        if border == 'default':
+            b = np.array(sv.border_zyx)
+        else:
+            b = np.array(border)
+        start = np.array(sv.box[0:3]) - b
+        stop = np.array(sv.box[3:6]) + b
+        data = np.random.randint(1, 100, size=stop-start).astype(np.uint64)
+        expected = data.copy()
+        expected[np.logical_not(dense_roi[bb_to_slicing(start, stop)])] = 0
+
+        mask_roi(data, sv, border)
+        assert (data == expected).all()
+        assert (dense_roi_mask_for_subvolume(sv, border) == dense_roi[bb_to_slicing(start, stop)]).all()
+
+def test_mask_roi_interior():
+    from DVIDSparkServices.sparkdvid.Subvolume import Subvolume
+    roi_map = RoiMap([(z,y,x) for z in range(4) for y in range(4) for x in range(4)])
+    sv = Subvolume(None, (32,32,32), 64, 10, roi_map)
+    assert sv.is_interior
+
+    data = np.ones((84,84,84), dtype=np.uint8)
+    mask_roi(data, sv)
+    assert data.all()
+
+def test_zorder_index():
+    assert list(zorder_index([(0,0,0), (0,0,1), (0,1,0), (1,0,0), (1,1,1), (0,0,2)])) == [0, 1, 2, 4, 7, 8]
+
+    # Each 2x2x2 cell of a 4x4x4 grid is contiguous in Z-order
+    coords = np.array(list(np.ndindex(4,4,4)))
+    ordered = coords[np.argsort(zorder_index(coords))]
+    for i in range(0, 64, 8):
+        assert len(set(map(tuple, ordered[i:i+8] // 2))) == 1
+
+    # Large coordinates don't overflow into neighboring bits
+    assert zorder_index([(0, 0, 2**21-1)])[0] == int('001'*21, 2)
+    assert zorder_index([(2**21-1, 0, 0)])[0] == int('100'*21, 2)
+
+def test_zero_where_reference_zero():
+    reference = np.random.randint(0, 3, size=(10,20,30))
+    data = np.random.randint(1, 100, size=(10,20,30)).astype(np.uint64)
+
+    expected = data.copy()
+    expected[reference == 0] = 0
+
+    zero_where_reference_zero(data, reference)
+    assert (data == expected).all()
+
+def test_prefetch_map():
+    import threading
+    lock = threading.Lock()
+    in_flight = [0]
+    peak = [0]
+    def func(x):
+        with lock:
+            in_flight[0] += 1
+            peak[0] = max(peak[0], in_flight[0])
+        return x*x
+
+    def consume(results):
+        # An item is in flight until the consumer is done with it
+        # (i.e. asks for the next one).
+        for r in results:
+            yield r
+            with lock:
+                in_flight[0] -= 1
+
+    # Up to 3 items ahead of the one being consumed
+    results = list(consume(prefetch_map(func, iter(range(20)), max_prefetch=3)))
+    assert results == [x*x for x in range(20)]
+    assert peak[0] <= 1+3
+
+    # Byte budget: each item is 'worth' 10 bytes; only 2 fit in 25 bytes,
+    # including the one being consumed.
+    peak[0] = 0
+    in_flight[0] = 0
+    results = list(consume(prefetch_map(func, range(20), max_prefetch=10, max_bytes=25,
+                                        nbytes_estimate=lambda x: 10)))
+    assert results == [x*x for x in range(20)]
+    assert peak[0] <= 2
+
+def test_prefetch_map_error():
+    def func(x):
+        if x == 3:
+            raise ValueError("bad item")
+        return x
+
+    results = []
+    try:
+        for r in prefetch_map(func, range(10)):
+            results.append(r)
+    except ValueError:
+        pass
+    else:
+        assert False, "Expected an exception"
+    assert results == [0,1,2]
+
 import logging
 logger = logging.getLogger("unit_tests.test_util")
 
+def test_pack_bins():
+    costs = [5, 1, 8, 3, 3, 2, 7]
+    bins = pack_bins(costs, 3)
+    assert sorted(sum(bins, [])) == list(range(len(costs)))
+    totals = [sum(costs[i] for i in b) for b in bins]
+    assert totals == sorted(totals, reverse=True)
+    assert max(totals) - min(totals) <= max(costs)
+
+    # Within each bin, heaviest first
+    for b in bins:
+        assert [costs[i] for i in b] == sorted([costs[i] for i in b], reverse=True)
+
+    # More bins than items
+    bins = pack_bins([1, 2], 4)
+    assert len(bins) == 4
+    assert bins[0] == [1] and bins[1] == [0]
+
+def test_split_by_cost():
+    costs = [1, 1, 1, 1, 10, 1, 1, 1, 1, 2]
+    runs = split_by_cost(costs, 3)
+    assert len(runs) == 3
+    assert runs[0][0] == 0 and runs[-1][1] == len(costs)
+    for (_, stop), (start, _) in zip(runs[:-1], runs[1:]):
+        assert stop == start
+    assert [sum(costs[a:b]) for (a,b) in runs] == [4, 10, 6]
+
+    assert split_by_cost([], 2) == [(0, 0), (0, 0)]
+
+def test_zyx_tuple():
+    assert zyx_tuple(64) == (64, 64, 64)
+    assert zyx_tuple(np.int64(64)) == (64, 64, 64)
+    assert zyx_tuple([32, 64, 128]) == (32, 64, 128)
+
+def test_dense_roi_mask_anisotropic():
+    from DVIDSparkServices.sparkdvid.Subvolume import Subvolume
+    roi_map = RoiMap([(0,0,0), (0,0,1)])
+    sv = Subvolume(None, (0,0,0), (32, 32, 64), (4, 8, 16), roi_map)
+    mask = dense_roi_mask_for_subvolume(sv)
+    assert mask.shape == sv.shape_with_border == (40, 48, 96)
+
+    # Only the core (the two ROI blocks) is inside the ROI
+    expected = np.zeros(mask.shape, dtype=bool)
+    expected[4:36, 8:40, 16:80] = True
+    assert (mask == expected).all()
+
+    mask = dense_roi_mask_for_subvolume(sv, border=(0, 8, 0))
+    assert mask.shape == (32, 48, 64)
+    assert mask[:, 8:40, :].all() and not mask[:, :8, :].any()
+
 if __name__ == "__main__":
     import sys
     logger.addHandler( logging.StreamHandler(sys.stdout) )
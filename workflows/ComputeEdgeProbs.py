@@ -13,8 +13,8 @@ from DVIDSparkServices.workflow.dvidworkflow import DVIDWorkflow
 import DVIDSparkServices
 from functools import partial
 from DVIDSparkServices.sparkdvid.CompressedNumpyArray import CompressedNumpyArray
-from DVIDSparkServices.auto_retry import auto_retry
-from DVIDSparkServices.sparkdvid.sparkdvid import retrieve_node_service 
+from DVIDSparkServices.sparkdvid.sparkdvid import retrieve_node_service, checkout_node_service, dvid_read_retry
+from DVIDSparkServices.sparkdvid.TokenService import dvid_token
 
 class ComputeEdgeProbs(DVIDWorkflow):
     # schema for creating segmentation
@@ -107,6 +107,12 @@ class ComputeEdgeProbs(DVIDWorkflow):
               "type": "boolean",
               "default": false
             },
+            "spark-serializer": {
+              "description": "How RDD records are serialized for shuffles and persisted RDDs.  'columnar-lz4' stores batches of keyed numeric records, like graph vertices and edges, as lz4-compressed columns (see CreateSegmentation for the other choices).",
+              "type": "string",
+              "enum": ["pickle", "numpy-raw", "numpy-compressed", "columnar-lz4"],
+              "default": "pickle"
+            },
             "debug": {
               "description": "Enable certain debugging functionality.  Mandatory for integration tests.",
               "type": "boolean",
@@ -214,6 +220,8 @@ class ComputeEdgeProbs(DVIDWorkflow):
             pdconf = self.config_data["dvid-info"]
             resource_server = self.resource_server
             resource_port = self.resource_port
+            retry_counts = self.sparkdvid_context.retry_counts
+            dvid_tokens = self.dvid_tokens
 
             # retrieve segmentation and generate features
             def generate_features(vox_pred):
@@ -232,21 +240,17 @@ class ComputeEdgeProbs(DVIDWorkflow):
 
                 # retrieve data from box start position considering border
                 # !! technically ROI is not respected but unwritten segmentation will be ignored since it will have 0-valued pixels.
-                @auto_retry(3, pause_between_tries=60.0, logging_name=__name__)
+                @dvid_read_retry("ComputeEdgeProbs.get_seg", retry_counts)
                 def get_seg():
-                    node_service = retrieve_node_service(pdconf["dvid-server"], 
-                            pdconf["uuid"], resource_server, resource_port)
-                    # retrieve data from box start position
-                    # Note: libdvid uses zyx order for python functions
-                    
-                    if resource_server != "": 
+                    with checkout_node_service(pdconf["dvid-server"], 
+                            pdconf["uuid"], resource_server, resource_port) as node_service, \
+                            dvid_token(dvid_tokens, 'read', 8*size_z*size_y*size_x):
+                        # retrieve data from box start position
+                        # Note: libdvid uses zyx order for python functions
                         return node_service.get_labels3D(str(pdconf["segmentation-name"]),
                             (size_z, size_y, size_x),
-                            (subvolume.box.z2-border, subvolume.box.y1-border, subvolume.box.x1-border))
-                    else:
-                        return node_service.get_labels3D(str(pdconf["segmentation-name"]),
-                             (size_z, size_y, size_x),
-                             (subvolume.box.z2-border, subvolume.box.y1-border, subvolume.box.x1-border))
+                            (subvolume.box.z2-border, subvolume.box.y1-border, subvolume.box.x1-border),
+                            throttle=(resource_server == "" and dvid_tokens is None))
 
                 initial_seg = get_seg()
 
@@ -48,6 +48,18 @@ class ComputeGraph(DVIDWorkflow):
           "description": "size of chunks to be processed",
           "type": "integer",
           "default": 256
+        },
+        "fetch-mode": {
+          "description": "How labels are fetched: 'dense' reads each subvolume's full box and masks it; 'roi-blocks' reads only ROI blocks",
+          "type": "string",
+          "enum": ["dense", "roi-blocks"],
+          "default": "dense"
+        },
+        "spark-serializer": {
+          "description": "How RDD records are serialized for shuffles and persisted RDDs.  'columnar-lz4' stores batches of keyed numeric records, like graph vertices and edges, as lz4-compressed columns (see CreateSegmentation for the other choices).",
+          "type": "string",
+          "enum": ["pickle", "numpy-raw", "numpy-compressed", "columnar-lz4"],
+          "default": "pickle"
         }
       }
     }
@@ -80,7 +92,8 @@ class ComputeGraph(DVIDWorkflow):
         label_chunks = self.sparkdvid_context.map_labels64(distrois,
                                                            self.config_data["dvid-info"]["label-name"],
                                                            border=1,
-                                                           roiname=self.config_data["dvid-info"]["roi"])
+                                                           roiname=self.config_data["dvid-info"]["roi"],
+                                                           fetch_mode=self.config_data["options"]["fetch-mode"])
 
         # map labels to graph data -- external program (eventually convert neuroproof metrics and graph to a python library) ?!
         sg = SimpleGraph.SimpleGraph(self.config_data["options"]) 
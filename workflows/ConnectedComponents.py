@@ -51,6 +51,12 @@ class ConnectedComponents(DVIDWorkflow):
               "type": "integer",
               "default": 512
             },
+            "fetch-mode": {
+              "description": "How labels are fetched: 'dense' reads each subvolume's full box and masks it; 'roi-blocks' reads only ROI blocks",
+              "type": "string",
+              "enum": ["dense", "roi-blocks"],
+              "default": "dense"
+            },
             "debug": {
               "description": "Enable certain debugging functionality.  Mandatory for integration tests.",
               "type": "boolean",
@@ -94,9 +100,11 @@ class ConnectedComponents(DVIDWorkflow):
         distsubvolumes.persist(StorageLevel.MEMORY_AND_DISK_SER)
 
         # grab seg chunks 
+        # (kept lz4-compressed through the join below, until connected_components() needs the voxels)
         seg_chunks = self.sparkdvid_context.map_labels64(distsubvolumes,
                 self.config_data["dvid-info"]["segmentation"],
-                self.overlap/2, self.config_data["dvid-info"]["roi"])
+                self.overlap/2, self.config_data["dvid-info"]["roi"],
+                self.config_data["options"]["fetch-mode"], compressed=True)
 
         # pass substack with labels (no shuffling)
         seg_chunks2 = distsubvolumes.join(seg_chunks) # (sv_id, (subvolume, segmentation))
@@ -106,7 +114,8 @@ class ConnectedComponents(DVIDWorkflow):
         def connected_components(seg_chunk):
             from DVIDSparkServices.reconutils.morpho import split_disconnected_bodies
 
-            _sid, (subvolume, seg) = seg_chunk
+            _sid, (subvolume, seg_compressed) = seg_chunk
+            seg = seg_compressed.deserialize()
             seg_split, split_mapping = split_disconnected_bodies(seg)
             
             # If any zero bodies were split, don't give them new labels.
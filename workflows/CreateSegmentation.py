@@ -15,9 +15,10 @@ import textwrap
 import numpy as np
 import DVIDSparkServices
 from DVIDSparkServices.sparkdvid.Subvolume import Subvolume
+from DVIDSparkServices.sparkdvid.CompressedNumpyArray import CompressedNumpyArray
 from DVIDSparkServices.workflow.dvidworkflow import DVIDWorkflow
-from DVIDSparkServices.sparkdvid.sparkdvid import retrieve_node_service 
-from DVIDSparkServices.util import select_item, mkdir_p, runlength_encode
+from DVIDSparkServices.sparkdvid.sparkdvid import retrieve_node_service, prefetch_subvolumes_per_partition
+from DVIDSparkServices.util import select_item, mkdir_p, runlength_encode, pack_bins, zyx_tuple
 from quilted.h5blockstore import H5BlockStore
 
 class CreateSegmentation(DVIDWorkflow):
@@ -110,10 +111,48 @@ class CreateSegmentation(DVIDWorkflow):
               "default": false
             },
             "chunk-size": {
-              "description": "Size of blocks to process independently (and then stitched together).",
-              "type": "integer",
+              "description": "Size of blocks to process independently (and then stitched together), either an integer (cubes) or [z,y,x].  Non-cubic sizes require the 'grid-aligned' partition-method.",
+              "oneOf": [ { "type": "integer" },
+                         { "type": "array", "items": { "type": "integer" }, "minItems": 3, "maxItems": 3 } ],
               "default": 512
             },
+            "overlap": {
+              "description": "Total overlap between neighboring chunks (i.e. twice the border), either an integer or [z,y,x]",
+              "oneOf": [ { "type": "integer" },
+                         { "type": "array", "items": { "type": "integer" }, "minItems": 3, "maxItems": 3 } ],
+              "default": 40
+            },
+            "fetch-mode": {
+              "description": "How grayscale is fetched: 'dense' reads each subvolume's full box; 'roi-blocks' reads only ROI blocks (grayscale outside the ROI will be 0)",
+              "type": "string",
+              "enum": ["dense", "roi-blocks"],
+              "default": "dense"
+            },
+            "prefetch": {
+              "description": "Number of grayscale subvolumes each task fetches ahead of segmentation (0 disables prefetching).  Tasks only fetch ahead within their own partition, so partitions then hold at least 4x this many subvolumes.",
+              "type": "integer",
+              "default": 0
+            },
+            "subvolumes-per-partition": {
+              "description": "Number of spatially adjacent subvolumes (in Z-order) to group in each Spark partition",
+              "type": "integer",
+              "default": 1
+            },
+            "load-balance": {
+              "description": "Weigh subvolumes by estimated cost (ROI block count, or measured times): iterations are bin-packed by cost and the heaviest subvolumes are scheduled first",
+              "type": "boolean",
+              "default": false
+            },
+            "subvolume-times-file": {
+              "description": "Optional JSON file of measured seconds per subvolume from a previous run, as {'z_y_x': seconds} (keyed by subvolume start), used by load-balance",
+              "type": "string",
+              "default": ""
+            },
+            "block-cache-mb": {
+              "description": "Size of each executor's cache of grayscale blocks, so overlapping subvolume borders are fetched once (0 disables the cache)",
+              "type": "integer",
+              "default": 0
+            },
             "label-offset": {
               "description": "Offset for first body id",
               "type": "number",
@@ -151,6 +190,24 @@ class CreateSegmentation(DVIDWorkflow):
               "type": "integer",
               "default": 125
             },
+            "write-mode": {
+              "description": "'per-subvolume' writes each subvolume separately; 'coalesced' sorts subvolumes by DVID block key, merges neighbors into larger requests, and skips all-zero blocks if the segmentation instance was created by this run",
+              "type": "string",
+              "enum": ["per-subvolume", "coalesced"],
+              "default": "per-subvolume"
+            },
+            "numpy-codecs": {
+              "description": "Codecs for compressing numpy arrays in shuffles and persisted RDDs, by dtype name or 'default', e.g. {'float32': 'lz4:shuffle'}.  Codecs: lz4, lz4:shuffle, labels (default for uint32/uint64), raw, zstd[:<level>], blosc[:<cname>[:<shuffle>[:<level>]]] (see CompressedNumpyArray)",
+              "type": "object",
+              "additionalProperties": { "type": "string" },
+              "default": {}
+            },
+            "spark-serializer": {
+              "description": "How RDD records are serialized for shuffles and persisted RDDs.  'pickle': numpy arrays are pickled as CompressedNumpyArrays.  'numpy-raw': numpy array buffers are sent out of band, uncompressed (fastest, for fast networks).  'numpy-compressed': numpy arrays are sent out of band, compressed with the numpy-codecs.  'columnar-lz4': batches of keyed numeric records (e.g. stitching boundary keys) are stored as lz4-compressed columns, and everything else is pickled and lz4-compressed.",
+              "type": "string",
+              "enum": ["pickle", "numpy-raw", "numpy-compressed", "columnar-lz4"],
+              "default": "pickle"
+            },
             "debug": {
               "description": "Enable certain debugging functionality.  Mandatory for integration tests.",
               "type": "boolean",
@@ -167,9 +224,6 @@ class CreateSegmentation(DVIDWorkflow):
     # assume blocks are 32x32x32
     blocksize = 32
 
-    # overlap between chunks
-    overlap = 40
-
     def __init__(self, config_filename):
         # ?! set number of cpus per task to 2 (make dynamic?)
         super(CreateSegmentation, self).__init__(config_filename, self.Schema, "Create segmentation")
@@ -201,13 +255,15 @@ class CreateSegmentation(DVIDWorkflow):
         from DVIDSparkServices.reconutils.Segmentor import Segmentor
         resource_server = self.resource_server
         resource_port = self.resource_port
-        self.chunksize = self.config_data["options"]["chunk-size"]
+        self.chunksize = zyx_tuple(self.config_data["options"]["chunk-size"])
+        border = tuple( o // 2 for o in zyx_tuple(self.config_data["options"]["overlap"]) )
 
         # create datatype in the beginning
         mutateseg = self.config_data["options"]["mutateseg"]
         node_service = retrieve_node_service(self.config_data["dvid-info"]["dvid-server"], 
                 self.config_data["dvid-info"]["uuid"], resource_server, resource_port)
         success = node_service.create_labelblk(str(self.config_data["dvid-info"]["segmentation-name"]))
+        created_labelblk = success
         # check whether seg should be mutated
         if (not success and mutateseg == "auto") or mutateseg == "yes":
             mutateseg = "yes"
@@ -215,12 +271,23 @@ class CreateSegmentation(DVIDWorkflow):
             mutateseg = "no"
 
         # grab ROI subvolumes and find neighbors
+        load_balance = self.config_data["options"]["load-balance"]
+        measured_seconds = None
+        if load_balance and self.config_data["options"]["subvolume-times-file"]:
+            with open(self.config_data["options"]["subvolume-times-file"]) as f:
+                measured_seconds = json.load(f)
+
+        subvolumes_per_partition = prefetch_subvolumes_per_partition( self.config_data["options"]["prefetch"],
+                                                                      self.config_data["options"]["subvolumes-per-partition"] )
         distsubvolumes = self.sparkdvid_context.parallelize_roi(
                 self.config_data["dvid-info"]["roi"],
-                self.chunksize, self.overlap/2,
+                self.chunksize, border,
                 True,
                 self.config_data["dvid-info"]["partition-method"],
-                self.config_data["dvid-info"]["partition-filter"] )
+                self.config_data["dvid-info"]["partition-filter"],
+                subvolumes_per_partition=subvolumes_per_partition,
+                load_balance=load_balance,
+                measured_seconds=measured_seconds )
 
         # do not recompute ROI for each iteration
         distsubvolumes.persist()
@@ -245,6 +312,18 @@ class CreateSegmentation(DVIDWorkflow):
         if num_parts % iteration_size > 0:
             num_iters += 1
 
+        # With load-balancing, bin-pack the subvolumes into iterations by cost
+        # (otherwise they're assigned round-robin, below)
+        subvolume_costs = {}
+        iteration_of_subvolume = {}
+        if load_balance:
+            all_subvols = distsubvolumes.values().collect()
+            costs = Subvolume.estimate_costs(all_subvols, measured_seconds)
+            subvolume_costs = dict( (sv.sv_index, cost) for sv, cost in zip(all_subvols, costs) )
+            for iteration, items in enumerate(pack_bins(costs, num_iters)):
+                for i in items:
+                    iteration_of_subvolume[all_subvols[i].sv_index] = iteration
+
         seg_chunks_list = []
 
         # enable checkpointing if not empty
@@ -297,6 +376,8 @@ class CreateSegmentation(DVIDWorkflow):
             # in case something pathological is happening -- if original partitioner
             # is randomish than this should be fine
             def subset_part( (s_id, data) ):
+                if iteration_of_subvolume:
+                    return iteration_of_subvolume[s_id] == iternum
                 if (s_id % num_iters) == iternum:
                     return True
                 return False
@@ -339,16 +420,23 @@ class CreateSegmentation(DVIDWorkflow):
             ##
             ## UNCACHED SUBVOLS
             ##    
-            uncached_subvols = self.sparkdvid_context.sc.parallelize(subvols_without_seg_cache, len(subvols_without_seg_cache) or None)
-            uncached_subvols.persist()
-
-            def prepend_sv_index(subvol):
-                return (subvol.sv_index, subvol)
-            uncached_subvols_kv_rdd = uncached_subvols.map(prepend_sv_index)
+            # Keep the Z-order grouping (and heaviest-first order) of parallelize_roi()
+            uncached_costs = None
+            if load_balance:
+                uncached_costs = [subvolume_costs[sv.sv_index] for sv in subvols_without_seg_cache]
+            uncached_subvols_kv_rdd = self.sparkdvid_context.parallelize_subvolumes( subvols_without_seg_cache,
+                                                                                     self.chunksize,
+                                                                                     subvolumes_per_partition,
+                                                                                     uncached_costs )
+            uncached_subvols_kv_rdd.persist()
+            uncached_subvols = uncached_subvols_kv_rdd.values()
 
             # get grayscale chunks with specified overlap
             uncached_sv_and_gray = self.sparkdvid_context.map_grayscale8(uncached_subvols_kv_rdd,
-                                                                         self.config_data["dvid-info"]["grayscale"])
+                                                                         self.config_data["dvid-info"]["grayscale"],
+                                                                         self.config_data["options"]["fetch-mode"],
+                                                                         prefetch=self.config_data["options"]["prefetch"],
+                                                                         block_cache_bytes=self.config_data["options"]["block-cache-mb"] * 2**20)
 
             uncached_gray_vols = select_item(uncached_sv_and_gray, 1, 1)
 
@@ -385,6 +473,13 @@ class CreateSegmentation(DVIDWorkflow):
             seg_chunks = seg_chunks.union(seg_chunks_list[iter1])
         del seg_chunks_list
 
+        # Keep the labels compressed while persisted, so that stitching
+        # only needs to decompress the boundary slabs it extracts.
+        def compress_seg(seg_and_max_id):
+            seg, max_id = seg_and_max_id
+            return (CompressedNumpyArray(seg), max_id)
+        seg_chunks = seg_chunks.mapValues(compress_seg)
+
         # persist through stitch
         # any forced persistence will result in costly
         # pickling, lz4 compressed numpy array should help
@@ -399,13 +494,21 @@ class CreateSegmentation(DVIDWorkflow):
             return (subvol.sv_index, item)
         mapped_seg_chunks = mapped_seg_chunks.map(prepend_key)
        
+        write_mode = self.config_data["options"]["write-mode"]
+        num_write_partitions = None
         if self.config_data["options"]["parallelwrites"] > 0:
-            # repartition to fewer partition if there is write bandwidth limits to DVID
-            # (coalesce() doesn't balance the partitions, so we opt for a full shuffle.)
-            mapped_seg_chunks = mapped_seg_chunks.repartition(self.config_data["options"]["parallelwrites"])
+            num_write_partitions = self.config_data["options"]["parallelwrites"]
+            if write_mode == "per-subvolume":
+                # repartition to fewer partition if there is write bandwidth limits to DVID
+                # (coalesce() doesn't balance the partitions, so we opt for a full shuffle.)
+                # ('coalesced' mode does its own (sorted) repartitioning.)
+                mapped_seg_chunks = mapped_seg_chunks.repartition(num_write_partitions)
 
         # write data to DVID
-        self.sparkdvid_context.foreach_write_labels3d(self.config_data["dvid-info"]["segmentation-name"], mapped_seg_chunks, self.config_data["dvid-info"]["roi"], mutateseg)
+        self.sparkdvid_context.foreach_write_labels3d(self.config_data["dvid-info"]["segmentation-name"], mapped_seg_chunks,
+                                                      self.config_data["dvid-info"]["roi"], mutateseg,
+                                                      write_mode=write_mode, num_partitions=num_write_partitions,
+                                                      skip_zero_blocks=created_labelblk)
         self.logger.write_data("Wrote DVID labels") # write to logger after spark job
 
         if self.config_data["options"]["debug"]:
@@ -1,7 +1,7 @@
 """Defines workflow for extracting stats to compare two segmentations."""
 
 from DVIDSparkServices.workflow.dvidworkflow import DVIDWorkflow
-from DVIDSparkServices.sparkdvid.sparkdvid import retrieve_node_service 
+from DVIDSparkServices.sparkdvid.sparkdvid import retrieve_node_service, prefetch_subvolumes_per_partition
 
 class EvaluateSeg(DVIDWorkflow):
     # schema for evaluating segmentation
@@ -96,6 +96,11 @@ class EvaluateSeg(DVIDWorkflow):
           "type": "integer",
           "default": 2
         },
+        "prefetch": {
+          "description": "Number of subvolume pairs each task fetches ahead of evaluation (0 disables prefetching).  Tasks only fetch ahead within their own partition, so partitions then hold 4x this many subvolumes.",
+          "type": "integer",
+          "default": 0
+        },
         "important-bodies": {
           "description": "filter metrics based on this list of GT bodies",
           "type": "array",
@@ -143,7 +148,8 @@ class EvaluateSeg(DVIDWorkflow):
 
         #  grab ROI (no overlap and no neighbor checking)
         distrois = self.sparkdvid_context.parallelize_roi(self.config_data["dvid-info"]["roi"],
-                self.chunksize)
+                self.chunksize,
+                subvolumes_per_partition=prefetch_subvolumes_per_partition(self.config_data["options"]["prefetch"]))
 
         # map ROI to two label volumes (0 overlap)
         # this will be used for all volume and point overlaps
@@ -153,7 +159,8 @@ class EvaluateSeg(DVIDWorkflow):
                 distrois, self.config_data["dvid-info"]["label-name"],
                 self.config_data["dvid-info-comp"]["dvid-server"],
                 self.config_data["dvid-info-comp"]["uuid"],
-                self.config_data["dvid-info-comp"]["label-name"], self.config_data["dvid-info"]["roi"])
+                self.config_data["dvid-info-comp"]["label-name"], self.config_data["dvid-info"]["roi"],
+                prefetch=self.config_data["options"]["prefetch"])
       
         # filter bodies if there is a body list from GT
         important_bodies = self.config_data["options"]["important-bodies"]
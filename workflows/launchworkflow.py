@@ -56,6 +56,13 @@ def main(argv):
             workflow_inst = workflow_cls(args.config_file)
             workflow_inst.execute()
 
+            # Summarize any DVID retries (and block cache use) on the executors
+            if hasattr(workflow_inst, "sparkdvid_context"):
+                workflow_inst.sparkdvid_context.report_retry_counts()
+                workflow_inst.sparkdvid_context.report_block_cache_stats()
+            if workflow_inst.dvid_token_server is not None:
+                workflow_inst.dvid_token_server.shutdown()
+
     # TODO: handle exceptions here
     except WorkflowError as e:
         raise